@@ -7,7 +7,8 @@
 # A       : area (float)
 # n_moths : number of moths (int)
 # n_flies : number of flies (int)
-# cost    : cost without bayes (dataframe, has the 'n_flies' and the 'n_moths' columns)
+# cost    : cost without bayes (dataframe, has the 'n_flies' and the 'n_moths' columns),
+#           or a lookup table (dictionary) {(n_moths, n_flies): cost}
 # dens_moths       : list with moth densities
 # prob_dens_moths : list with moth density probabilities
 #
@@ -25,8 +26,11 @@ def bayes_cost(dens_moths, prob_dens_moths, sample_n_moths, sample_area, n_flies
     norm_factor = 0
     for idx in range(len(dens_moths)):
         local_prob = poisson(sample_n_moths, sample_area, dens_moths[idx]) * prob_dens_moths[idx]
-        cost_b += local_prob * costs[(costs['#moths'] == int(dens_moths[idx] * density_factor)) &
-                                     (costs['#flies'] == n_flies)]['cost'].iloc[-1]
+        if isinstance(costs, dict):
+            cost_b += local_prob * costs[(int(dens_moths[idx] * density_factor), int(n_flies))]
+        else:
+            cost_b += local_prob * costs[(costs['#moths'] == int(dens_moths[idx] * density_factor)) &
+                                         (costs['#flies'] == n_flies)]['cost'].iloc[-1]
         norm_factor += local_prob
 
     return cost_b / norm_factor
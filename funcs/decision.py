@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+#
+# Precomputed decision table: "given n moths counted on a sample of area A,
+# how many flies should be released?".
+#
+# The table is built once, from the simple costs of the simulations and the
+# moth density distribution (the same inputs of the bayes cost, see
+# 'funcs.bayes'), over a grid of sample counts n and sample areas A:
+#    > the posterior of the density p given the sample is
+#      poisson(n; p A) P(p) / sum_p' poisson(n; p' A) P(p')
+#    > the bayes cost of each number of flies is the posterior mean of the
+#      simple costs of the (density, #flies) pairs
+# for all the grid at once. The table keeps the bayes costs of every number of
+# flies on every grid node (the 'cost' cube), and the best number of flies on
+# each node (the 'decision' grid).
+#
+# The table is saved as a directory of '.npy' files, loaded memory-mapped (so
+# it starts up instantly, and only the pages actually looked up are read).
+# Queries off the grid interpolate the bayes costs (bilinear on n and A) and
+# take the number of flies with the lowest one.
+
+import os
+import bisect
+import numpy as np
+import scipy.stats as stats
+from scipy.special import logsumexp
+
+_FILES = ['n', 'area', 'n_flies', 'cost', 'decision']
+
+
+#
+# builds the decision table over the grid 'n_values' x 'area_values', for the
+# numbers of flies on 'n_flies_list'.
+#
+# p_data         : dataframe with the moth densities and their probabilities ('p', 'P(p)')
+# costs          : simple costs (dataframe with '#flies', '#moths' and 'cost'
+#                  columns, the last row of each pair is used), or a lookup
+#                  table {(n_moths, n_flies): cost}
+# density_factor : #moths of a density (as on 'SimulationControl')
+def build_decision_table(p_data, costs, n_flies_list, n_values, area_values, density_factor=10000):
+    dens_moths = np.asarray(p_data['p'].values, dtype=float)
+    prob_dens_moths = np.asarray(p_data['P(p)'].values, dtype=float)
+    n_values = np.asarray(n_values, dtype=float)
+    area_values = np.asarray(area_values, dtype=float)
+    n_flies_list = np.asarray(n_flies_list)
+
+    if not isinstance(costs, dict):
+        costs = {(int(m), int(f)): c for m, f, c in zip(costs['#moths'].values, costs['#flies'].values,
+                                                         costs['cost'].values)}
+    pairs = [(int(p * density_factor), int(f)) for p in dens_moths for f in n_flies_list]
+    missing = [pair for pair in pairs if pair not in costs]
+    if missing:
+        raise ValueError('{} (#moths, #flies) costs are missing, e.g. {}'.format(len(missing), missing[:5]))
+    simple_costs = np.array([costs[pair] for pair in pairs]).reshape(len(dens_moths), len(n_flies_list))
+
+    # posterior of the densities on each grid node: (n, A, p)
+    with np.errstate(divide='ignore'):
+        log_posterior = (stats.poisson.logpmf(n_values[:, None, None], dens_moths[None, None, :] *
+                                              area_values[None, :, None]) + np.log(prob_dens_moths)[None, None, :])
+        log_posterior -= logsumexp(log_posterior, axis=2, keepdims=True)
+
+    cost = np.exp(log_posterior) @ simple_costs
+    return DecisionTable(n_values, area_values, n_flies_list, cost.astype(np.float32),
+                         n_flies_list[np.argmin(cost, axis=2)])
+
+
+# loads a saved decision table (memory-mapped)
+def load_decision_table(path):
+    return DecisionTable(*[np.load(os.path.join(path, name + '.npy'), mmap_mode='r') for name in _FILES])
+
+
+#
+# index i and weight of the grid point i + 1 for the linear interpolation of
+# 'x' between 'grid[i]' and 'grid[i + 1]' (clipped to the grid)
+def _locate(grid, x):
+    if len(grid) == 1:
+        return 0, 0, 0.0
+    i = min([max([bisect.bisect_right(grid, x) - 1, 0]), len(grid) - 2])
+    weight = (x - grid[i]) / (grid[i + 1] - grid[i])
+    return i, i + 1, min([max([weight, 0.0]), 1.0])
+
+
+# vectorized '_locate()'
+def _locate_all(grid, x):
+    if len(grid) == 1:
+        zeros = np.zeros(x.shape, dtype=int)
+        return zeros, zeros, np.zeros(x.shape)
+    i = np.clip(np.searchsorted(grid, x, side='right') - 1, 0, len(grid) - 2)
+    weight = np.clip((x - grid[i]) / (grid[i + 1] - grid[i]), 0.0, 1.0)
+    return i, i + 1, weight
+
+
+class DecisionTable:
+
+    # grid axes, #flies, bayes cost cube (n, A, #flies) and best #flies (n, A)
+    def __init__(self, n, area, n_flies, cost, decision):
+        self.n = n
+        self.area = area
+        self.n_flies = n_flies
+        self.cost = cost
+        self.decision = decision
+
+        # python lists of the axes and plain array view of the costs (still on
+        # the mapped file, without the memmap overhead), for the lookups
+        self._n = [float(x) for x in n]
+        self._area = [float(x) for x in area]
+        self._cost = np.asarray(cost)
+
+    def save(self, path):
+        if not os.path.exists(path):
+            os.mkdir(path)
+        for name in _FILES:
+            np.save(os.path.join(path, name + '.npy'), np.asarray(getattr(self, name)))
+
+    # bayes costs of each #flies for a sample (interpolated)
+    def costs(self, n, area):
+        i0, i1, u = _locate(self._n, n)
+        j0, j1, v = _locate(self._area, area)
+        c = self._cost
+        return (((1 - u) * (1 - v)) * c[i0, j0] + ((1 - u) * v) * c[i0, j1] +
+                (u * (1 - v)) * c[i1, j0] + (u * v) * c[i1, j1])
+
+    # number of flies to release for a sample of 'n' moths on area 'area'
+    def flies(self, n, area):
+        return self.n_flies[int(np.argmin(self.costs(n, area)))]
+
+    #
+    # numbers of flies for arrays of samples (same interpolation as
+    # 'flies()', all the samples at once)
+    def lookup(self, n, area):
+        n, area = np.broadcast_arrays(np.asarray(n, dtype=float), np.asarray(area, dtype=float))
+        i0, i1, u = _locate_all(np.asarray(self.n), n)
+        j0, j1, v = _locate_all(np.asarray(self.area), area)
+        c = self._cost
+        u, v = u[..., None], v[..., None]
+        costs = (((1 - u) * (1 - v)) * c[i0, j0] + ((1 - u) * v) * c[i0, j1] +
+                 (u * (1 - v)) * c[i1, j0] + (u * v) * c[i1, j1])
+        return np.asarray(self.n_flies)[np.argmin(costs, axis=-1)]
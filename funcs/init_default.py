@@ -6,15 +6,20 @@
 #     > simulationControl
 #     > plotter
 # with optionally definable parameters
+#
+# The simulation package imports the bayes cost from 'funcs', so its classes
+# are only imported when the function runs: 'import funcs' and 'import simul'
+# work in any order, and 'funcs.init_default' is always the function
 
-from simul.universe import Universe
-from simul.world import WonderfulWorld
-from simul.control import SimulationControl
-from media.plotter import Plotter
 import numpy as np
 
 
 def init_default():
+    from simul.universe import Universe
+    from simul.world import WonderfulWorld
+    from simul.control import SimulationControl
+    from media.plotter import Plotter
+
     # set the pseudo-random number generator with a fixed seed
     np.random.seed(42)
 
@@ -5,11 +5,14 @@
 # images. Only afterwards, optionally, a video can be generated using those
 # images.
 #
+# matplotlib (and opencv, for the videos) are only imported when an image
+# (or video) is actually generated, so creating a plotter - or importing
+# this module - doesn't load them. Worker processes and scripts that never
+# plot anything can run on hosts without a display or without opencv.
+#
 
 import os
 import numpy as np
-import matplotlib.pyplot as plt
-from media.video import make_video
 
 
 class Plotter:
@@ -32,12 +35,15 @@ class Plotter:
         self.n_simuls = n_simuls
 
     def save_image(self, df, idx=0):
+        import matplotlib.pyplot as plt
+
         df[self.columns].plot()
         plt.title(self.title + (' {0:0{1}}'.format(idx, self.n_simuls_prec)))
         plt.savefig(self.path + ('_{0:0{1}}'.format(idx, self.n_simuls_prec)))
         plt.close()
 
     def make_video(self, out_path, fps=None):
+        from media.video import make_video
 
         images = [(self.path + '_{0:0{1}}.png'.format(i, self.n_simuls_prec)) for i in range(self.n_simuls)]
 
@@ -18,12 +18,15 @@
 #    By default, the video will have the size of the first image.
 #    It will resize every image to this size before adding them to the video.
 #
+#    opencv is imported only when a video is made, so this module can be
+#    imported on hosts without it.
+#
 import os
-from cv2 import VideoWriter, VideoWriter_fourcc, imread, resize
 
 
 def make_video(images, outvid=None, fps=5, size=None,
                is_color=True, vformat="XVID"):
+    from cv2 import VideoWriter, VideoWriter_fourcc, imread, resize
 
     fourcc = VideoWriter_fourcc(*vformat)
     vid = None
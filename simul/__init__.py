@@ -1,6 +1,20 @@
 from .universe import Universe
 from .world import WonderfulWorld
+from .events import EventWorld
 from .creatures import Creature
 from .creatures import Moth
 from .creatures import Fly
-from .control import SimulationControl
+from .control import SimulationControl, DownscalingWarning
+from .log import SimulationLog
+from .catalog import ResultsCatalog
+from .ledger import CostsLedger
+from .meanfield import MeanFieldWorld
+from .stream import open_streamed_log
+from .telemetry import Telemetry
+from .calibration import AbcSmc
+from .costindex import CostIndex
+from .multilevel import MultilevelCost
+from .sensitivity import SensitivityAnalysis
+from .metapop import Metapopulation
+from .splitting import RareEventSplitting
+from .sharded import ShardedWorld
@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+#
+# Calibration of universe parameters against field data, by Approximate
+# Bayesian Computation with Sequential Monte Carlo (ABC-SMC).
+#
+# Field data (without the parasitoid flies):
+#    > moth density distribution ('Densidade_sem_cotesia-bin_02.txt'): the
+#      densities p and their probabilities P(p)
+#    > field samples ('BrocasP-No-Area.txt'): number of moths n found on a
+#      sample of area A (and n/A)
+# summarized by the statistics
+#    1. mean moth density
+#    2. fraction of (near) zero densities
+#    3. fraction of samples without moths
+#    4. mean sampled density n/A
+#
+# A parameter set is evaluated with 'n_replicates' short simulations without
+# flies, each one starting from a moth density drawn from P(p). The density
+# at the end of each replicate gives the same statistics (the sample ones as
+# expected values over the observed sample areas) and the distance is the
+# scaled euclidean distance between the simulated and the observed statistics.
+#
+# All the statistics are averages over the replicates of non-negative (and,
+# for the fractions, bounded) values, so after some of the replicates the
+# final statistics are known to lie in a box. When the whole box is farther
+# than the tolerance from the observed statistics, the evaluation is aborted:
+# the parameter set would be rejected anyway. Most of the rejected candidates
+# are dropped after a few replicates, and the candidates of a generation are
+# evaluated in parallel.
+#
+# ABC-SMC (Beaumont et al., 2009): the first generation samples the (uniform)
+# priors; each of the next ones perturbs particles of the previous one (with a
+# gaussian kernel, twice the weighted covariance of the particles), keeping the
+# ones within a tolerance that is a quantile of the previous distances, until
+# 'n_particles' are accepted, and weights them by prior / kernel mixture.
+
+import numpy as np
+import pandas as pd
+import scipy.stats as stats
+
+from simul.universe import Universe
+from simul.creatures import Creature
+from simul.creatures import Moth
+from simul.creatures import Fly
+from simul.parallel import light_control, job_seeds, run_jobs
+
+_STATISTICS = ['mean_density', 'zero_density', 'zero_samples', 'mean_sampled_density']
+
+# bounds of the replicate values of each statistic
+_LOW = np.array([0.0, 0.0, 0.0, 0.0])
+_HIGH = np.array([np.inf, 1.0, 1.0, np.inf])
+
+
+#
+# reads the field data files: the samples (columns 'n', 'A', 'n/A') and the
+# moth densities (columns 'p', 'P(p)')
+def load_field_data(samples_file, densities_file):
+    samples = pd.read_csv(samples_file, sep=r'\s+', header=None, names=['n', 'A', 'n/A'])
+    densities = pd.read_csv(densities_file, sep=r'\s+', header=None, names=['p', 'P(p)'])
+    return samples, densities
+
+
+# observed statistics ('_STATISTICS' order)
+def observed_statistics(samples, densities, zero_tol=0.01):
+    prob = densities['P(p)'].values / densities['P(p)'].values.sum()
+    return np.array([
+        np.sum(densities['p'].values * prob),
+        np.sum(prob[densities['p'].values < zero_tol]),
+        np.mean(samples['n'].values == 0),
+        np.mean(samples['n'].values / samples['A'].values)
+    ])
+
+
+#
+# statistics values of a replicate that ended with a moth density 'p', for the
+# observed sample areas
+def replicate_statistics(p, sample_areas, zero_tol=0.01):
+    return np.array([p, float(p < zero_tol), np.mean(np.exp(-p * sample_areas)), p])
+
+
+#
+# smallest possible distance to the observed statistics, when 'done' of the
+# 'total' replicates gave the 'partial' sums of the statistics
+def distance_bound(partial, done, total, observed, scales):
+    low = (partial + _LOW * (total - done)) / total
+    high = partial / total + (_HIGH * (total - done) / total if done < total else 0)
+    closest = np.clip(observed, low, high)
+    return np.sqrt(np.sum(((closest - observed) / scales) ** 2))
+
+
+#
+# evaluates a parameter set on a worker: runs the replicates (aborting as soon
+# as the distance is known to be over 'epsilon') and returns the distance
+# (inf if aborted) and the number of replicates run. The creatures' universe
+# is restored on exit (the serial jobs run on the caller's process)
+def abc_distance_job(control, parameters, initial_densities, sample_areas, observed, scales,
+                     simul_time, epsilon, seed, zero_tol=0.01, column='moth-living'):
+    creature_universe = Creature.universe
+    try:
+        np.random.seed(seed)
+        universe = Universe(**dict(control.world.universe.parameters, **parameters))
+        world = type(control.world)(universe, fil=control.world.initial_lifespan[Fly],
+                                    mil=control.world.initial_lifespan[Moth])
+        control = type(control)(world, control.cost_fly, control.cost_moth, density_factor=control.density_factor,
+                                area_fraction=control.area_fraction)
+        Creature.universe = universe
+
+        n_replicates = len(initial_densities)
+        partial = np.zeros(len(observed))
+        for i, p in enumerate(initial_densities):
+            data_log = control.run_world(0, int(round(p * control.density_factor)), simul_time, lean=True)
+            partial += replicate_statistics(data_log[column][-1] / control.density_factor, sample_areas, zero_tol)
+            if distance_bound(partial, i + 1, n_replicates, observed, scales) > epsilon:
+                return np.inf, i + 1
+
+        return np.sqrt(np.sum(((partial / n_replicates - observed) / scales) ** 2)), n_replicates
+    finally:
+        Creature.universe = creature_universe
+
+
+class AbcSmc:
+
+    # control      : simulation control (its world, universe and area fraction
+    #                are the base of the candidates; an 'EventWorld' and an area
+    #                fraction make the evaluations much cheaper)
+    # samples, densities : field data (see 'load_field_data()')
+    # priors       : dictionary {universe parameter name: (low, high)}, uniform
+    # simul_time   : steps of each replicate
+    # n_replicates : replicates per candidate
+    # n_particles  : accepted particles per generation
+    # alpha        : quantile of the distances used as the next tolerance
+    # scales       : scales of the statistics on the distance (default: the
+    #                observed values, i.e., relative differences)
+    def __init__(self, control, samples, densities, priors, simul_time=60, n_replicates=20,
+                 n_particles=200, alpha=0.5, scales=None, zero_tol=0.01, column='moth-living',
+                 batch_size=32, n_workers=None):
+        self.control = light_control(control)
+        self.densities = densities
+        self.sample_areas = samples['A'].values.astype(float)
+        self.priors = dict(priors)
+        self.names = list(self.priors)
+        self.low = np.array([self.priors[name][0] for name in self.names], dtype=float)
+        self.high = np.array([self.priors[name][1] for name in self.names], dtype=float)
+        self.simul_time = simul_time
+        self.n_replicates = n_replicates
+        self.n_particles = n_particles
+        self.alpha = alpha
+        self.zero_tol = zero_tol
+        self.column = column
+        self.batch_size = batch_size
+        self.n_workers = n_workers
+
+        self.observed = observed_statistics(samples, densities, zero_tol=zero_tol)
+        self.scales = np.maximum(np.abs(self.observed), 1e-6) if scales is None else np.array(scales)
+
+        self.particles = None
+        self.weights = None
+        self.distances = None
+        self.epsilon = np.inf
+        self.history = []
+
+    def in_support(self, theta):
+        return np.all(theta >= self.low) and np.all(theta <= self.high)
+
+    # draws the initial moth densities of the replicates of a candidate
+    def initial_densities(self):
+        prob = self.densities['P(p)'].values / self.densities['P(p)'].values.sum()
+        return np.random.choice(self.densities['p'].values, size=self.n_replicates, p=prob)
+
+    #
+    # evaluates a list of candidates (arrays of parameters) in parallel, with
+    # the current tolerance. Returns the distances and the replicates run
+    def evaluate(self, candidates):
+        jobs = [(self.control, dict(zip(self.names, theta.tolist())), self.initial_densities(), self.sample_areas,
+                 self.observed, self.scales, self.simul_time, self.epsilon, seed, self.zero_tol, self.column)
+                for theta, seed in zip(candidates, job_seeds(len(candidates)))]
+        results = run_jobs(abc_distance_job, jobs, n_workers=self.n_workers)
+        return np.array([d for d, _ in results]), sum(n for _, n in results)
+
+    # draws a candidate from the previous generation, perturbed by the kernel
+    def propose(self, covariance):
+        while True:
+            idx = np.random.choice(len(self.particles), p=self.weights)
+            theta = np.random.multivariate_normal(self.particles[idx], covariance)
+            if self.in_support(theta):
+                return theta
+
+    #
+    # runs one generation: samples the priors (first generation) or perturbs the
+    # previous particles, until 'n_particles' candidates are within the tolerance
+    def generation(self):
+        first = self.particles is None
+        if not first:
+            self.epsilon = np.quantile(self.distances, self.alpha)
+            covariance = 2 * np.atleast_2d(np.cov(self.particles.T, aweights=self.weights))
+
+        accepted, distances = [], []
+        n_proposed = n_replicates = 0
+        while len(accepted) < self.n_particles:
+            if first:
+                candidates = [np.random.uniform(self.low, self.high) for _ in range(self.batch_size)]
+            else:
+                candidates = [self.propose(covariance) for _ in range(self.batch_size)]
+            batch_distances, batch_replicates = self.evaluate(candidates)
+            n_proposed += len(candidates)
+            n_replicates += batch_replicates
+            for theta, distance in zip(candidates, batch_distances):
+                if (distance <= self.epsilon) and (len(accepted) < self.n_particles):
+                    accepted.append(theta)
+                    distances.append(distance)
+
+        accepted = np.array(accepted)
+        if first:
+            weights = np.ones(len(accepted))
+        else:
+            kernel = stats.multivariate_normal(mean=np.zeros(len(self.names)), cov=covariance)
+            weights = np.array([1.0 / np.sum(self.weights * kernel.pdf(theta - self.particles)) for theta in accepted])
+
+        self.particles = accepted
+        self.weights = weights / weights.sum()
+        self.distances = np.array(distances)
+        self.history.append({
+            'generation': len(self.history),
+            'epsilon': self.epsilon,
+            'proposed': n_proposed,
+            'acceptance_rate': len(accepted) / n_proposed,
+            'replicates': n_replicates,
+            'replicates_saved': 1 - n_replicates / (n_proposed * self.n_replicates)
+        })
+        print('abc generation {}: epsilon {:.4g}, acceptance {:.3f}, {:.0%} of the replicates saved'
+              .format(len(self.history) - 1, self.epsilon, self.history[-1]['acceptance_rate'],
+                      self.history[-1]['replicates_saved']))
+
+    #
+    # runs up to 'n_generations' generations, stopping earlier if the
+    # acceptance rate falls below 'min_acceptance'.
+    #
+    # Returns the dataframe of the final particles (parameters, distance, weight)
+    def run(self, n_generations=5, min_acceptance=0.01):
+        for _ in range(n_generations):
+            self.generation()
+            if self.history[-1]['acceptance_rate'] < min_acceptance:
+                break
+        return self.posterior()
+
+    def posterior(self):
+        posterior = pd.DataFrame(data=self.particles, columns=self.names)
+        posterior['distance'] = self.distances
+        posterior['weight'] = self.weights
+        return posterior
+
+    # weighted posterior mean of the parameters, as a universe
+    def universe(self):
+        mean = dict(zip(self.names, np.sum(self.particles * self.weights[:, None], axis=0).tolist()))
+        return Universe(**dict(self.control.world.universe.parameters, **mean))
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+#
+# Results catalog. Indexes a directory with simulation results (the csv
+# files written by 'SimulationControl.simulation_batch()') so they don't
+# have to be parsed over and over again every time a cost is evaluated.
+#
+# For each csv file the catalog records:
+#    > the file modification time and size (used to detect changes)
+#    > the initial populations (#flies, #moths) and the number of rows
+#    > a binary (.npz) cache with only the columns needed by the costs
+#
+# The index and the caches are kept on a hidden subdirectory of the
+# results directory, so the catalog can be reopened by later runs. A
+# refresh only parses the files that are new or that changed since the
+# last time, and the parsing is spread over a pool of processes.
+
+import os
+import json
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+
+_CATALOG_DIR = '.catalog'
+_CATALOG_INDEX = 'index.json'
+_CATALOG_COLUMNS = ['moth-caterpillars', 'moth-living', 'fly-living']
+
+
+#
+# parses a single csv file and saves its cached columns (on the 'cache'
+# path, relative to the catalog directory). Defined at the module level so it
+# can be sent to the worker processes.
+#
+# Returns the index entry of the file
+def _index_file(src, catalog_dir, cache, stat):
+    df = pd.read_csv(src, usecols=lambda col: col in _CATALOG_COLUMNS)
+    dst = os.path.join(catalog_dir, cache)
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    np.savez(dst, **{col: df[col].values for col in _CATALOG_COLUMNS})
+    return {
+        'mtime': stat[0],
+        'size': stat[1],
+        '#flies': int(df['fly-living'].iloc[0]),
+        '#moths': int(df['moth-living'].iloc[0]),
+        'rows': len(df),
+        'cache': cache
+    }
+
+
+def _index_file_star(args):
+    return _index_file(*args)
+
+
+class ResultsCatalog:
+
+    # receives the results directory. 'n_workers' is the number of processes
+    # used to parse the csv files (None uses one per cpu)
+    def __init__(self, parent_dir, n_workers=None):
+        self.parent_dir = parent_dir
+        self.catalog_dir = os.path.join(parent_dir, _CATALOG_DIR)
+        self.n_workers = n_workers
+        self.index = {}
+
+        index_path = os.path.join(self.catalog_dir, _CATALOG_INDEX)
+        if os.path.exists(index_path):
+            with open(index_path) as f:
+                self.index = json.load(f)
+
+    # the index key of a file: its path relative to the results directory
+    # (the files may be given with a subdirectory, 'run1/simul_mean.csv')
+    def key(self, f):
+        return os.path.relpath(os.path.join(self.parent_dir, f), self.parent_dir)
+
+    #
+    # updates the index for the given files (all csv files of the directory,
+    # by default). Only new or modified files are parsed; entries of files
+    # that no longer exist are dropped.
+    #
+    # Returns the list of files (index keys) that were (re)parsed
+    def refresh(self, files=None):
+        if files is None:
+            files = sorted(f for f in os.listdir(self.parent_dir) if f.endswith('.csv'))
+
+        if not os.path.exists(self.catalog_dir):
+            os.mkdir(self.catalog_dir)
+
+        # drops the entries of removed files (and their caches)
+        for f in [f for f in self.index if not os.path.exists(os.path.join(self.parent_dir, f))]:
+            cache = os.path.join(self.catalog_dir, self.index.pop(f)['cache'])
+            if os.path.exists(cache):
+                os.remove(cache)
+
+        jobs = []
+        keys = []
+        for f in [self.key(f) for f in files]:
+            st = os.stat(os.path.join(self.parent_dir, f))
+            entry = self.index.get(f)
+            if (entry is None) or (entry['mtime'] != st.st_mtime_ns) or (entry['size'] != st.st_size):
+                jobs.append((os.path.join(self.parent_dir, f), self.catalog_dir, f[:-len('.csv')] + '.npz',
+                             (st.st_mtime_ns, st.st_size)))
+                keys.append(f)
+
+        if len(jobs) > 1 and self.n_workers != 1:
+            n_workers = self.n_workers or os.cpu_count() or 1
+            with ProcessPoolExecutor(max_workers=n_workers) as pool:
+                entries = list(pool.map(_index_file_star, jobs,
+                                        chunksize=max([1, len(jobs) // (4 * n_workers)])))
+        else:
+            entries = [_index_file(*job) for job in jobs]
+
+        for f, entry in zip(keys, entries):
+            self.index[f] = entry
+
+        if jobs:
+            self.save()
+
+        return keys
+
+    # writes the index file (atomically, so concurrent readers never see
+    # a half-written index)
+    def save(self):
+        index_path = os.path.join(self.catalog_dir, _CATALOG_INDEX)
+        with open(index_path + '.tmp', 'w') as f:
+            json.dump(self.index, f)
+        os.replace(index_path + '.tmp', index_path)
+
+    # returns the index entry of a file
+    def entry(self, f):
+        return self.index[self.key(f)]
+
+    # returns a dictionary with the cached columns of a file
+    def columns(self, f):
+        with np.load(os.path.join(self.catalog_dir, self.entry(f)['cache'])) as data:
+            return {col: data[col] for col in data.files}
+
+    # the index as a dataframe, one row per file
+    def to_dataframe(self):
+        return pd.DataFrame.from_dict(self.index, orient='index')
@@ -11,15 +11,35 @@
 # or a video with that evolution.
 
 import os
+import time
+import warnings
 import numpy as np
 import pandas as pd
 import scipy.integrate as integrate
+import scipy.stats as stats
 from funcs.bayes import bayes_cost
+from simul.log import SimulationLog
+from simul.catalog import ResultsCatalog
+from simul.ledger import CostsLedger
+from simul.parallel import light_control, job_seeds, batch_cost_job, run_jobs
+from simul.stream import create_streamed_log, open_streamed_log
+from simul.telemetry import creature_days
+from simul.writer import BackgroundWriter
+from simul.sharedlog import run_shared_replicates
+from simul.designs import design_uniforms, design_report
+from simul.creatures import Moth
+from simul.creatures import Fly
 
 _COST_COLUMNS = ['#flies', '#moths', '#steps', '#simuls', 'cost']
 _BAYES_COST_COLUMNS = ['#flies', 'sample_#moth', 'sample_area', 'bayes_cost']
 
 
+# warning issued when the area downscaled simulations may not represent the
+# full area ones (too few creatures, extinctions, different cost distributions)
+class DownscalingWarning(UserWarning):
+    pass
+
+
 class SimulationControl:
 
     # receives a world to be simulated and the costs
@@ -28,28 +48,164 @@ class SimulationControl:
     # and probabilities file and the actual number of moths
     # dim[density factor] : hectare (area)
     # density_factor * density : hectare * (n_moths / hectare) = n_moths
-    def __init__(self, world, cost_fly, cost_moth, plotter=None, density_factor=10000):
+    #
+    # if a costs ledger (see 'simul.ledger.CostsLedger') is given, the simple
+    # costs of the simulation batches are appended to it instead of to the
+    # '*_cost.csv' files
+    #
+    # area_fraction < 1 turns on the area downscaled mode: each simulation runs
+    # on that fraction of the area, with proportionally less moths and flies,
+    # and its logged counts are scaled back up (see 'run_world()')
+    #
+    # if a telemetry object (see 'simul.telemetry.Telemetry') is given, the
+    # progress of the sweeps, batches and replicates is reported to it
+    def __init__(self, world, cost_fly, cost_moth, plotter=None, density_factor=10000, costs_ledger=None,
+                 area_fraction=1.0, telemetry=None):
         self.world = world
         self.cost_fly = cost_fly
         self.cost_moth = cost_moth
         self.plotter = plotter
         self.density_factor = density_factor
+        self.costs_ledger = costs_ledger
+        self.area_fraction = area_fraction
+        self.telemetry = telemetry
+        self.design_report = None
 
     #
     # cost function computation, given the output of the
     # 'world.run_world(total_time)' method (a dataframe
-    # with all the data)
+    # with all the data, or a lean 'SimulationLog')
     def cost(self, data_log):
-        moth_function = np.array(data_log[['moth-caterpillars']].values.reshape(len(data_log)), dtype=int)
+        moth_function = np.array(data_log['moth-caterpillars'], dtype=int)
         return ((self.world.n_flies * self.cost_fly) +
                 (self.cost_moth * integrate.simps(moth_function)))
 
-    def simple_cost(self, parent_dir, files, cost_steps=None):
+    #
+    # runs a single simulation of the world ('kwargs' go to 'world.run_world()').
+    #
+    # On the area downscaled mode, the predation only depends on the ratio
+    # between caterpillars and flies and all of the other laws act on each
+    # creature by itself, so a fraction of the area behaves (nearly) as the
+    # whole of it: the world runs with the initial populations times the area
+    # fraction (rounded at random, keeping their expected values) and the
+    # logged counts are divided by it. The world keeps the full area initial
+    # populations, so the costs are computed as usual.
+    def run_world(self, n_flies, n_moths, simul_time, **kwargs):
+        if self.area_fraction == 1.0:
+            return self.world.run_world(n_flies, n_moths, simul_time, **kwargs)
+
+        data_log = self.world.run_world(downscaled_count(n_flies, self.area_fraction),
+                                        downscaled_count(n_moths, self.area_fraction), simul_time, **kwargs)
+        self.world.n_flies = n_flies
+        self.world.n_moths = n_moths
+
+        # streamed logs are scaled on the file itself, a chunk at a time
+        if kwargs.get('stream_to') is not None:
+            data_log = open_streamed_log(kwargs['stream_to'], mode='r+')
+            chunk_size = kwargs.get('chunk_size', 4096)
+            for a in range(0, len(data_log), chunk_size):
+                data_log.values[a:a + chunk_size] /= self.area_fraction
+            data_log.values.flush()
+            return data_log
+
+        return data_log / self.area_fraction
+
+    #
+    # runs a single simulation one step at a time (see 'world.iter_steps()'),
+    # yielding the counts of each step (scaled back to the full area on the
+    # downscaled mode). The consumer may stop early, e.g., when a running cost
+    # already exceeds the best one found
+    def iter_steps(self, n_flies, n_moths, simul_time=None):
+        f = self.area_fraction
+        steps = (self.world.iter_steps(n_flies, n_moths, simul_time) if f == 1.0 else
+                 self.world.iter_steps(downscaled_count(n_flies, f), downscaled_count(n_moths, f), simul_time))
+        for record in steps:
+            record.scale = 1.0 / f
+            self.world.n_flies = n_flies
+            self.world.n_moths = n_moths
+            yield record
+
+    # warns if the downscaled initial populations are too small
+    def check_downscaled_counts(self, n_flies, n_moths, min_count=20):
+        small = [(name, n * self.area_fraction) for name, n in [('flies', n_flies), ('moths', n_moths)]
+                 if 0 < n * self.area_fraction < min_count]
+        if small:
+            warnings.warn('area fraction {} leaves only {} at the start of the simulations: small number '
+                          'effects (extinctions) may bias the costs'
+                          .format(self.area_fraction, ' and '.join('{:.1f} {}'.format(n, name) for name, n in small)),
+                          DownscalingWarning)
+        return not small
+
+    #
+    # compares the costs of full area and downscaled simulation batches of the
+    # given initial populations ('n_simuls' replicates each), with a Welch t
+    # test of the mean replicate costs (only the means are used by the bayes
+    # cost: the downscaled costs have a variance about 1 / area_fraction times
+    # larger, reported apart as 'variance_ratio') and a Fisher exact test of
+    # the extinction (of the moths) frequencies. Warns (DownscalingWarning) if
+    # any of the tests fails at the 'alpha' level or if the downscaled initial
+    # populations are too small.
+    #
+    # Returns a dictionary with the comparison ('safe' is False if it warned)
+    def check_downscaling(self, n_flies, n_moths, simul_time, n_simuls=30, area_fraction=None,
+                          alpha=0.01, min_count=20):
+        full_area_fraction = self.area_fraction
+        area_fraction = area_fraction or full_area_fraction
+        costs = {}
+        extinctions = {}
+        try:
+            for key, fraction in [('full', 1.0), ('downscaled', area_fraction)]:
+                self.area_fraction = fraction
+                costs[key] = np.zeros(n_simuls)
+                extinctions[key] = 0
+                for i in range(n_simuls):
+                    data_log = self.run_world(n_flies, n_moths, simul_time, lean=True)
+                    costs[key][i] = self.cost(data_log)
+                    extinctions[key] += data_log['moth-living'][-1] == 0
+            self.area_fraction = area_fraction
+            safe = self.check_downscaled_counts(n_flies, n_moths, min_count=min_count)
+        finally:
+            self.area_fraction = full_area_fraction
+
+        welch = stats.ttest_ind(costs['full'], costs['downscaled'], equal_var=False)
+        full_variance = np.var(costs['full'], ddof=1)
+        variance_ratio = np.var(costs['downscaled'], ddof=1) / full_variance if full_variance > 0 else np.nan
+        _, extinction_pvalue = stats.fisher_exact([[extinctions['full'], n_simuls - extinctions['full']],
+                                                   [extinctions['downscaled'], n_simuls - extinctions['downscaled']]])
+        if welch.pvalue < alpha:
+            warnings.warn('downscaled mean cost {:.4g} differs from the full area one {:.4g}, Welch t test '
+                          'p-value {:.3g}'.format(costs['downscaled'].mean(), costs['full'].mean(), welch.pvalue),
+                          DownscalingWarning)
+        if extinction_pvalue < alpha:
+            warnings.warn('moths go extinct on {}/{} downscaled simulations, against {}/{} on the full area'
+                          .format(extinctions['downscaled'], n_simuls, extinctions['full'], n_simuls),
+                          DownscalingWarning)
+
+        return {
+            'area_fraction': area_fraction,
+            'full_cost': costs['full'].mean(),
+            'downscaled_cost': costs['downscaled'].mean(),
+            't_statistic': welch.statistic,
+            't_pvalue': welch.pvalue,
+            'variance_ratio': variance_ratio,
+            'full_extinctions': extinctions['full'] / n_simuls,
+            'downscaled_extinctions': extinctions['downscaled'] / n_simuls,
+            'safe': safe and (welch.pvalue >= alpha) and (extinction_pvalue >= alpha)
+        }
+
+    def simple_cost(self, parent_dir, files, cost_steps=None, use_catalog=False, n_workers=None):
         """
         Evaluates the simple cost from all simulation files on a given directory. Optionally, a
         maximum step size can be defined.
+
+        If 'use_catalog' is set, the files are read through a 'ResultsCatalog' of the directory:
+        only new or modified files are parsed (in parallel, over 'n_workers' processes) and the
+        others are read from the catalog's binary cache.
         """
 
+        if use_catalog:
+            return self._catalog_simple_cost(ResultsCatalog(parent_dir, n_workers=n_workers), files, cost_steps)
+
         df = pd.read_csv(os.path.join(parent_dir, files[0]))
         if (cost_steps is None) or (cost_steps > len(df)):
             cost_steps = len(df)
@@ -69,6 +225,29 @@ class SimulationControl:
         costs_df = pd.DataFrame(data=costs_data, index=range(len(files)), columns=_COST_COLUMNS)
         return costs_df
 
+    # same as 'simple_cost()', reading the data from a results catalog
+    def _catalog_simple_cost(self, catalog, files, cost_steps=None):
+        catalog.refresh(files)
+
+        if (cost_steps is None) or (cost_steps > catalog.entry(files[0])['rows']):
+            cost_steps = catalog.entry(files[0])['rows']
+
+        costs_data = dict.fromkeys(_COST_COLUMNS, [])
+        for col in _COST_COLUMNS:
+            costs_data[col] = np.zeros(len(files))
+
+        for i, f in enumerate(files):
+            entry = catalog.entry(f)
+            columns = catalog.columns(f)
+            costs_data['#moths'][i] = entry['#moths']
+            costs_data['#flies'][i] = entry['#flies']
+            costs_data['#steps'][i] = cost_steps
+            costs_data['#simuls'][i] = 4
+            costs_data['cost'][i] = self.cost({'moth-caterpillars': columns['moth-caterpillars'][0:cost_steps]})
+
+        costs_df = pd.DataFrame(data=costs_data, index=range(len(files)), columns=_COST_COLUMNS)
+        return costs_df
+
     #
     # executes a batch of simulations given we already have
     # a functioning world.
@@ -86,22 +265,68 @@ class SimulationControl:
     # Checks the output_costs parameter to open/create a new costs csv
     # file and save the costs data on it, under the directory
     #       output_dir / output_costs_name_{simul_idx}.csv
+    # (the costs of an area downscaled control go to a file of their own,
+    # 'output_costs_name_area{area_fraction}.csv', or to the costs ledger
+    # under their area fraction: they are never mixed with the full area ones)
+    #
+    # If 'lean' is set, the replicates are run on the lean mode (see
+    # 'simul.log.SimulationLog') and the averaged log is returned as a
+    # 'SimulationLog' as well; dataframes are only built for the outputs
+    # that actually need them (csv files and plots)
+    #
+    # If 'stream' is set (for very long horizons), each replicate log is streamed
+    # to a binary file in chunks of 'chunk_size' steps (see 'simul.stream') and the
+    # running average is kept on a memory-mapped file as well,
+    #       output_dir / output_name_{simul_idx}.bin  (kept if output_csv is 'all')
+    #       output_dir / output_name_mean.bin
+    # so only a chunk of each log is in memory at any time. The returned average
+    # is a memory-mapped 'SimulationLog'. No images are plotted on this mode.
+    #
+    # If 'async_output' is set, the csv files are written on the background
+    # (see 'simul.writer.BackgroundWriter') while the next replicates run. It can
+    # also be a writer object, shared by several batches (to compress the logs,
+    # for instance). All of the files are complete when the method returns.
+    #
+    # If a cost index is given (see 'simul.costindex.CostIndex'), each replicate
+    # is added to it, so its costs can later be evaluated with other prices
+    # and horizons without running it again.
+    #
+    # If 'n_workers' is set, the replicates run on that many worker processes,
+    # which write their logs straight into a shared memory block (see
+    # 'simul.sharedlog'); the average (and the replicate costs and outputs) are
+    # then taken from the block, without sending the logs back. Not available
+    # with 'stream' (the block holds all of the replicates at once).
+    #
+    # If a replicate 'design' is given ('stratified' or 'antithetic', see
+    # 'simul.designs'), the initial ages of the replicates are correlated to
+    # lower the variance of the batch means (which stay unbiased). The variance
+    # reduction of the replicate costs is printed, reported to the telemetry
+    # and kept on 'design_report'. Not available with 'n_workers'.
     def simulation_batch(self, n_flies, n_moths, simul_time, n_simuls,
                          output_csv='none', output_costs='none',
-                         output_dir='outputs', output_name='simul'):
+                         output_dir='outputs', output_name='simul', lean=False,
+                         stream=False, chunk_size=4096, async_output=False, cost_index=None,
+                         n_workers=None, design=None, design_blocks=4):
+
+        if stream and (n_workers is not None):
+            raise ValueError('the shared memory transport (n_workers) is not available with stream')
+        if (design is not None) and (n_workers is not None):
+            raise ValueError('the replicate designs are not available with the shared memory transport (n_workers)')
 
         output_costs_name = output_name + '_cost'
         if output_costs == 'same_name':
             output_costs_name = 'simul_results_cost'
             output_costs = 'mean'
+        if self.area_fraction != 1.0:
+            output_costs_name += '_area{:g}'.format(self.area_fraction)
 
         # creates a directory with the given name if it doesn't already exists
-        if (output_csv != 'none') or (output_costs != 'none'):
+        if (output_csv != 'none') or (output_costs != 'none') or stream:
             if not os.path.exists(output_dir):
                 os.mkdir(output_dir)
 
-        # initializes the cost dataframe
-        if output_costs != 'none':
+        # initializes the cost dataframe (not needed when the costs go to the ledger)
+        if (output_costs != 'none') and (self.costs_ledger is None):
 
             # if there is a costs file saved under the same name, open and use it
             # (append the new results on it)
@@ -122,17 +347,89 @@ class SimulationControl:
             for col in _COST_COLUMNS:
                 costs_data[col] = [0]
 
+        if self.area_fraction != 1.0:
+            self.check_downscaled_counts(n_flies, n_moths)
+
+        writer = None
+        if isinstance(async_output, BackgroundWriter):
+            writer = async_output
+        elif async_output:
+            writer = BackgroundWriter()
+
         snp = max([1, int(np.ceil(np.log10(n_simuls + 1)))])
-        avg_simul_log = self.empty_data_log(simul_time + 1)
+        if stream:
+            avg_simul_log = create_streamed_log(os.path.join(output_dir, output_name + '_mean.bin'),
+                                                simul_time + 1, self.world.universe.df_columns)
+        elif lean:
+            avg_simul_log = SimulationLog.zeros(simul_time + 1, self.world.universe.df_columns)
+        else:
+            avg_simul_log = self.empty_data_log(simul_time + 1)
+        if self.telemetry is not None:
+            self.telemetry.batch_started(n_flies, n_moths, simul_time, n_simuls)
+
+        block = None
+        if n_workers is not None:
+            block = run_shared_replicates(self, n_flies, n_moths, simul_time, n_simuls,
+                                          n_workers=n_workers, telemetry=self.telemetry)
+            self.world.n_flies = n_flies
+            self.world.n_moths = n_moths
+
+        # uniform numbers of the initial ages of each replicate (for all of the
+        # creatures a downscaled world may have)
+        if design is not None:
+            uniforms = {creature_type: design_uniforms(design, n_simuls, int(np.ceil(n * self.area_fraction)) + 1,
+                                                       n_blocks=design_blocks)
+                        for creature_type, n in [(Moth, n_moths), (Fly, n_flies)]}
+            design_costs = []
+
         for i in range(n_simuls):
             print('      - simulation {}/{}'.format(i + 1, n_simuls))
+            start_time, start_cpu = time.time(), time.process_time()
+            if design is not None:
+                self.world.initial_age_uniforms = {creature_type: u[i] for creature_type, u in uniforms.items()}
+
+            if stream:
+                curr_path = os.path.join(output_dir, output_name + ('_{0:0{1}}.bin'.format(i, snp)))
+                curr_df = self.run_world(n_flies, n_moths, simul_time,
+                                         stream_to=curr_path, chunk_size=chunk_size)
+                self.world.initial_age_uniforms = {Moth: None, Fly: None}
+                if design is not None:
+                    design_costs.append(self.cost(curr_df))
+                if output_costs == 'all':
+                    costs_data['#moths'][i] = self.world.n_moths
+                    costs_data['#flies'][i] = self.world.n_flies
+                    costs_data['#steps'][i] = simul_time
+                    costs_data['#simuls'][i] = 1
+                    costs_data['cost'][i] = self.cost(curr_df)
+
+                # running sum, one chunk at a time
+                for a in range(0, simul_time + 1, chunk_size):
+                    avg_simul_log.values[a:a + chunk_size] += curr_df.values[a:a + chunk_size]
+                if cost_index is not None:
+                    cost_index.add(n_flies, n_moths, curr_df)
+                self.report_replicate(curr_df, start_time, start_cpu)
+                del curr_df
+                if output_csv != 'all':
+                    os.remove(curr_path)
+                    os.remove(curr_path + '.json')
+                continue
+
             # current simulation dataframe results
-            curr_df = self.world.run_world(n_flies, n_moths, simul_time)
+            if block is not None:
+                curr_df = block.replicate(i) if lean else block.replicate(i).to_dataframe()
+            else:
+                curr_df = self.run_world(n_flies, n_moths, simul_time, lean=lean)
+                self.world.initial_age_uniforms = {Moth: None, Fly: None}
+            if design is not None:
+                design_costs.append(self.cost(curr_df))
 
             # if output saving mode is set to 'all', save these results
             if output_csv == 'all':
-                curr_df.to_csv(os.path.join(output_dir,
-                                            output_name + ('_{0:0{1}}.csv'.format(i, snp))))
+                curr_path = os.path.join(output_dir, output_name + ('_{0:0{1}}.csv'.format(i, snp)))
+                if writer is not None:
+                    writer.to_csv(curr_df, curr_path)
+                else:
+                    curr_df.to_csv(curr_path)
 
             if output_costs == 'all':
                 costs_data['#moths'][i] = self.world.n_moths
@@ -141,15 +438,36 @@ class SimulationControl:
                 costs_data['#simuls'][i] = 1
                 costs_data['cost'][i] = self.cost(curr_df)
 
-            avg_simul_log = avg_simul_log + curr_df
+            # (the shared block is averaged at once, in place, at the end)
+            if (block is None) or (self.plotter is not None):
+                avg_simul_log = avg_simul_log + curr_df
+            if cost_index is not None:
+                cost_index.add(n_flies, n_moths, curr_df)
 
             if self.plotter is not None:
-                self.plotter.save_image(avg_simul_log / (i + 1), idx=i)
-
-        avg_simul_log = avg_simul_log / n_simuls
-
-        if output_csv != 'none':
-            avg_simul_log.to_csv(os.path.join(output_dir, output_name + '_mean.csv'))
+                curr_avg = avg_simul_log / (i + 1)
+                self.plotter.save_image(curr_avg.to_dataframe() if lean else curr_avg, idx=i)
+
+            if block is None:
+                self.report_replicate(curr_df, start_time, start_cpu)
+
+        if stream:
+            for a in range(0, simul_time + 1, chunk_size):
+                avg_simul_log.values[a:a + chunk_size] /= n_simuls
+            avg_simul_log.values.flush()
+        elif block is not None:
+            avg_simul_log = block.mean() if lean else block.mean().to_dataframe()
+            if writer is not None:
+                writer.flush()
+            block.close()
+        else:
+            avg_simul_log = avg_simul_log / n_simuls
+
+        if (output_csv != 'none') and not stream:
+            if writer is not None:
+                writer.to_csv(avg_simul_log, os.path.join(output_dir, output_name + '_mean.csv'))
+            else:
+                avg_simul_log.to_csv(os.path.join(output_dir, output_name + '_mean.csv'))
 
         if output_costs != 'none':
             costs_data['#moths'][-1] = self.world.n_moths
@@ -157,14 +475,46 @@ class SimulationControl:
             costs_data['#steps'][-1] = simul_time
             costs_data['#simuls'][-1] = n_simuls
             costs_data['cost'][-1] = self.cost(avg_simul_log)
+
+        if (output_costs != 'none') and (self.costs_ledger is not None):
+            self.costs_ledger.append(costs_data, universe=self.world.universe.fingerprint(),
+                                     area_fraction=self.area_fraction)
+
+        elif output_costs != 'none':
             costs_df = costs_df.append(pd.DataFrame(data=costs_data,
                                                     index=range(costs_idx_offset,
                                                                 costs_idx_offset + len(costs_data['#moths'])),
                                                     columns=_COST_COLUMNS))
-            costs_df.to_csv(os.path.join(output_dir, output_costs_name + '.csv'))
+            if writer is not None:
+                writer.to_csv(costs_df, os.path.join(output_dir, output_costs_name + '.csv'), compress=False)
+            else:
+                costs_df.to_csv(os.path.join(output_dir, output_costs_name + '.csv'))
+
+        # barrier: waits for the background writes of the batch
+        if writer is async_output:
+            writer.flush()
+        elif writer is not None:
+            writer.close()
+
+        if design is not None:
+            self.design_report = design_report(design, design_costs, n_blocks=design_blocks)
+            print('      - {} design: cost {:.4g} +- {:.3g} (independent replicates: +- {:.3g}), variance reduction '
+                  '{:.2f}x'.format(design, self.design_report['mean'], self.design_report['std_error'],
+                                   self.design_report['iid_std_error'], self.design_report['variance_reduction']))
+            if self.telemetry is not None:
+                self.telemetry.emit('design', **self.design_report)
+
+        if self.telemetry is not None:
+            self.telemetry.batch_done(cost=self.cost(avg_simul_log))
 
         return avg_simul_log
 
+    # reports a finished replicate (started at the given wall and cpu times) to the telemetry
+    def report_replicate(self, data_log, start_time, start_cpu):
+        if self.telemetry is not None:
+            self.telemetry.replicate_done(time.time() - start_time, time.process_time() - start_cpu,
+                                          creature_days(data_log) * self.area_fraction)
+
     #
     # Initializes an empty dataframe with the length of the simulation time
     # and with a number of columns equal to the number of saved parameters
@@ -176,11 +526,13 @@ class SimulationControl:
                             columns=self.world.universe.df_columns)
 
     # runs simulation batches with the initial #moths and #flies defined on a
-    # dataframe passed as argument
+    # dataframe passed as argument. With 'async_output' set, a single background
+    # writer (see 'simulation_batch()') is used by all of the batches
     def run_some_batches(self, initial_populations, simul_time, n_simuls,
                          lines=None,
                          output_csv='none', output_costs='none',
-                         output_dir='outputs', output_name='simul'
+                         output_dir='outputs', output_name='simul',
+                         lean=False, async_output=False
                          ):
 
         # limits the dataframe of simulations to be executed based
@@ -189,31 +541,86 @@ class SimulationControl:
             lines[1] = min([len(initial_populations), lines[1]])
             initial_populations = initial_populations.iloc[lines[0]:lines[1]]
 
+        if self.telemetry is not None:
+            self.telemetry.sweep_started(len(initial_populations))
+
+        writer = async_output
+        if async_output and not isinstance(async_output, BackgroundWriter):
+            writer = BackgroundWriter()
+
         for j, initial_pop in initial_populations.iterrows():
             print('{}/{} - running batch for #flies={}, #moths={}'.format(j+1, lines[1], initial_pop['#flies'], initial_pop['#moths']))
             self.simulation_batch(initial_pop['#flies'], initial_pop['#moths'], simul_time,  n_simuls,
                                   output_csv=output_csv, output_costs='same_name',
                                   output_dir=output_dir,
-                                  output_name=output_name+'{}-{}'.format(initial_pop['#flies'], initial_pop['#moths']))
+                                  output_name=output_name+'{}-{}'.format(initial_pop['#flies'], initial_pop['#moths']),
+                                  lean=lean, async_output=writer)
+
+        if writer is not async_output:
+            writer.close()
+
+        if self.telemetry is not None:
+            self.telemetry.sweep_done()
+
+    #
+    # builds a lookup table {(#moths, #flies): cost} for the given moth densities
+    # and list of #flies, from a costs dataframe or from a costs ledger, with
+    # the costs of the simulations of 'n_steps' steps. With a ledger the
+    # lookups are keyed (and 'n_steps' is required) and only the costs of the
+    # control's area fraction are used; a dataframe is scanned only once (and,
+    # as before, the last row for each pair of populations is the one used;
+    # without 'n_steps', of any number of steps). A dataframe doesn't tell the
+    # area fraction of its costs, so it is only taken as full area costs
+    def costs_table(self, p_data, n_flies_list, costs, n_steps=None):
+        pairs = [(int(dens_moths * self.density_factor), int(n_flies))
+                 for dens_moths in p_data['p'].values
+                 for n_flies in n_flies_list]
+
+        if costs is None:
+            raise ValueError('no costs given and the simulation control has no costs ledger')
+        if isinstance(costs, CostsLedger):
+            if n_steps is None:
+                raise ValueError('the number of steps of the simulations is required on the costs ledger lookups')
+            return costs.costs(pairs, n_steps, universe=self.world.universe.fingerprint(),
+                               area_fraction=self.area_fraction)
+        self.check_full_area_costs()
+
+        if n_steps is not None:
+            costs = costs[costs['#steps'] == n_steps]
+        table = {(int(m), int(f)): c for m, f, c in zip(costs['#moths'].values,
+                                                         costs['#flies'].values,
+                                                         costs['cost'].values)}
+        return {pair: table[pair] for pair in pairs if pair in table}
+
+    # the costs dataframes (and csv files) hold full area costs only
+    def check_full_area_costs(self):
+        if self.area_fraction != 1.0:
+            raise ValueError('the costs of an area downscaled control (area fraction {}) are only kept on a costs '
+                             'ledger: a costs dataframe holds full area costs'.format(self.area_fraction))
 
     #
     # A : sample area (float)
     # sample_n_moths : number of moths in sampled area (integer)
     # w_list : list with values for which we want to evaluate the bayes cost
     # p_data : dataframe with initial moth density, probability ('p', 'P(p)')
-    # costs  : dataframe with simple cost data
+    # costs  : dataframe with simple cost data, or a costs ledger (if None,
+    #          the control's own ledger is used)
+    # n_steps : number of steps of the simulations of the costs (see 'costs_table()')
     #
     # returns : success (bool), dataframe with columns
     #           ('n_flies', 'moth_density', 'sample_n_moth', 'sample_area', 'bayes_cost')
-    def bayes_cost_function(self, p_data, sample_n_moths, sample_area, n_flies_list, costs):
+    def bayes_cost_function(self, p_data, sample_n_moths, sample_area, n_flies_list, costs=None, n_steps=None):
+
+        if costs is None:
+            costs = self.costs_ledger
+        costs_table = self.costs_table(p_data, n_flies_list, costs, n_steps=n_steps)
 
         # check if the costs dataframe has at least 1 row for all of
         # the required costs
         missing_simulation_values = {'#moths': [], '#flies': []}
         for dens_moths in p_data['p'].values:
             for n_flies in n_flies_list:
-                if not len(costs[(costs['#moths'] == int(dens_moths * self.density_factor)) &
-                                 (costs['#flies'] == n_flies)]):
+                if (int(dens_moths * self.density_factor), int(n_flies)) not in costs_table:
                     missing_simulation_values['#moths'].append(int(dens_moths * self.density_factor))
                     missing_simulation_values['#flies'].append(int(n_flies))
 
@@ -240,7 +647,96 @@ class SimulationControl:
             bayes_cost_data['bayes_cost'][idx] = bayes_cost(p_data['p'].values, p_data['P(p)'].values,
                                                             sample_n_moths, sample_area, n_flies,
                                                             density_factor=self.density_factor,
-                                                            costs=costs[costs['#flies'] == n_flies][
-                                                                ['#moths', '#flies', 'cost']])
+                                                            costs=costs_table)
 
         return success, pd.DataFrame(data=bayes_cost_data, index=range(len(n_flies_list)), columns=_BAYES_COST_COLUMNS)
+
+    #
+    # returns the (deduplicated) dataframe of initial populations ('#flies',
+    # '#moths') that are needed by the bayes cost of the given moth densities
+    # and list of #flies, but that are missing on the costs (of simulations
+    # of 'n_steps' steps, see 'costs_table()')
+    def missing_simulations(self, p_data, n_flies_list, costs=None, n_steps=None):
+        if costs is None:
+            costs = self.costs_ledger
+        costs_table = self.costs_table(p_data, n_flies_list, costs, n_steps=n_steps)
+
+        missing = []
+        for dens_moths in p_data['p'].values:
+            for n_flies in n_flies_list:
+                pair = (int(dens_moths * self.density_factor), int(n_flies))
+                if (pair not in costs_table) and (pair not in missing):
+                    missing.append(pair)
+
+        return pd.DataFrame(data={'#flies': [f for _, f in missing], '#moths': [m for m, _ in missing]},
+                            index=range(len(missing)), columns=['#flies', '#moths'])
+
+    #
+    # runs the simulation batches of the given initial populations (dataframe
+    # with '#flies' and '#moths' columns) on a pool of 'n_workers' processes
+    # and records their costs: on the costs ledger (appended by the workers
+    # themselves) or, for a costs dataframe, as new rows of it (in place).
+    #
+    # Returns the dataframe with the new cost rows
+    def fill_missing_simulations(self, missing, simul_time, n_simuls, costs=None, n_workers=None):
+        if costs is None:
+            costs = self.costs_ledger
+
+        if not isinstance(costs, CostsLedger):
+            self.check_full_area_costs()
+        control = light_control(self)
+        control.costs_ledger = costs if isinstance(costs, CostsLedger) else None
+
+        seeds = job_seeds(len(missing))
+        rows = run_jobs(batch_cost_job,
+                        [(control, int(n_flies), int(n_moths), simul_time, n_simuls, seed)
+                         for n_flies, n_moths, seed in zip(missing['#flies'].values, missing['#moths'].values, seeds)],
+                        n_workers=n_workers, telemetry=self.telemetry)
+        new_costs = pd.DataFrame(data=rows, index=range(len(rows)), columns=_COST_COLUMNS)
+
+        if (costs is not None) and not isinstance(costs, CostsLedger):
+            for _, row in new_costs.iterrows():
+                costs.loc[(costs.index.max() + 1) if len(costs) else 0] = row[costs.columns].values
+
+        return new_costs
+
+    #
+    # bayes cost for several samples at once. 'samples' is a dataframe with the
+    # sampled number of moths and sample areas on the columns 'n' and 'A' (as
+    # the 'AmostragemBrocas.csv' data file); repeated samples are computed once.
+    #
+    # Only the costs of simulations of 'simul_time' steps are used. If
+    # 'auto_fill' is set, the simulations missing on the costs are planned
+    # (the minimal set of initial populations needed by all the samples), run
+    # in parallel over 'n_workers' processes and recorded before the bayes
+    # costs are computed. Otherwise this works as 'bayes_cost_function()': if
+    # there are missing simulations they are returned instead of the costs.
+    #
+    # returns : success (bool), dataframe with the '_BAYES_COST_COLUMNS'
+    #           (or with the missing initial populations)
+    def bayes_cost_query(self, p_data, samples, n_flies_list, costs=None, auto_fill=False,
+                         simul_time=200, n_simuls=50, n_workers=None):
+        if costs is None:
+            costs = self.costs_ledger
+
+        missing = self.missing_simulations(p_data, n_flies_list, costs, n_steps=simul_time)
+        if len(missing):
+            if not auto_fill:
+                return False, missing
+            print('running {} missing simulation batches'.format(len(missing)))
+            self.fill_missing_simulations(missing, simul_time, n_simuls, costs=costs, n_workers=n_workers)
+
+        bayes_costs = []
+        for _, sample in samples[['n', 'A']].drop_duplicates().iterrows():
+            _, cost = self.bayes_cost_function(p_data, int(sample['n']), sample['A'], n_flies_list, costs,
+                                               n_steps=simul_time)
+            bayes_costs.append(cost)
+
+        return True, pd.concat(bayes_costs, ignore_index=True)
+
+
+#
+# count of creatures on a fraction of the area: rounded up or down at random,
+# so that its expected value is exactly 'n * area_fraction'
+def downscaled_count(n, area_fraction):
+    return int(np.floor(n * area_fraction + np.random.uniform()))
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+#
+# Cost re-evaluation index. The cost of a simulation is
+#    n_flies * cost_fly + cost_moth * simps(caterpillars[0:steps])
+# so, once the caterpillars integral of every horizon (number of steps) is
+# known, the cost of any (cost_fly, cost_moth, steps) scenario is a couple of
+# multiplications. The index keeps, for each replicate, its initial #flies and
+# #moths and the integrals of all of its prefixes (computed in a single pass,
+# with the same rule as 'scipy.integrate.simps'), so the costs can be
+# repriced, or evaluated on another horizon, without reading or running the
+# simulations again, and whole price tables are computed at once.
+
+import numpy as np
+import pandas as pd
+import scipy.integrate as integrate
+
+_PRICE_COLUMNS = ['#flies', '#moths', '#steps', 'cost_fly', 'cost_moth', 'cost']
+
+# rule used by 'simps' on an even number of points: older versions of scipy
+# average the two simpson + trapezoid combinations, newer ones correct the
+# last interval (Cartwright)
+_EVEN_RULE = 'avg' if abs(integrate.simps(np.array([0.0, 0.0, 1.0, 0.0])) - 13 / 12) < 1e-9 else 'simpson'
+
+
+#
+# returns the array with simps(y[0:n]) on position n - 1, for every n
+def prefix_integrals(y):
+    y = np.asarray(y, dtype=float)
+    n_points = len(y)
+    integrals = np.zeros(n_points)
+    if n_points < 2:
+        return integrals
+    integrals[1] = 0.5 * (y[0] + y[1])
+
+    # odd number of points (2k + 1): simpson panels starting at 0
+    panels = (y[0:-2:2] + 4 * y[1:-1:2] + y[2::2]) / 3
+    first = np.cumsum(panels)
+    integrals[2::2] = first
+
+    # even number of points (2k + 2, k >= 1)
+    k = np.arange(1, (n_points - 2) // 2 + 1)
+    if len(k) == 0:
+        return integrals
+    if _EVEN_RULE == 'simpson':
+        integrals[2 * k + 1] = (first[k - 1] + 5 / 12 * y[2 * k + 1] + 2 / 3 * y[2 * k] - 1 / 12 * y[2 * k - 1])
+    else:
+        shifted = np.cumsum((y[1:-2:2] + 4 * y[2:-1:2] + y[3::2]) / 3)
+        integrals[2 * k + 1] = 0.5 * (first[k - 1] + 0.5 * (y[2 * k] + y[2 * k + 1]) +
+                                      0.5 * (y[0] + y[1]) + shifted[k - 1])
+    return integrals
+
+
+class CostIndex:
+
+    def __init__(self):
+        self.n_flies = []
+        self.n_moths = []
+        self.rows = []
+        self.prefixes = []
+        self.integrals = None
+
+    def __len__(self):
+        return len(self.n_flies)
+
+    #
+    # adds a replicate, from its log (dataframe, 'SimulationLog' or anything
+    # with a 'moth-caterpillars' column). The caterpillars are truncated to
+    # integers, as on 'SimulationControl.cost()'
+    def add(self, n_flies, n_moths, data_log):
+        caterpillars = np.array(data_log['moth-caterpillars'], dtype=int)
+        self.n_flies.append(n_flies)
+        self.n_moths.append(n_moths)
+        self.rows.append(len(caterpillars))
+        self.prefixes.append(prefix_integrals(caterpillars))
+        self.integrals = None
+
+    #
+    # builds the index of the csv files of a results catalog (see
+    # 'simul.catalog.ResultsCatalog'), only reading their cached columns
+    @classmethod
+    def from_catalog(cls, catalog, files=None):
+        catalog.refresh(files)
+        index = cls()
+        for f in (files if files is not None else sorted(catalog.index)):
+            entry = catalog.entry(f)
+            index.add(entry['#flies'], entry['#moths'], catalog.columns(f))
+        return index
+
+    # (replicates, max rows) array with the integrals, padded with the last one
+    def table(self):
+        if self.integrals is None:
+            n_rows = max(self.rows) if self.rows else 0
+            self.integrals = np.array([np.pad(prefix, (0, n_rows - len(prefix)), mode='edge')
+                                       if len(prefix) else np.zeros(n_rows) for prefix in self.prefixes])
+        return self.integrals
+
+    def save(self, path):
+        np.savez(path, n_flies=np.array(self.n_flies, dtype=float), n_moths=np.array(self.n_moths, dtype=float),
+                 rows=np.array(self.rows, dtype=int), integrals=self.table())
+
+    @classmethod
+    def load(cls, path):
+        index = cls()
+        with np.load(path) as data:
+            index.n_flies = data['n_flies'].tolist()
+            index.n_moths = data['n_moths'].tolist()
+            index.rows = data['rows'].tolist()
+            index.integrals = data['integrals']
+        index.prefixes = [index.integrals[i, 0:rows] for i, rows in enumerate(index.rows)]
+        return index
+
+    #
+    # integrals of each replicate up to 'steps' rows (all of them if None or
+    # if the replicate is shorter, as on 'simple_cost()')
+    def integral(self, steps=None):
+        table = self.table()
+        if steps is None:
+            return table[np.arange(len(self)), np.array(self.rows) - 1]
+        return table[np.arange(len(self)), np.minimum(steps, self.rows) - 1]
+
+    # cost of a single replicate (constant time)
+    def cost(self, i, cost_fly, cost_moth, steps=None):
+        rows = self.rows[i] if steps is None else min([steps, self.rows[i]])
+        return self.n_flies[i] * cost_fly + cost_moth * self.prefixes[i][rows - 1]
+
+    # costs of all the replicates
+    def costs(self, cost_fly, cost_moth, steps=None):
+        return np.array(self.n_flies) * cost_fly + cost_moth * self.integral(steps)
+
+    #
+    # price sensitivity table: the cost of every replicate for every combination
+    # of the given fly prices, moth prices and horizons (steps), computed at
+    # once. Returns a dataframe with the '_PRICE_COLUMNS'
+    def price_table(self, cost_fly_list, cost_moth_list, steps_list=None):
+        steps_list = [None] if steps_list is None else list(steps_list)
+        cost_fly, cost_moth, steps_idx = [a.ravel() for a in np.meshgrid(cost_fly_list, cost_moth_list,
+                                                                          range(len(steps_list)), indexing='ij')]
+        integrals = np.array([self.integral(steps) for steps in steps_list])
+        rows = np.array([[min([steps, rows]) if steps is not None else rows for rows in self.rows]
+                         for steps in steps_list])
+
+        costs = cost_fly[:, None] * np.array(self.n_flies)[None, :] + cost_moth[:, None] * integrals[steps_idx]
+        n_scenarios = len(cost_fly)
+        return pd.DataFrame(data={
+            '#flies': np.tile(self.n_flies, n_scenarios),
+            '#moths': np.tile(self.n_moths, n_scenarios),
+            '#steps': rows[steps_idx].ravel(),
+            'cost_fly': np.repeat(cost_fly, len(self)),
+            'cost_moth': np.repeat(cost_moth, len(self)),
+            'cost': costs.ravel()
+        }, columns=_PRICE_COLUMNS)
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+#
+# Replicate designs of the simulation batches. The initial ages of the
+# creatures are uniform on the universe's limits, drawn independently on each
+# replicate, and they drive most of the variance of the early counts (and of
+# the costs). A design gives, for each replicate, the uniform numbers of the
+# initial ages of its creatures (see 'WonderfulWorld.initial_age()'):
+#    > 'stratified' : latin hypercube across the replicates. For each creature,
+#                     the replicates of a block get one uniform number from
+#                     each one of the intervals [k/m, (k+1)/m) (m replicates on
+#                     the block), in a random order, so all of the age ranges
+#                     are covered on every block
+#    > 'antithetic' : the replicates come in pairs, with the uniform numbers
+#                     u and 1 - u (young creatures on one replicate, old on the
+#                     other one)
+# On both, each replicate alone has the same distribution as an independent
+# one, so the batch means stay unbiased; only the correlations between the
+# replicates change.
+#
+# The variance of the mean of a design is estimated from its independent
+# units (the blocks of the stratified design, the pairs of the antithetic one)
+# and compared to the one of independent replicates, which gives the variance
+# reduction and the number of independent replicates it is worth.
+
+import numpy as np
+
+DESIGNS = ['stratified', 'antithetic']
+
+
+#
+# uniform numbers of a stratified design: array (n_replicates, n), with
+# 'n_blocks' independent latin hypercubes of (nearly) equal size
+def stratified_uniforms(n_replicates, n, n_blocks=1):
+    uniforms = np.empty([n_replicates, n])
+    for rows in np.array_split(np.arange(n_replicates), n_blocks):
+        m = len(rows)
+        strata = np.argsort(np.random.uniform(size=(m, n)), axis=0)
+        uniforms[rows] = (strata + np.random.uniform(size=(m, n))) / m
+    return uniforms
+
+
+#
+# uniform numbers of an antithetic design: array (n_replicates, n), with the
+# odd rows mirroring the even ones (the last one is independent, if the number
+# of replicates is odd)
+def antithetic_uniforms(n_replicates, n):
+    uniforms = np.random.uniform(size=(n_replicates, n))
+    n_pairs = n_replicates // 2
+    uniforms[1:2 * n_pairs:2] = 1 - uniforms[0:2 * n_pairs:2]
+    return uniforms
+
+
+def design_uniforms(design, n_replicates, n, n_blocks=4):
+    if design == 'stratified':
+        return stratified_uniforms(n_replicates, n, n_blocks=min([n_blocks, n_replicates]))
+    if design == 'antithetic':
+        return antithetic_uniforms(n_replicates, n)
+    raise ValueError("unknown replicate design '{}' (expected one of {})".format(design, DESIGNS))
+
+
+#
+# variance reduction report of a design, from the values (the costs, usually)
+# of its replicates, on their order. Returns a dictionary with the mean, its
+# standard error on the design and with independent replicates, the variance
+# reduction factor (iid variance / design variance) and the number of
+# independent replicates the design is worth
+def design_report(design, values, n_blocks=4):
+    values = np.asarray(values, dtype=float)
+    n = len(values)
+    iid_variance = np.var(values, ddof=1) / n if n > 1 else np.nan
+
+    if design == 'stratified':
+        blocks = [values[rows] for rows in np.array_split(np.arange(n), min([n_blocks, n]))]
+        means = np.array([np.mean(block) for block in blocks])
+        weights = np.array([len(block) for block in blocks]) / n
+        variance = np.sum(weights ** 2) * np.var(means, ddof=1) if len(blocks) > 1 else np.nan
+    else:
+        n_pairs = n // 2
+        pairs = values[0:2 * n_pairs].reshape(n_pairs, 2).mean(axis=1)
+        variance = (4 * n_pairs * np.var(pairs, ddof=1) + (n % 2) * np.var(values, ddof=1)) / n ** 2 \
+            if n_pairs > 1 else np.nan
+
+    reduction = iid_variance / variance if variance > 0 else np.nan
+    return {
+        'design': design,
+        'replicates': n,
+        'mean': float(np.mean(values)),
+        'std_error': float(np.sqrt(variance)),
+        'iid_std_error': float(np.sqrt(iid_variance)),
+        'variance_reduction': float(reduction),
+        'equivalent_replicates': float(n * reduction)
+    }
@@ -0,0 +1,302 @@
+# -*- coding: utf-8 -*-
+#
+# Event-driven world. Everything that will happen to a creature, except being
+# eaten, is known when it is born:
+#    > its old age death day (the lifespan is drawn at birth)
+#    > its random death day (each day it dies with the universe's random death
+#      chance, so the number of days it survives is geometric)
+#    > the days it becomes (and stops being) a caterpillar and an adult, that
+#      depend only on its age
+# so the 'EventWorld' draws them at birth and puts the creature on a calendar
+# (a dictionary day: list of events). Each step only processes the creatures
+# with events on that day, and the logged counts (living, males, adults,
+# caterpillars, ...) are kept up to date incrementally, instead of visiting
+# every living creature every day.
+#
+# The days are processed in the same order as on 'WonderfulWorld.single_step()':
+# first the flies (deaths and predations, that see the caterpillars of the day
+# before), then the moths (deaths, births and age transitions). The results
+# have the same distribution as the ones of 'WonderfulWorld' (though not the
+# same random numbers), and the worlds are interchangeable on the simulation
+# control.
+
+import numpy as np
+from collections import defaultdict
+
+from simul.creatures import Moth
+from simul.creatures import Fly
+from simul.world import WonderfulWorld
+
+
+#
+# creatures of a type, kept as lists indexed by creature id (ids are never
+# reused during a simulation)
+class _Population:
+
+    def __init__(self):
+        self.male = []
+        self.fertile = []
+        self.alive = []
+        self.adult = []
+        self.random_death = []
+        self.lifespan = []
+        self.birth = []
+        self.calendar = defaultdict(list)
+
+        self.n_alive = 0
+        self.n_male = 0
+        self.n_adults = 0
+
+
+class EventWorld(WonderfulWorld):
+
+    def __init__(self, universe, fil=None, mil=None):
+        super().__init__(universe, fil=fil, mil=mil)
+        self.end_of_times = 0
+        self.populations = {Moth: _Population(), Fly: _Population()}
+
+        # caterpillars (moth ids), with the position of each one on the list,
+        # so any of them can be removed in constant time (swapped with the last)
+        self.caterpillars = []
+        self.caterpillar_position = {}
+
+    def initialize_world(self, n_steps, log_writer=None, chunk_size=None, rolling=False):
+        self.instant = 0
+        self.log_idx = 0
+        self.log_offset = 0
+        self.log_writer = log_writer
+        self.log_rolling = rolling
+        self.end_of_times = n_steps
+
+        self.populations = {Moth: _Population(), Fly: _Population()}
+        self.caterpillars = []
+        self.caterpillar_position = {}
+
+        self.reset_iteration_log(n_steps if (log_writer is None) and not rolling else min([n_steps, chunk_size - 1]))
+
+        # initial ages as on the 'WonderfulWorld' (uniform, or given by a
+        # replicate design, or, if an initial lifespan is given, from the
+        # lifespan), or the initial creatures given (see 'initial_creatures')
+        for creature_type, n in [(Moth, self.n_moths), (Fly, self.n_flies)]:
+            features = self.initial_creatures[creature_type]
+            if features is not None:
+                self.add(creature_type, features[:, 0] == 1, features[:, 1] == 1, features[:, 2], features[:, 3])
+                continue
+            ages = self.initial_ages(creature_type, n)
+            self.create(creature_type, n, ages, self.initial_lifespan[creature_type])
+
+        self.initialize_log()
+
+    #
+    # creates 'n' creatures of a type, with the given ages, to be processed from
+    # the next day on: draws their features and puts their events on the calendar
+    def create(self, creature_type, n, ages, initial_lifespan=None):
+        if n == 0:
+            return
+        universe = self.universe
+        population = self.populations[creature_type]
+
+        male = np.random.uniform(size=n) < universe.mf_ratio[creature_type]
+        fertile = np.random.uniform(size=n) < universe.fertility_ratio[creature_type]
+        lifespan = np.maximum(1, np.round(np.random.normal(loc=universe.lifespan_mean[creature_type],
+                                                           scale=universe.lifespan_var[creature_type],
+                                                           size=n)).astype(int))
+        if initial_lifespan is not None:
+            ages = lifespan - initial_lifespan
+        self.add(creature_type, male, fertile, lifespan, ages)
+
+    #
+    # adds creatures of a type with the given features (arrays), to be
+    # processed from the next day on: draws their random death days and puts
+    # their events on the calendar
+    def add(self, creature_type, male, fertile, lifespan, ages):
+        n = len(male)
+        if n == 0:
+            return
+        universe = self.universe
+        population = self.populations[creature_type]
+
+        # days lived before dying: of old age when its age gets over the lifespan,
+        # randomly after a geometric number of survived days (if it comes first)
+        old_age_days = np.maximum(0, lifespan - ages + 1)
+        if universe.random_death_chance[creature_type] > 0:
+            random_days = np.random.geometric(universe.random_death_chance[creature_type], size=n) - 1
+        else:
+            random_days = np.full(n, np.iinfo(int).max)
+        random_death = random_days <= old_age_days
+        death_day = self.instant + 1 + np.minimum(random_days, old_age_days)
+
+        # age transitions: days at the end of which the age reaches a threshold
+        # (the creature has age 'age + k + 1' at the end of its k-th day)
+        adult_age = universe.adult_age[creature_type]
+        egg_age = universe.egg_age[creature_type]
+        adult_day = self.instant + adult_age - ages
+        caterpillar_day = self.instant + egg_age + 1 - ages
+
+        first_id = len(population.alive)
+        population.male += male.tolist()
+        population.fertile += fertile.tolist()
+        population.alive += [True] * n
+        population.adult += (ages >= adult_age).tolist()
+        population.random_death += random_death.tolist()
+        population.lifespan += lifespan.tolist()
+        population.birth += (self.instant - ages).tolist()
+        population.n_alive += n
+        population.n_male += int(male.sum())
+        population.n_adults += int((ages >= adult_age).sum())
+
+        calendar = population.calendar
+        end_of_times = self.end_of_times
+        for i, (age, death, adult, caterpillar) in enumerate(zip(ages.tolist(), death_day.tolist(),
+                                                                 adult_day.tolist(), caterpillar_day.tolist())):
+            creature_id = first_id + i
+            if death <= end_of_times:
+                calendar[death].append(('death', creature_id))
+            if age < adult_age and adult < death and adult <= end_of_times:
+                calendar[adult].append(('adult', creature_id))
+
+            # only the moths have caterpillars (ages strictly between the egg
+            # and the adult ages). They stop being caterpillars when they
+            # become adults
+            if creature_type is Moth:
+                if egg_age < age < adult_age:
+                    self.add_caterpillar(creature_id)
+                elif age <= egg_age < adult_age - 1 and caterpillar < death and caterpillar <= end_of_times:
+                    calendar[caterpillar].append(('caterpillar', creature_id))
+
+    def add_caterpillar(self, moth_id):
+        self.caterpillar_position[moth_id] = len(self.caterpillars)
+        self.caterpillars.append(moth_id)
+
+    def remove_caterpillar(self, moth_id):
+        position = self.caterpillar_position.pop(moth_id, None)
+        if position is None:
+            return
+        last = self.caterpillars.pop()
+        if last != moth_id:
+            self.caterpillars[position] = last
+            self.caterpillar_position[last] = position
+
+    #
+    # kills a creature: updates the aggregated counts (the calendar is left as
+    # it is, events of dead creatures are skipped when their days come)
+    def kill_creature(self, creature_type, creature_id):
+        population = self.populations[creature_type]
+        population.alive[creature_id] = False
+        population.n_alive -= 1
+        population.n_male -= population.male[creature_id]
+        population.n_adults -= population.adult[creature_id]
+        if creature_type is Moth:
+            self.remove_caterpillar(creature_id)
+
+    # number of children of a parent, as on 'Creature.children()'
+    def n_children(self, creature_type):
+        return max([0, int(np.round(np.random.normal(loc=self.universe.offspring_mean[creature_type],
+                                                     scale=self.universe.offspring_var[creature_type])))])
+
+    #
+    # processes the deaths of a type of creature on the current day. Returns
+    # the number of (males, females) that died and the number of children born
+    def process_deaths(self, creature_type, events):
+        population = self.populations[creature_type]
+        data = self.iteration_data[creature_type]
+        n_alive = population.n_alive
+        dead_males = dead_females = newborn = 0
+
+        for event, creature_id in events:
+            if event != 'death' or not population.alive[creature_id]:
+                continue
+            self.kill_creature(creature_type, creature_id)
+            if population.male[creature_id]:
+                dead_males += 1
+            else:
+                dead_females += 1
+
+            if population.random_death[creature_id]:
+                data['randomly_killed'][self.log_idx] += 1
+                continue
+            data['old_age_killed'][self.log_idx] += 1
+            if population.male[creature_id] or not population.fertile[creature_id]:
+                continue
+
+            # with its last breath, a fly may parasite a caterpillar (and only
+            # then procreates), while a moth always procreates
+            if creature_type is Fly:
+                if not (np.random.uniform() < (self.universe.predation_coefficient *
+                                               len(self.caterpillars) / n_alive)):
+                    continue
+                data['predation'][self.log_idx] += 1
+                self.iteration_data[Moth]['dead'][self.log_idx] += 1
+                victim = self.caterpillars[np.random.randint(low=0, high=len(self.caterpillars))]
+                self.kill_creature(Moth, victim)
+
+            n = self.n_children(creature_type)
+            data['parents'][self.log_idx] += 1
+            data['newborn'][self.log_idx] += n
+            newborn += n
+
+        return dead_males, dead_females, newborn
+
+    # processes the age transitions (of the creatures that are still alive)
+    def process_transitions(self, creature_type, events):
+        population = self.populations[creature_type]
+        for event, creature_id in events:
+            if not population.alive[creature_id]:
+                continue
+            if event == 'adult':
+                population.adult[creature_id] = True
+                population.n_adults += 1
+                if creature_type is Moth:
+                    self.remove_caterpillar(creature_id)
+            elif event == 'caterpillar':
+                self.add_caterpillar(creature_id)
+
+    # logs the aggregated counts of a type of creature on the current day
+    def log_population(self, creature_type, dead_males, dead_females):
+        population = self.populations[creature_type]
+        data = self.iteration_data[creature_type]
+        data['living'][self.log_idx] += population.n_alive
+        data['dead'][self.log_idx] += dead_males + dead_females
+        data['male'][self.log_idx] += population.n_male + dead_males
+        data['female'][self.log_idx] += population.n_alive - population.n_male + dead_females
+        data['adults'][self.log_idx] += population.n_adults
+        if creature_type is Moth:
+            data['caterpillars'][self.log_idx] += len(self.caterpillars)
+
+    #
+    # migration between worlds (see 'WonderfulWorld.emigrate()'): each living
+    # adult leaves with chance 'rate' (its pending events are skipped, as the
+    # ones of the dead). Returns the array with a row per emigrant (male,
+    # fertile, lifespan, age)
+    def emigrate(self, creature_type, rate):
+        population = self.populations[creature_type]
+        adults = np.flatnonzero(np.array(population.alive, dtype=bool) & np.array(population.adult, dtype=bool))
+        leaving = adults[np.random.uniform(size=len(adults)) < rate]
+        for creature_id in leaving.tolist():
+            self.kill_creature(creature_type, creature_id)
+        return np.array([[population.male[i], population.fertile[i], population.lifespan[i],
+                          self.instant - population.birth[i]] for i in leaving.tolist()], dtype=int).reshape(-1, 4)
+
+    # receives the emigrants of other worlds (rows of 'emigrate()'), keeping
+    # their features. Their random death days are drawn again (the random
+    # deaths are memoryless, so this doesn't change their distribution)
+    def immigrate(self, creature_type, migrants):
+        self.add(creature_type, migrants[:, 0] == 1, migrants[:, 1] == 1, migrants[:, 2], migrants[:, 3])
+
+    # logs the initial creatures
+    def initialize_log(self):
+        for creature_type in [Moth, Fly]:
+            self.log_population(creature_type, 0, 0)
+
+    def single_step(self):
+        self.instant = self.instant + 1
+        self.advance_log()
+
+        for creature_type in [Fly, Moth]:
+            events = self.populations[creature_type].calendar.pop(self.instant, [])
+            dead_males, dead_females, newborn = self.process_deaths(creature_type, events)
+            self.process_transitions(creature_type, events)
+            self.log_population(creature_type, dead_males, dead_females)
+
+            # the newborn only start living (and being counted) on the next day
+            self.create(creature_type, newborn, np.zeros(newborn, dtype=int))
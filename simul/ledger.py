@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+#
+# Costs ledger. Append-only storage for the simple costs computed by the
+# simulation control, replacing the '*_cost.csv' files (that had to be read,
+# appended to and rewritten as a whole at the end of every simulation batch).
+#
+# The ledger is a SQLite database in WAL mode, so several processes can
+# append to the same ledger concurrently without losing each other's rows.
+# The rows are indexed by (#flies, #moths, #steps, universe fingerprint,
+# area fraction), so the lookups done by the bayes cost are keyed (O(log n))
+# instead of a scan of the whole costs dataframe for every (density, #flies)
+# pair. The costs of area downscaled simulations (see
+# 'SimulationControl.run_world()') are approximations, so they are kept
+# apart from the full area ones (area fraction 1.0, as the imported rows).
+#
+# As it happens with the csv files, if there are several rows for the
+# same initial populations, the last one appended is the one used. The
+# lookups always take the number of steps: the costs of simulations of
+# different lengths are never mixed up.
+
+import os
+import sqlite3
+import threading
+import pandas as pd
+
+_LEDGER_COLUMNS = ['#flies', '#moths', '#steps', '#simuls', 'cost']
+
+_LEDGER_SCHEMA = """
+CREATE TABLE IF NOT EXISTS costs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    flies INTEGER NOT NULL,
+    moths INTEGER NOT NULL,
+    steps INTEGER NOT NULL,
+    simuls INTEGER NOT NULL,
+    cost REAL NOT NULL,
+    universe TEXT,
+    area_fraction REAL NOT NULL DEFAULT 1.0
+);
+"""
+
+# (ledgers created before the area fraction was recorded only hold full area costs)
+_LEDGER_MIGRATION = 'ALTER TABLE costs ADD COLUMN area_fraction REAL NOT NULL DEFAULT 1.0'
+_LEDGER_INDEX = """
+DROP INDEX IF EXISTS costs_key;
+CREATE INDEX IF NOT EXISTS costs_area_key ON costs (flies, moths, steps, universe, area_fraction);
+"""
+
+
+class CostsLedger:
+
+    # receives the path of the database file (created if it doesn't exist).
+    # 'timeout' is how long (seconds) a writer waits for a concurrent one.
+    def __init__(self, path, timeout=60.0):
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+
+    #
+    # the connection is opened lazily, once per process and thread: sqlite
+    # connections can't be shared between processes (the ledger may be
+    # pickled and sent to worker processes together with the simulation
+    # control) nor between threads (the service runs its lookups on a thread
+    # of its own, see 'simul.service')
+    def connection(self):
+        local = self._local
+        if (getattr(local, 'conn', None) is None) or (local.pid != os.getpid()):
+            parent_dir = os.path.dirname(self.path)
+            if parent_dir and not os.path.exists(parent_dir):
+                os.makedirs(parent_dir, exist_ok=True)
+            local.conn = sqlite3.connect(self.path, timeout=self.timeout)
+            local.conn.execute('PRAGMA journal_mode=WAL')
+            local.conn.execute('PRAGMA synchronous=NORMAL')
+            local.conn.executescript(_LEDGER_SCHEMA)
+            if 'area_fraction' not in [row[1] for row in local.conn.execute('PRAGMA table_info(costs)')]:
+                try:
+                    local.conn.execute(_LEDGER_MIGRATION)
+                except sqlite3.OperationalError:
+                    # (migrated by a concurrent process)
+                    pass
+            local.conn.executescript(_LEDGER_INDEX)
+            local.pid = os.getpid()
+        return local.conn
+
+    # closes the connection of the current thread (if it was opened on this process)
+    def close(self):
+        local = self._local
+        if (getattr(local, 'conn', None) is not None) and (local.pid == os.getpid()):
+            local.conn.close()
+        local.conn = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_local']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = threading.local()
+
+    #
+    # appends cost rows to the ledger, on a single transaction. 'costs_data'
+    # is a dictionary with the '_COST_COLUMNS' keys (the same one built by the
+    # 'simulation_batch' method) or a dataframe with those columns, of
+    # simulations on the given area fraction.
+    def append(self, costs_data, universe=None, area_fraction=1.0):
+        rows = [(int(f), int(m), int(st), int(si), float(c), universe, float(area_fraction))
+                for f, m, st, si, c in zip(*[costs_data[col] for col in _LEDGER_COLUMNS])]
+        conn = self.connection()
+        with conn:
+            conn.executemany('INSERT INTO costs (flies, moths, steps, simuls, cost, universe, area_fraction) '
+                             'VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+
+    #
+    # imports an existing '*_cost.csv' file into the ledger
+    def import_csv(self, path, universe=None):
+        self.append(pd.read_csv(path, index_col=[0]), universe=universe)
+
+    #
+    # returns the last cost recorded for the given initial populations and
+    # number of steps (of simulations on the given area fraction), or None if
+    # there is none. Optionally filters by universe fingerprint (rows without
+    # a fingerprint, like the imported ones, match any universe)
+    def cost(self, n_flies, n_moths, n_steps, universe=None, area_fraction=1.0):
+        query = 'SELECT cost FROM costs WHERE flies = ? AND moths = ? AND steps = ? AND area_fraction = ?'
+        args = [int(n_flies), int(n_moths), int(n_steps), float(area_fraction)]
+        if universe is not None:
+            query += ' AND (universe = ? OR universe IS NULL)'
+            args.append(universe)
+        row = self.connection().execute(query + ' ORDER BY id DESC LIMIT 1', args).fetchone()
+        return None if row is None else row[0]
+
+    #
+    # keyed lookup for a list of (#moths, #flies) pairs, simulated for 'n_steps'.
+    # Returns a dictionary {(#moths, #flies): cost} with only the pairs found on the ledger
+    def costs(self, pairs, n_steps, universe=None, area_fraction=1.0):
+        table = {}
+        for n_moths, n_flies in pairs:
+            cost = self.cost(n_flies, n_moths, n_steps=n_steps, universe=universe, area_fraction=area_fraction)
+            if cost is not None:
+                table[(int(n_moths), int(n_flies))] = cost
+        return table
+
+    def __len__(self):
+        return self.connection().execute('SELECT COUNT(*) FROM costs').fetchone()[0]
+
+    # the whole ledger (of an area fraction) as a dataframe, with the same columns of the costs csv files
+    def to_dataframe(self, universe=None, area_fraction=1.0):
+        query = 'SELECT flies, moths, steps, simuls, cost FROM costs WHERE area_fraction = ?'
+        args = [float(area_fraction)]
+        if universe is not None:
+            query += ' AND (universe = ? OR universe IS NULL)'
+            args.append(universe)
+        rows = self.connection().execute(query + ' ORDER BY id', args).fetchall()
+        return pd.DataFrame(data=rows, columns=_LEDGER_COLUMNS)
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+#
+# Lightweight simulation log. Holds the same data as the dataframe returned
+# by 'world.run_world()' (one row per time step, one column per entry of the
+# universe's 'df_columns'), but stored on a single 2D numpy array.
+#
+# It is used on the 'lean' run mode: cost sweeps with thousands of replicates
+# only need a couple of scalars from each replicate (mostly the integral of
+# the caterpillars curve), so building a pandas dataframe for each one of
+# them is pure overhead. The dataframe is only built (and cached) when
+# someone actually asks for it, through the 'to_dataframe()' method.
+
+import numpy as np
+import pandas as pd
+import scipy.integrate as integrate
+
+
+class SimulationLog:
+
+    # receives a 2D array with shape (n_steps + 1, len(columns)) and the
+    # list of column names (usually the universe's 'df_columns')
+    def __init__(self, values, columns):
+        self.values = values
+        self.columns = list(columns)
+        self._col_idx = {col: idx for idx, col in enumerate(self.columns)}
+        self._df = None
+
+    #
+    # builds a log from the 'iteration_data' structure of a world, without
+    # any copy of the data other than the final stacking of the columns
+    @classmethod
+    def from_iteration_data(cls, iteration_data, universe, creature_types):
+        # keeps the same column order used on the dataframes
+        types_by_name = {creature_type.name(): creature_type for creature_type in creature_types}
+        values = np.column_stack([iteration_data[types_by_name[c]][d]
+                                  for c in universe.c_types
+                                  for d in universe.recordable_data])
+        return cls(values, universe.df_columns)
+
+    # empty (zeroed) log with the given number of rows
+    @classmethod
+    def zeros(cls, elems, columns):
+        return cls(np.zeros([elems, len(columns)]), columns)
+
+    # returns a new log with the columns in the given order
+    def reorder(self, columns):
+        if list(columns) == self.columns:
+            return self
+        return SimulationLog(self.values[:, [self._col_idx[col] for col in columns]], columns)
+
+    def __len__(self):
+        return self.values.shape[0]
+
+    # column access, returns a view (no copies) of the requested column
+    def __getitem__(self, col):
+        return self.values[:, self._col_idx[col]]
+
+    # arithmetic used to compute the running average of a simulation batch
+    def __add__(self, other):
+        if isinstance(other, SimulationLog):
+            other = other.reorder(self.columns).values
+        elif isinstance(other, pd.DataFrame):
+            other = other[self.columns].values
+        return SimulationLog(self.values + other, self.columns)
+
+    __radd__ = __add__
+
+    def __truediv__(self, other):
+        return SimulationLog(self.values / other, self.columns)
+
+    #
+    # integral of a column along the simulation time. Uses the same
+    # integration rule used on the cost function of the simulation control
+    def integral(self, col='moth-caterpillars'):
+        return integrate.simps(np.array(self[col], dtype=int))
+
+    # last value of a column (final populations, for instance)
+    def final(self, col):
+        return self.values[-1, self._col_idx[col]]
+
+    # maximum value of a column along the simulation time
+    def peak(self, col):
+        return self.values[:, self._col_idx[col]].max()
+
+    #
+    # builds the dataframe with the log data. It is cached, so subsequent
+    # calls return the same dataframe object.
+    def to_dataframe(self):
+        if self._df is None:
+            self._df = pd.DataFrame(data=self.values, index=range(len(self)), columns=self.columns)
+        return self._df
+
+    def to_csv(self, *args, **kwargs):
+        return self.to_dataframe().to_csv(*args, **kwargs)
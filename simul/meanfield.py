@@ -0,0 +1,288 @@
+# -*- coding: utf-8 -*-
+#
+# Deterministic mean-field world. Projects forward the expected number of
+# moths and flies of each age, following the same laws of the universe used
+# by the (stochastic, agent based) 'WonderfulWorld':
+#    > random death with a constant daily chance
+#    > death by old age, with the lifespan drawn from the rounded normal
+#      distribution when the creature is born
+#    > moths procreate when they die of old age (fertile females), with the
+#      expected number of children of the rounded normal distribution
+#    > flies procreate when they die of old age after a predation, that
+#      happens with the ratio-based chance (#caterpillars / #flies)
+#
+# The state of each species is the expected number of creatures of each age.
+# Given a creature lived up to some age, the chance of its lifespan ending on
+# that day only depends on the age (the lifespan is drawn once, when it is
+# born), so a day of the simulation is a projection of the state by a sparse
+# (Leslie) matrix: the subdiagonal holds the chances of surviving both kinds
+# of death, and the newborns come from the old age deaths (the parents). The
+# matrix is applied with array slicing instead of being built explicitly.
+#
+# The creatures of the initial population are kept on a separate compartment,
+# since their lifespans are not conditioned on their initial ages (or, if the
+# world defines an initial lifespan, they all die of old age on the same day).
+#
+# The output log has the same columns as the one of the 'WonderfulWorld',
+# with expected (real valued) counts.
+
+import numpy as np
+import pandas as pd
+import scipy.integrate as integrate
+from math import erf, sqrt
+
+from simul.creatures import Moth
+from simul.creatures import Fly
+from simul.log import SimulationLog
+
+
+# cumulative distribution function of the normal distribution
+def _normal_cdf(x, mean, std):
+    if std <= 0:
+        return float(x >= mean)
+    return 0.5 * (1.0 + erf((x - mean) / (std * sqrt(2.0))))
+
+
+#
+# probabilities of the values of 'max([low, int(np.round(normal(mean, std)))])',
+# the distribution used on the lifespans (low=1) and on the number of children
+# (low=0) of the creatures. Returns the array of probabilities for the values
+# 0, 1, ..., high (where high is far enough on the distribution's tail)
+def rounded_normal_pmf(mean, std, low):
+    high = int(np.ceil(mean + 8 * std)) + 1
+    pmf = np.zeros(max([high, low]) + 1)
+    pmf[low] = _normal_cdf(low + 0.5, mean, std)
+    for k in range(low + 1, len(pmf)):
+        pmf[k] = _normal_cdf(k + 0.5, mean, std) - _normal_cdf(k - 0.5, mean, std)
+    return pmf
+
+
+class MeanFieldWorld:
+
+    # same interface as the 'WonderfulWorld': receives the universe and the
+    # (optional) initial lifespans of flies and moths
+    def __init__(self, universe, fil=None, mil=None):
+        self.universe = universe
+        self.instant = 0
+
+        self.n_moths = 0
+        self.n_flies = 0
+
+        self.initial_lifespan = {Fly: fil, Moth: mil}
+        self.iteration_data = {Moth: [], Fly: []}
+
+        # per species constants of the projection
+        self.lifespan_pmf = {}
+        self.expected_offspring = {}
+        self.n_ages = {}
+        self.old_age_hazard = {}
+        for creature_type in [Fly, Moth]:
+            pmf = rounded_normal_pmf(universe.lifespan_mean[creature_type],
+                                     universe.lifespan_var[creature_type], 1)
+            offspring_pmf = rounded_normal_pmf(universe.offspring_mean[creature_type],
+                                               universe.offspring_var[creature_type], 0)
+            self.lifespan_pmf[creature_type] = pmf
+            self.expected_offspring[creature_type] = np.dot(np.arange(len(offspring_pmf)), offspring_pmf)
+
+            # ages go up to the maximum lifespan (+1, the day of the death by
+            # old age) or to the maximum initial age
+            self.n_ages[creature_type] = max([len(pmf), universe.initial_age_max[creature_type] + 1]) + 2
+
+            # a creature of age 'a' dies of old age if its lifespan is 'a - 1',
+            # given it is at least 'a - 1' (otherwise it would already be dead)
+            hazard = np.ones(self.n_ages[creature_type])
+            hazard[0] = 0.0
+            for age in range(1, len(pmf) + 1):
+                tail = pmf[age - 1:].sum()
+                hazard[age] = pmf[age - 1] / tail if tail > 0 else 1.0
+            self.old_age_hazard[creature_type] = hazard
+
+    #
+    # expected ages of a single creature of the initial population: uniformly
+    # distributed between the universe limits or, if the world defines an
+    # initial lifespan, its lifespan minus the initial lifespan (negative ages
+    # are taken as zero: they are neither caterpillars nor adults anyway)
+    def initial_ages(self, creature_type):
+        ages = np.zeros(self.n_ages[creature_type])
+        initial_lifespan = self.initial_lifespan[creature_type]
+        if initial_lifespan is None:
+            low = self.universe.initial_age_min[creature_type]
+            high = self.universe.initial_age_max[creature_type]
+            ages[low:high + 1] = 1.0 / (high - low + 1)
+        else:
+            pmf = self.lifespan_pmf[creature_type]
+            for lifespan in range(1, len(pmf)):
+                ages[max([lifespan - initial_lifespan, 0])] += pmf[lifespan]
+        return ages
+
+    #
+    # old age death chances of each age of the initial population, on the
+    # given day of the simulation (counted from 1)
+    def initial_hazard(self, creature_type, day):
+        initial_lifespan = self.initial_lifespan[creature_type]
+        if initial_lifespan is None:
+            if day > 1:
+                return self.old_age_hazard[creature_type]
+
+            # on the first day, they die if the lifespan is less than the age
+            cdf = np.cumsum(self.lifespan_pmf[creature_type])
+            ages = np.arange(self.n_ages[creature_type])
+            return cdf[np.clip(ages - 1, 0, len(cdf) - 1)] * (ages > 0)
+
+        # they all reach their lifespan on the same day
+        hazard = np.zeros(self.n_ages[creature_type])
+        hazard[-1] = 1.0
+        if day == max([initial_lifespan, -1]) + 2:
+            hazard[:] = 1.0
+        return hazard
+
+    # range (slice) of the ages in which the creatures are caterpillars
+    def caterpillar_ages(self, creature_type):
+        if creature_type is not Moth:
+            return slice(0, 0)
+        return slice(self.universe.egg_age[creature_type] + 1, self.universe.adult_age[creature_type])
+
+    #
+    # one day of projection of a species, given the state at the start of the
+    # day: array (batch, compartment, age), where the compartment 0 holds the
+    # creatures born during the simulation and the compartment 1 the initial
+    # population. Returns the state of the survivors at the end of the day
+    # (without the newborns), the expected random and old age deaths (batch arrays)
+    def project(self, creature_type, state):
+        rd = self.universe.random_death_chance[creature_type]
+        hazard = np.stack([self.old_age_hazard[creature_type], self.initial_hazard(creature_type, self.instant)])
+
+        randomly_killed = rd * state.sum(axis=(1, 2))
+        survivors = (1 - rd) * state
+        old_age = survivors * hazard
+        old_age_killed = old_age.sum(axis=(1, 2))
+
+        aged = np.zeros(state.shape)
+        aged[:, :, 1:] = (survivors - old_age)[:, :, :-1]
+        return aged, randomly_killed, old_age_killed
+
+    #
+    # logs the expected counts of a species at the current instant
+    def log_state(self, creature_type, state, listed):
+        log = self.iteration_data[creature_type]
+        mfr = self.universe.mf_ratio[creature_type]
+        by_age = state.sum(axis=1)
+        log['living'][:, self.instant] = by_age.sum(axis=1)
+        log['male'][:, self.instant] = mfr * listed
+        log['female'][:, self.instant] = (1 - mfr) * listed
+        log['caterpillars'][:, self.instant] = by_age[:, self.caterpillar_ages(creature_type)].sum(axis=1)
+        log['adults'][:, self.instant] = by_age[:, self.universe.adult_age[creature_type]:].sum(axis=1)
+
+    # resets the iteration log, with one row per initial population of the batch
+    def reset_iteration_log(self, batch, n_steps):
+        self.iteration_data = {
+            Fly: {col: np.zeros([batch, n_steps + 1]) for col in self.universe.recordable_data},
+            Moth: {col: np.zeros([batch, n_steps + 1]) for col in self.universe.recordable_data}
+        }
+
+    #
+    # projects a batch of initial populations (arrays with the same length)
+    # for 'end_of_times' days. Returns a 3D array (batch, step, column) with
+    # the expected logs, columns on the universe's 'df_columns' order
+    def run_batch(self, n_flies, n_moths, end_of_times):
+        n_flies = np.asarray(n_flies, dtype=float)
+        n_moths = np.asarray(n_moths, dtype=float)
+        batch = len(n_flies)
+        universe = self.universe
+
+        self.instant = 0
+        self.reset_iteration_log(batch, end_of_times)
+        state = {}
+        for creature_type, n in [(Fly, n_flies), (Moth, n_moths)]:
+            state[creature_type] = np.zeros([batch, 2, self.n_ages[creature_type]])
+            state[creature_type][:, 1, :] = n[:, None] * self.initial_ages(creature_type)
+            self.log_state(creature_type, state[creature_type], n)
+
+        moth_caterpillars = self.caterpillar_ages(Moth)
+        for _ in range(end_of_times):
+            self.instant = self.instant + 1
+            fly_log = self.iteration_data[Fly]
+            moth_log = self.iteration_data[Moth]
+
+            # flies: deaths and, for the fertile females dying of old age,
+            # predation with the ratio-based chance
+            listed_flies = state[Fly].sum(axis=(1, 2))
+            caterpillars = state[Moth][:, :, moth_caterpillars].sum(axis=(1, 2))
+            aged, randomly_killed, old_age_killed = self.project(Fly, state[Fly])
+
+            chance = np.zeros(batch)
+            np.divide(universe.predation_coefficient * caterpillars, listed_flies,
+                      out=chance, where=listed_flies > 0)
+            predators = old_age_killed * (1 - universe.mf_ratio[Fly]) * universe.fertility_ratio[Fly]
+            predation = np.minimum(caterpillars, predators * np.minimum(chance, 1.0))
+            newborn = predation * self.expected_offspring[Fly]
+
+            fly_log['dead'][:, self.instant] = randomly_killed + old_age_killed
+            fly_log['randomly_killed'][:, self.instant] = randomly_killed
+            fly_log['old_age_killed'][:, self.instant] = old_age_killed
+            fly_log['parents'][:, self.instant] = predation
+            fly_log['newborn'][:, self.instant] = newborn
+            fly_log['predation'][:, self.instant] = predation
+            self.log_state(Fly, aged, listed_flies)
+            aged[:, 0, 0] += newborn
+            state[Fly] = aged
+
+            # moths: the preyed caterpillars are removed (evenly from all the
+            # caterpillar ages) before the deaths and the procreation
+            survival = np.ones(batch)
+            np.divide(caterpillars - predation, caterpillars, out=survival, where=caterpillars > 0)
+            state[Moth][:, :, moth_caterpillars] *= survival[:, None, None]
+
+            listed_moths = state[Moth].sum(axis=(1, 2))
+            aged, randomly_killed, old_age_killed = self.project(Moth, state[Moth])
+            parents = old_age_killed * (1 - universe.mf_ratio[Moth]) * universe.fertility_ratio[Moth]
+            newborn = parents * self.expected_offspring[Moth]
+
+            moth_log['dead'][:, self.instant] = randomly_killed + old_age_killed + predation
+            moth_log['randomly_killed'][:, self.instant] = randomly_killed
+            moth_log['old_age_killed'][:, self.instant] = old_age_killed
+            moth_log['parents'][:, self.instant] = parents
+            moth_log['newborn'][:, self.instant] = newborn
+            self.log_state(Moth, aged, listed_moths)
+            aged[:, 0, 0] += newborn
+            state[Moth] = aged
+
+        types_by_name = {creature_type.name(): creature_type for creature_type in [Fly, Moth]}
+        return np.stack([self.iteration_data[types_by_name[c]][d]
+                         for c in universe.c_types
+                         for d in universe.recordable_data], axis=2)
+
+    #
+    # same interface as 'WonderfulWorld.run_world()', so the mean-field world
+    # can be used by a simulation control. Returns the dataframe with the
+    # expected log (or a 'SimulationLog', if 'lean' is set)
+    def run_world(self, n_flies, n_moths, end_of_times, lean=False):
+        self.n_moths = n_moths
+        self.n_flies = n_flies
+
+        log = SimulationLog(self.run_batch([n_flies], [n_moths], end_of_times)[0], self.universe.df_columns)
+        return log if lean else log.to_dataframe()
+
+
+#
+# screens the simple costs of a grid of initial populations with the
+# mean-field projection of the control's universe (and world's initial
+# lifespans). Returns a dataframe with the costs columns ('#simuls' is 0,
+# these are not simulations), one row per (#flies, #moths) pair of the grid.
+def screen_costs(control, n_flies_list, n_moths_list, simul_time):
+    world = control.world
+    mean_field = MeanFieldWorld(world.universe, fil=world.initial_lifespan[Fly], mil=world.initial_lifespan[Moth])
+
+    n_flies, n_moths = [a.ravel() for a in np.meshgrid(n_flies_list, n_moths_list, indexing='ij')]
+    logs = mean_field.run_batch(n_flies, n_moths, simul_time)
+
+    # same cost as 'SimulationControl.cost()', on all the grid at once (and
+    # without truncating the expected counts of caterpillars)
+    caterpillars = logs[:, :, world.universe.df_columns.index('moth-caterpillars')]
+    costs = n_flies * control.cost_fly + control.cost_moth * integrate.simps(caterpillars, axis=1)
+    return pd.DataFrame(data={'#flies': n_flies,
+                              '#moths': n_moths,
+                              '#steps': simul_time,
+                              '#simuls': 0,
+                              'cost': costs},
+                        columns=['#flies', '#moths', '#steps', '#simuls', 'cost'])
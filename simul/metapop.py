@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+#
+# Metapopulation of fields (patches): each field is a world, with its own
+# initial populations, running on its own process. Every 'sync_steps' steps
+# the adult moths and flies of each field emigrate with a given chance (per
+# sync) to one of its neighbours on the (sparse) adjacency graph of the
+# fields, chosen at random.
+#
+# The exchange is done in bulk: each patch sends, to each one of its
+# neighbours, the array with the features of the creatures going there (see
+# 'WonderfulWorld.emigrate()' and 'EventWorld.emigrate()') through the
+# neighbour's inbox queue, and waits for the arrays of all of its own
+# neighbours before its next step. So the patches only synchronize with their
+# neighbours, on the sync steps, and the farm runs with as many processes as
+# fields.
+#
+# The creature lists of the moths (caterpillars) are class attributes, so two
+# worlds can't run on the same process: one process per patch is a must, not
+# only a matter of speed.
+#
+# The counts of the fields add up to the farm log, and the farm cost is the
+# cost of the farm log, with all of the released flies.
+
+import traceback
+import numpy as np
+import multiprocessing as mp
+import scipy.integrate as integrate
+from collections import defaultdict
+
+from simul.log import SimulationLog
+from simul.creatures import Moth
+from simul.creatures import Fly
+from simul.parallel import light_control, prepare_worker, job_seeds
+
+
+#
+# runs a patch (on its own process): simulates its world, exchanging migrants
+# with its neighbours on the sync steps, and puts its log on the results queue
+# (or the error, if any)
+def patch_process(control, index, n_flies, n_moths, simul_time, sync_steps, migration, neighbours,
+                  inboxes, results, seed):
+    try:
+        prepare_worker(control, seed)
+        world = control.world
+        received = defaultdict(list)
+        rows = []
+        for record in control.iter_steps(n_flies, n_moths, simul_time):
+            rows.append(record.values())
+            t = record.instant
+            if (not neighbours) or (t == 0) or (t % sync_steps != 0) or (t == simul_time):
+                continue
+
+            outgoing = {j: {} for j in neighbours}
+            for creature_type, rate in migration.items():
+                if rate == 0:
+                    continue
+                emigrants = world.emigrate(creature_type, rate)
+                destination = np.random.randint(len(neighbours), size=len(emigrants))
+                for k, j in enumerate(neighbours):
+                    outgoing[j][creature_type] = emigrants[destination == k]
+            for j in neighbours:
+                inboxes[j].put((t, index, outgoing[j]))
+
+            # a neighbour may already be on its next sync: its messages are kept
+            while len(received[t]) < len(neighbours):
+                message_t, source, migrants = inboxes[index].get()
+                received[message_t].append((source, migrants))
+
+            # (the immigrants come in the same order on every run)
+            for _, migrants in sorted(received.pop(t), key=lambda message: message[0]):
+                for creature_type, immigrants in migrants.items():
+                    world.immigrate(creature_type, immigrants)
+
+        results.put((index, np.array(rows), None))
+    except Exception:
+        results.put((index, None, traceback.format_exc()))
+
+
+class Metapopulation:
+
+    # control             : simulation control (world, universe and costs of every patch)
+    # initial_populations : dataframe with the '#flies' and '#moths' of each patch
+    # edges               : list of pairs of neighbour patches (indexes)
+    # fly_migration, moth_migration : chance of an adult leaving its patch, per sync
+    # sync_steps          : steps between the migrations
+    def __init__(self, control, initial_populations, edges, fly_migration=0.0, moth_migration=0.0, sync_steps=1):
+        self.control = light_control(control)
+        self.n_flies = [int(n) for n in initial_populations['#flies'].values]
+        self.n_moths = [int(n) for n in initial_populations['#moths'].values]
+        self.migration = {Fly: fly_migration, Moth: moth_migration}
+        self.sync_steps = sync_steps
+
+        self.neighbours = [set() for _ in self.n_flies]
+        for i, j in edges:
+            if i != j:
+                self.neighbours[i].add(j)
+                self.neighbours[j].add(i)
+        self.neighbours = [sorted(patch) for patch in self.neighbours]
+
+    def __len__(self):
+        return len(self.n_flies)
+
+    #
+    # simulates the farm for 'simul_time' steps. Returns the farm log (sum of
+    # the patches) and the list with the log of each patch
+    def run(self, simul_time):
+        inboxes = [mp.Queue() for _ in range(len(self))]
+        results = mp.Queue()
+        processes = [mp.Process(target=patch_process,
+                                args=(self.control, i, self.n_flies[i], self.n_moths[i], simul_time, self.sync_steps,
+                                      self.migration, self.neighbours[i], inboxes, results, seed))
+                     for i, seed in enumerate(job_seeds(len(self)))]
+        for process in processes:
+            process.start()
+
+        logs = [None] * len(self)
+        try:
+            for _ in range(len(self)):
+                index, values, error = results.get()
+                if error is not None:
+                    raise RuntimeError('patch {} failed:\n{}'.format(index, error))
+                logs[index] = SimulationLog(values, self.control.world.universe.df_columns)
+            for process in processes:
+                process.join()
+        finally:
+            for process in processes:
+                if process.is_alive():
+                    process.terminate()
+
+        farm_log = SimulationLog(np.sum([log.values for log in logs], axis=0), self.control.world.universe.df_columns)
+        return farm_log, logs
+
+    # cost of a farm log (as on 'SimulationControl.cost()', with all the flies of the farm)
+    def cost(self, farm_log):
+        moth_function = np.array(farm_log['moth-caterpillars'], dtype=int)
+        return sum(self.n_flies) * self.control.cost_fly + self.control.cost_moth * integrate.simps(moth_function)
@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+#
+# Multilevel Monte Carlo (MLMC) estimator of the expected cost of a
+# simulation ('SimulationControl.cost()'), mixing cheap and full fidelity
+# models (Giles, 2008).
+#
+# The levels are increasingly expensive models of the same scenario: area
+# downscaled runs (see 'SimulationControl.run_world()') with increasing area
+# fractions, the last one usually the full area (1.0), optionally preceded by
+# the deterministic mean-field projection (see 'simul.meanfield'). With P_l the
+# cost on level l, the expected cost on the finest level L is
+#    E[P_L] = E[P_0] + sum_{l=1}^{L} E[P_l - P_{l-1}]
+# and each term is estimated by its own replicates: level 0 with plain runs of
+# the cheapest model, the others with coupled pairs of runs (fine and coarse).
+# The pair shares its initial creatures: the fine run draws them (sexes,
+# fertility, lifespans and ages, see 'WonderfulWorld.draw_initial_creatures()')
+# and the coarse one starts with a random thinning of them, the same number of
+# creatures a downscaled run would have (see 'downscaled_count()', both counts
+# are rounded with the same uniform number). Both runs then go on from the
+# same seed. The thinned creatures are a uniform sample of the fine ones, so
+# the coarse run has the same distribution as a plain one, and the
+# correction P_l - P_{l-1} keeps its expected value, with a smaller variance
+# (the pair starts from the same ages, which drive most of the early
+# dynamics). The mean-field level is exact (a single, deterministic, run).
+#
+# After a pilot round, the variance V_l and the cpu time C_l of a replicate of
+# each level are known, and the replicates are allocated to minimize the
+# variance of the estimate for a compute budget B (cpu seconds)
+#    N_l = B sqrt(V_l / C_l) / sum_k sqrt(V_k C_k)
+# or to reach a standard error 'tolerance' with the least compute
+#    N_l = sqrt(V_l / C_l) sum_k sqrt(V_k C_k) / tolerance^2
+#
+# Most of the variance sits on the cheap levels, so most of the replicates are
+# cheap ones and only a few full area runs correct their bias.
+
+import time
+import numpy as np
+import pandas as pd
+import scipy.integrate as integrate
+
+from simul.creatures import Moth
+from simul.creatures import Fly
+from simul.meanfield import MeanFieldWorld
+from simul.parallel import light_control, prepare_worker, job_seeds, run_jobs
+
+_LEVEL_COLUMNS = ['level', 'fine', 'coarse', 'replicates', 'mean', 'variance', 'seconds']
+
+
+#
+# runs coupled replicates of a level on a worker: for each seed, the fine area
+# fraction runs with its initial creatures and the coarse one (if any) with a
+# random thinning of them, both from the same seed afterwards. Returns an
+# array with a row per seed: fine cost, fine cpu seconds, coarse cost, coarse
+# cpu seconds
+def multilevel_job(control, fine, coarse, n_flies, n_moths, simul_time, seeds):
+    prepare_worker(control, seeds[0])
+    world = control.world
+    rows = np.zeros([len(seeds), 4])
+    for i, seed in enumerate(seeds):
+        np.random.seed(seed)
+        creatures = {fine: {}, coarse: {}}
+        for creature_type, n in [(Fly, n_flies), (Moth, n_moths)]:
+            u = np.random.uniform()
+            n_fine = int(np.floor(n * fine + u))
+            features = world.draw_initial_creatures(creature_type, n_fine)
+            creatures[fine][creature_type] = features
+            if coarse is not None:
+                n_coarse = int(np.floor(n * coarse + u))
+                creatures[coarse][creature_type] = features[np.sort(np.random.choice(n_fine, size=n_coarse,
+                                                                                     replace=False))]
+        dynamics_seed = np.random.randint(low=0, high=2 ** 31 - 1)
+
+        try:
+            for j, area_fraction in enumerate([fine, coarse]):
+                if area_fraction is None:
+                    continue
+                np.random.seed(dynamics_seed)
+                world.initial_creatures = creatures[area_fraction]
+                start = time.process_time()
+                data_log = world.run_world(len(creatures[area_fraction][Fly]), len(creatures[area_fraction][Moth]),
+                                           simul_time, lean=True) / area_fraction
+                world.n_flies = n_flies
+                world.n_moths = n_moths
+                rows[i, 2 * j] = control.cost(data_log)
+                rows[i, 2 * j + 1] = time.process_time() - start
+        finally:
+            world.initial_creatures = {Moth: None, Fly: None}
+    return rows
+
+
+class MultilevelCost:
+
+    # control        : simulation control (its world, universe and costs)
+    # area_fractions : area fractions of the stochastic levels, increasing
+    # mean_field     : if set, the coarsest level is the mean-field projection
+    # n_pilot        : replicates per level on the pilot round
+    # job_size       : replicates per job sent to the workers
+    def __init__(self, control, area_fractions=(0.01, 0.1, 1.0), mean_field=False, n_pilot=10, job_size=5,
+                 n_workers=None):
+        if np.any(np.diff(np.asarray(area_fractions, dtype=float)) <= 0):
+            raise ValueError('the area fractions must be strictly increasing')
+        if (min(area_fractions) <= 0) or (max(area_fractions) > 1):
+            raise ValueError('the area fractions must be in (0, 1]')
+
+        self.control = light_control(control)
+        self.area_fractions = list(area_fractions)
+        self.mean_field = mean_field
+        self.n_pilot = n_pilot
+        self.job_size = job_size
+        self.n_workers = n_workers
+
+        # (fine, coarse) models of each level: an area fraction, 'mean_field' or None
+        coarse = ['mean_field' if mean_field else None] + self.area_fractions[:-1]
+        self.levels = list(zip(self.area_fractions, coarse))
+        if mean_field:
+            self.levels = [('mean_field', None)] + self.levels
+
+    # deterministic cost of the mean-field projection (without truncating the counts)
+    def mean_field_cost(self, n_flies, n_moths, simul_time):
+        world = self.control.world
+        mean_field = MeanFieldWorld(world.universe, fil=world.initial_lifespan[Fly], mil=world.initial_lifespan[Moth])
+        data_log = mean_field.run_world(n_flies, n_moths, simul_time, lean=True)
+        return n_flies * self.control.cost_fly + self.control.cost_moth * integrate.simps(data_log['moth-caterpillars'])
+
+    #
+    # runs 'n' replicates of a level, in parallel. Returns the array with a row
+    # per replicate: correction (fine - coarse costs), cpu seconds, fine cost and
+    # fine cpu seconds
+    def run_level(self, level, n_flies, n_moths, simul_time, n):
+        fine, coarse = self.levels[level]
+        if fine == 'mean_field':
+            return np.array([[self.mean_field_cost(n_flies, n_moths, simul_time), 0.0, np.nan, 0.0]])
+
+        seeds = job_seeds(n)
+        rows = np.concatenate(run_jobs(multilevel_job,
+                                       [(self.control, fine, coarse if coarse != 'mean_field' else None,
+                                         n_flies, n_moths, simul_time, seeds[a:a + self.job_size])
+                                        for a in range(0, n, self.job_size)],
+                                       n_workers=self.n_workers))
+        offset = self.mean_field_cost(n_flies, n_moths, simul_time) if coarse == 'mean_field' else 0.0
+        return np.column_stack([rows[:, 0] - rows[:, 2] - offset, rows[:, 1] + rows[:, 3], rows[:, 0], rows[:, 1]])
+
+    #
+    # replicates of each level that minimize the variance for the 'budget' (cpu
+    # seconds) or reach the standard error 'tolerance', given the variances
+    # and the cpu seconds per replicate of the levels
+    @staticmethod
+    def allocation(variances, seconds, budget=None, tolerance=None):
+        variances = np.asarray(variances, dtype=float)
+        seconds = np.maximum(np.asarray(seconds, dtype=float), 1e-9)
+        total = np.sum(np.sqrt(variances * seconds))
+        if total == 0:
+            return np.zeros(len(variances), dtype=int)
+        if budget is not None:
+            return np.floor(budget * np.sqrt(variances / seconds) / total).astype(int)
+        return np.ceil(np.sqrt(variances / seconds) * total / tolerance ** 2).astype(int)
+
+    #
+    # estimates the expected cost of the scenario: a pilot round on each level,
+    # then the remaining replicates of the optimal allocation for the 'budget'
+    # (cpu seconds, including the pilot) or the 'tolerance' (standard error).
+    #
+    # Returns the estimate, its standard error and a dataframe with the levels
+    # ('_LEVEL_COLUMNS': replicates, mean and variance of the corrections and
+    # cpu seconds per replicate). Its 'attrs' hold the cpu seconds spent and
+    # the ones a plain Monte Carlo on the finest level would take for the
+    # same standard error.
+    def estimate(self, n_flies, n_moths, simul_time, budget=None, tolerance=None):
+        samples = [self.run_level(level, n_flies, n_moths, simul_time, self.n_pilot)
+                   for level in range(len(self.levels))]
+
+        if (budget is not None) or (tolerance is not None):
+            stochastic = [level for level, (fine, _) in enumerate(self.levels) if fine != 'mean_field']
+            variances = [np.var(samples[level][:, 0], ddof=1) for level in stochastic]
+            seconds = [np.mean(samples[level][:, 1]) for level in stochastic]
+            targets = self.allocation(variances, seconds, budget=budget, tolerance=tolerance)
+
+            for level, target in zip(stochastic, targets):
+                if target > len(samples[level]):
+                    samples[level] = np.concatenate([samples[level], self.run_level(
+                        level, n_flies, n_moths, simul_time, target - len(samples[level]))])
+
+        levels = pd.DataFrame(data={
+            'level': range(len(self.levels)),
+            'fine': [fine for fine, _ in self.levels],
+            'coarse': [coarse for _, coarse in self.levels],
+            'replicates': [len(rows) for rows in samples],
+            'mean': [np.mean(rows[:, 0]) for rows in samples],
+            'variance': [np.var(rows[:, 0], ddof=1) if len(rows) > 1 else 0.0 for rows in samples],
+            'seconds': [np.mean(rows[:, 1]) for rows in samples]
+        }, columns=_LEVEL_COLUMNS)
+
+        estimate = levels['mean'].sum()
+        std_error = np.sqrt(np.sum(levels['variance'] / levels['replicates']))
+
+        # plain Monte Carlo on the finest level: the fine runs of the last level
+        finest = samples[-1]
+        levels.attrs['cpu_seconds'] = float(sum(np.sum(rows[:, 1]) for rows in samples))
+        levels.attrs['single_level_cpu_seconds'] = (float(np.var(finest[:, 2], ddof=1) / std_error ** 2 *
+                                                          np.mean(finest[:, 3]))
+                                                    if (std_error > 0) and (len(finest) > 1) else np.nan)
+        return estimate, std_error, levels
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+#
+# Helpers to run simulation batches on a pool of worker processes.
+#
+# The simulation control (and its world) are sent to the workers as light
+# copies: a fresh world with the same universe and initial lifespans, without
+# the creatures of any previous run and without the plotter. Each job gets its
+# own seed, drawn from the parent's random generator, so the workers don't
+# repeat each other's random streams and a sweep is reproducible given the
+# parent seed.
+
+import os
+import time
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from simul.creatures import Creature
+from simul.creatures import Moth
+from simul.creatures import Fly
+
+
+#
+# returns a copy of the simulation control that is cheap to send to another
+# process: same universe, costs, density factor, costs ledger and area
+# fraction, but a fresh world and no plotter
+def light_control(control):
+    world = control.world
+    light_world = type(world)(world.universe, fil=world.initial_lifespan[Fly], mil=world.initial_lifespan[Moth])
+    return type(control)(light_world, control.cost_fly, control.cost_moth,
+                         density_factor=control.density_factor,
+                         costs_ledger=control.costs_ledger,
+                         area_fraction=control.area_fraction)
+
+
+# draws one seed per job from the current (global) random generator
+def job_seeds(n_jobs):
+    return np.random.randint(low=0, high=2 ** 31 - 1, size=n_jobs)
+
+
+#
+# prepares a worker process to run simulations of a given control: the
+# creatures' universe is a class attribute, so it doesn't travel with the
+# pickled world and must be set again on the worker
+def prepare_worker(control, seed):
+    Creature.universe = control.world.universe
+    np.random.seed(seed)
+
+
+#
+# runs a simulation batch on a worker and returns its cost row, a dictionary
+# with the '_COST_COLUMNS' keys. If the control has a costs ledger, the row
+# is also appended to it (directly from the worker).
+def batch_cost_job(control, n_flies, n_moths, simul_time, n_simuls, seed):
+    prepare_worker(control, seed)
+    output_costs = 'mean' if control.costs_ledger is not None else 'none'
+    avg_simul_log = control.simulation_batch(n_flies, n_moths, simul_time, n_simuls,
+                                             output_costs=output_costs, lean=True)
+    return {
+        '#flies': n_flies,
+        '#moths': n_moths,
+        '#steps': simul_time,
+        '#simuls': n_simuls,
+        'cost': control.cost(avg_simul_log)
+    }
+
+
+def _star(args):
+    return args[0](*args[1:])
+
+
+#
+# runs 'fn(*job)' for each job of the list, on 'n_workers' processes (one per
+# cpu if None; serially if 1). Returns the results in the same order as the jobs.
+# The progress is reported to the telemetry object, if one is given.
+#
+# The serial jobs run on the caller's process: the random state, the
+# creatures' universe and the caterpillars list they change (see
+# 'prepare_worker()') are restored after each one of them
+def run_jobs(fn, jobs, n_workers=None, telemetry=None):
+    jobs = list(jobs)
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+    start_time = time.time()
+
+    if (n_workers == 1) or (len(jobs) <= 1):
+        results = []
+        for job in jobs:
+            random_state, universe, caterpillars = np.random.get_state(), Creature.universe, list(Moth.caterpillars)
+            try:
+                results.append(fn(*job))
+            finally:
+                np.random.set_state(random_state)
+                Creature.universe = universe
+                Moth.caterpillars[:] = caterpillars
+            if telemetry is not None:
+                telemetry.jobs_progress(len(results), len(jobs), time.time() - start_time, 1)
+        return results
+
+    n_workers = min([n_workers, len(jobs)])
+    with ProcessPoolExecutor(max_workers=n_workers) as pool:
+        if telemetry is None:
+            return list(pool.map(_star, [(fn,) + tuple(job) for job in jobs]))
+
+        futures = [pool.submit(fn, *job) for job in jobs]
+        for done, _ in enumerate(as_completed(futures)):
+            telemetry.jobs_progress(done + 1, len(jobs), time.time() - start_time, n_workers)
+        return [future.result() for future in futures]
+
+
+#
+# runs a single (lean) replicate on a worker and returns the 2D array with
+# its log values (columns on the universe's 'df_columns' order)
+def replicate_job(control, n_flies, n_moths, simul_time, seed):
+    prepare_worker(control, seed)
+    return control.run_world(n_flies, n_moths, simul_time, lean=True).values
+
+
+#
+# runs 'n_replicates' (lean) replicates on a worker and returns the list with
+# the cost of each one of them
+def replicate_costs_job(control, n_flies, n_moths, simul_time, n_replicates, seed):
+    prepare_worker(control, seed)
+    return [control.cost(control.run_world(n_flies, n_moths, simul_time, lean=True))
+            for _ in range(n_replicates)]
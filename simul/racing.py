@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+#
+# Racing selection of the number of flies with the minimal bayes cost. Instead
+# of giving all the 'n_simuls' replicates to every candidate #flies, the
+# replicates are run in rounds, for all the candidates still in the race. After
+# each round the bayes cost of each candidate is estimated with a confidence
+# interval, and the candidates whose interval lies entirely above the one of
+# the best candidate are dropped. The rounds go on, with the replicates
+# spared on the dropped candidates, until a single candidate is left or the
+# budget (the one of the full, non raced, evaluation) is spent.
+#
+# The bayes cost of a candidate is the weighted average, over the moth
+# densities, of its expected (simple) cost, so it is estimated from the mean
+# replicate costs of each density, weighted by poisson(n, A, p) * P(p) as on
+# 'funcs.bayes.bayes_cost()'.
+
+import numpy as np
+import pandas as pd
+
+from funcs.poisson import poisson
+from simul.parallel import light_control, job_seeds, replicate_costs_job, run_jobs
+
+_RACE_COLUMNS = ['#flies', 'bayes_cost', 'std_error', '#simuls', 'eliminated']
+
+
+#
+# normalized bayes weights of the moth densities for a sample. The densities
+# with the smallest weights, adding up to less than 'weight_tol', are left out
+# (they would take as many simulations as the others, for almost no effect on
+# the costs). Returns the list of (#moths, weight)
+def density_weights(control, p_data, sample_n_moths, sample_area, weight_tol=1e-3):
+    weights = np.array([poisson(sample_n_moths, sample_area, p) * prob
+                        for p, prob in zip(p_data['p'].values, p_data['P(p)'].values)])
+    weights = weights / weights.sum()
+
+    order = np.argsort(weights)
+    dropped = order[np.cumsum(weights[order]) < weight_tol]
+    kept = [idx for idx in range(len(weights)) if (idx not in dropped) and (weights[idx] > 0)]
+    total = weights[kept].sum()
+    return [(int(p_data['p'].values[idx] * control.density_factor), weights[idx] / total) for idx in kept]
+
+
+#
+# races the candidate #flies of 'n_flies_list' for the given sample.
+#    round_size : replicates per (#flies, density) on each round
+#    n_simuls   : replicates of the full evaluation, the budget of the race is
+#                 n_simuls * len(n_flies_list) replicates per density
+#    z          : width of the confidence intervals, in standard errors
+#    indifference : cost difference small enough not to matter. Candidates
+#                 whose interval is above the best one by less than this are
+#                 dropped too (the race may then pick a candidate up to this
+#                 much worse than the optimum, but ends much sooner)
+#
+# Returns the #flies with the minimal bayes cost and a dataframe with the
+# '_RACE_COLUMNS': the estimated bayes cost of each candidate, its standard
+# error, the replicates it got (per density) and the round on which it was
+# dropped (0 if it was never dropped)
+def race_bayes_cost(control, p_data, sample_n_moths, sample_area, n_flies_list, simul_time=200,
+                    n_simuls=50, round_size=5, z=3.0, indifference=0.0, weight_tol=1e-3, n_workers=None):
+    densities = density_weights(control, p_data, sample_n_moths, sample_area, weight_tol=weight_tol)
+    worker_control = light_control(control)
+    round_size = min([round_size, n_simuls])
+
+    n_flies_list = [int(n_flies) for n_flies in n_flies_list]
+    replicates = {(n_flies, n_moths): [] for n_flies in n_flies_list for n_moths, _ in densities}
+    eliminated = {n_flies: 0 for n_flies in n_flies_list}
+    alive = list(n_flies_list)
+    budget = n_simuls * len(n_flies_list)
+    spent = 0
+    n_round = 0
+
+    def estimate(n_flies):
+        mean = sum(weight * np.mean(replicates[(n_flies, n_moths)]) for n_moths, weight in densities)
+        var = sum((weight ** 2) * np.var(replicates[(n_flies, n_moths)], ddof=1) /
+                  len(replicates[(n_flies, n_moths)]) for n_moths, weight in densities)
+        return mean, np.sqrt(var)
+
+    while (len(alive) > 1) and (spent + round_size * len(alive) <= budget):
+        n_round += 1
+        pairs = [(n_flies, n_moths) for n_flies in alive for n_moths, _ in densities]
+        costs = run_jobs(replicate_costs_job,
+                         [(worker_control, n_flies, n_moths, simul_time, round_size, seed)
+                          for (n_flies, n_moths), seed in zip(pairs, job_seeds(len(pairs)))],
+                         n_workers=n_workers)
+        for pair, pair_costs in zip(pairs, costs):
+            replicates[pair] += pair_costs
+        spent += round_size * len(alive)
+
+        # at least two replicates are needed for the standard errors
+        if n_round * round_size < 2:
+            continue
+
+        estimates = {n_flies: estimate(n_flies) for n_flies in alive}
+        best = min(alive, key=lambda n_flies: estimates[n_flies][0] + z * estimates[n_flies][1])
+        best_upper = estimates[best][0] + z * estimates[best][1]
+        for n_flies in list(alive):
+            mean, std = estimates[n_flies]
+            if (n_flies != best) and (mean - z * std > best_upper - indifference):
+                alive.remove(n_flies)
+                eliminated[n_flies] = n_round
+        print('race round {}: {} candidates left, {} of {} replicates spent'.format(n_round, len(alive),
+                                                                                   spent, budget))
+
+    rows = []
+    for n_flies in n_flies_list:
+        n = len(replicates[(n_flies, densities[0][0])])
+        mean, std = estimate(n_flies) if n > 1 else (np.nan, np.nan)
+        rows.append([n_flies, mean, std, n, eliminated[n_flies]])
+    race = pd.DataFrame(data=rows, index=range(len(rows)), columns=_RACE_COLUMNS)
+
+    best = race[race['eliminated'] == 0].sort_values('bayes_cost')['#flies'].iloc[0]
+    return best, race
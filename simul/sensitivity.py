@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+#
+# Global sensitivity analysis of the simulation outputs (cost and final
+# populations) to the parameters of the universe.
+#
+# Design (Saltelli, 2010): two independent samples A and B of the varied
+# parameters (n rows each, on the given ranges, from a scrambled Sobol
+# sequence or from latin hypercubes) and, for each parameter i, the matrix
+# AB_i: A with the column i taken from B. The model is evaluated on the
+# n (k + 2) design points and, with Var(Y) the variance of the outputs on A
+# and B, the first and total order indices of each parameter are
+#    S_i  = mean(f(B) (f(AB_i) - f(A))) / Var(Y)
+#    ST_i = mean((f(A) - f(AB_i)) ^ 2) / (2 Var(Y))      (Jansen)
+# with bootstrap confidence intervals.
+#
+# Each design point is a universe (the control's one, with the varied
+# parameters replaced) and its outputs are the means over 'n_replicates'
+# simulations of the scenario. The k + 2 points of each row of the design
+# only differ on a parameter or two from each other, so they go to the same
+# worker job, which reuses its world and runs all of them from the same seeds
+# (common random numbers: the differences f(A) - f(AB_i) are much less noisy).
+#
+# The outputs of each point are cached by universe fingerprint and scenario
+# (on memory and, optionally, on a json-lines file), so a design that is
+# extended, or run again with other parameters ranges, only runs new points.
+
+import os
+import json
+import numpy as np
+import pandas as pd
+import scipy.stats.qmc as qmc
+
+from simul.universe import Universe
+from simul.creatures import Creature
+from simul.parallel import light_control, prepare_worker, job_seeds, run_jobs
+
+_OUTPUTS = ['cost', 'moth-living', 'fly-living']
+_INDICES_COLUMNS = ['parameter', 'output', 'S1', 'S1_conf', 'ST', 'ST_conf']
+
+
+#
+# evaluates a group of design points (dictionaries with the universe
+# parameters) on a worker, all with the same seeds. Returns the array with the
+# mean outputs ('_OUTPUTS') of each point. The control's universe (and the
+# creatures' one) are restored afterwards: the serial jobs run on the
+# caller's process, with the caller's control
+def sensitivity_job(control, points, n_flies, n_moths, simul_time, n_replicates, seed):
+    base_universe, creature_universe = control.world.universe, Creature.universe
+    try:
+        prepare_worker(control, seed)
+        seeds = job_seeds(n_replicates)
+        outputs = np.zeros([len(points), len(_OUTPUTS)])
+        for p, parameters in enumerate(points):
+            universe = Universe(**parameters)
+            control.world.universe = universe
+            Creature.universe = universe
+            for s in seeds:
+                np.random.seed(s)
+                data_log = control.run_world(n_flies, n_moths, simul_time, lean=True)
+                outputs[p] += [control.cost(data_log), data_log['moth-living'][-1], data_log['fly-living'][-1]]
+    finally:
+        control.world.universe = base_universe
+        Creature.universe = creature_universe
+    return outputs / n_replicates
+
+
+class SensitivityAnalysis:
+
+    # control      : simulation control (its universe gives the parameters not varied)
+    # ranges       : dictionary {universe parameter name: (low, high)}; the
+    #                parameters with integer bounds only take integer values
+    #                (ages, for instance)
+    # n_flies, n_moths, simul_time : scenario
+    # n_replicates : simulations per design point
+    # cache_file   : json-lines file with the outputs of the points already run
+    def __init__(self, control, ranges, n_flies, n_moths, simul_time=200, n_replicates=10, cache_file=None,
+                 n_workers=None):
+        unknown = [name for name in ranges if name not in Universe.parameter_names]
+        if unknown:
+            raise ValueError('unknown universe parameters: {}'.format(unknown))
+
+        self.control = light_control(control)
+        self.names = list(ranges)
+        self.low = np.array([ranges[name][0] for name in self.names], dtype=float)
+        self.high = np.array([ranges[name][1] for name in self.names], dtype=float)
+        self.integer = np.array([all(isinstance(x, (int, np.integer)) for x in ranges[name]) for name in self.names])
+        self.scenario = [int(n_flies), int(n_moths), int(simul_time), int(n_replicates),
+                         float(self.control.area_fraction), type(self.control.world).__name__]
+        self.n_workers = n_workers
+
+        self.cache = {}
+        self.cache_file = cache_file
+        if (cache_file is not None) and os.path.exists(cache_file):
+            with open(cache_file) as f:
+                for line in f:
+                    record = json.loads(line)
+                    self.cache[(record['universe'], tuple(record['scenario']))] = record['outputs']
+
+    #
+    # design matrices A and B (n rows, one column per varied parameter), from a
+    # scrambled Sobol sequence ('sobol', n rounded up to a power of 2) or from
+    # latin hypercubes ('lhs')
+    def design(self, n, method='sobol', seed=None):
+        k = len(self.names)
+        if method == 'sobol':
+            unit = qmc.Sobol(d=2 * k, scramble=True, seed=seed).random_base2(int(np.ceil(np.log2(n))))
+        elif method == 'lhs':
+            unit = qmc.LatinHypercube(d=2 * k, seed=seed).random(n)
+        else:
+            raise ValueError("unknown design method '{}' (expected 'sobol' or 'lhs')".format(method))
+        values = qmc.scale(unit, np.tile(self.low, 2), np.tile(self.high, 2) + np.tile(self.integer, 2))
+        values[:, np.tile(self.integer, 2)] = np.floor(values[:, np.tile(self.integer, 2)])
+        values = np.minimum(values, np.tile(self.high, 2))
+        return values[:, :k], values[:, k:]
+
+    # universe parameters of a point (values of the varied parameters)
+    def parameters(self, values):
+        parameters = dict(self.control.world.universe.parameters)
+        for name, value, integer in zip(self.names, values, self.integer):
+            parameters[name] = int(value) if integer else float(value)
+        return parameters
+
+    def key(self, parameters):
+        return Universe(**parameters).fingerprint(), tuple(self.scenario)
+
+    #
+    # mean outputs of groups of points (arrays of values of the varied
+    # parameters, the points of a group run on the same job). The points not
+    # on the cache are run in parallel
+    def evaluate(self, groups):
+        groups = [[self.parameters(values) for values in group] for group in groups]
+        jobs, pending = [], []
+        for group, seed in zip(groups, job_seeds(len(groups))):
+            missing = [parameters for parameters in group if self.key(parameters) not in self.cache]
+            if missing:
+                jobs.append((self.control, missing, self.scenario[0], self.scenario[1], self.scenario[2],
+                             self.scenario[3], seed))
+                pending.append(missing)
+
+        for missing, outputs in zip(pending, run_jobs(sensitivity_job, jobs, n_workers=self.n_workers)):
+            for parameters, output in zip(missing, outputs):
+                self.store(parameters, output.tolist())
+        return [np.array([self.cache[self.key(parameters)] for parameters in group]) for group in groups]
+
+    def store(self, parameters, outputs):
+        universe, scenario = self.key(parameters)
+        self.cache[(universe, scenario)] = outputs
+        if self.cache_file is not None:
+            with open(self.cache_file, 'a') as f:
+                f.write(json.dumps({'universe': universe, 'scenario': list(scenario), 'outputs': outputs,
+                                    'parameters': {name: parameters[name] for name in self.names}}) + '\n')
+
+    #
+    # runs the analysis with 'n' rows on the design ('design()'). Returns the
+    # dataframe with the first ('S1') and total ('ST') order indices of each
+    # parameter, for each output, and the half widths of their 95% bootstrap
+    # confidence intervals
+    def run(self, n=64, method='sobol', seed=None, n_bootstrap=200):
+        a, b = self.design(n, method=method, seed=seed)
+        k = len(self.names)
+
+        # row j of the design: A_j, B_j, AB_1j, ..., AB_kj
+        groups = []
+        for j in range(len(a)):
+            ab = np.tile(a[j], (k, 1))
+            ab[np.arange(k), np.arange(k)] = b[j, np.arange(k)]
+            groups.append(np.vstack([a[j], b[j], ab]))
+        outputs = np.array(self.evaluate(groups))
+        f_a, f_b, f_ab = outputs[:, 0], outputs[:, 1], outputs[:, 2:]
+
+        rows = []
+        resamples = np.random.randint(0, len(a), size=(n_bootstrap, len(a)))
+        for o, output in enumerate(_OUTPUTS):
+            s1, st = _sobol_indices(f_a[:, o], f_b[:, o], f_ab[:, :, o])
+            boot = [_sobol_indices(f_a[r, o], f_b[r, o], f_ab[r, :, o]) for r in resamples]
+            s1_conf = 1.96 * np.std([s for s, _ in boot], axis=0)
+            st_conf = 1.96 * np.std([t for _, t in boot], axis=0)
+            for i, name in enumerate(self.names):
+                rows.append([name, output, s1[i], s1_conf[i], st[i], st_conf[i]])
+        return pd.DataFrame(data=rows, columns=_INDICES_COLUMNS)
+
+
+#
+# first and total order indices of each parameter, from the outputs on A (n),
+# on B (n) and on the AB_i matrices (n, k)
+def _sobol_indices(f_a, f_b, f_ab):
+    variance = np.var(np.concatenate([f_a, f_b]))
+    if variance == 0:
+        return np.zeros(f_ab.shape[1]), np.zeros(f_ab.shape[1])
+    s1 = np.mean(f_b[:, None] * (f_ab - f_a[:, None]), axis=0) / variance
+    st = 0.5 * np.mean((f_a[:, None] - f_ab) ** 2, axis=0) / variance
+    return s1, st
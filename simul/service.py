@@ -0,0 +1,320 @@
+# -*- coding: utf-8 -*-
+#
+# Local simulation job service. Wraps a simulation control and serves, over a
+# unix socket (or a localhost tcp port), requests of:
+#    > 'simulate'  : runs a simulation batch and returns its cost and its
+#                    averaged log
+#    > 'bayes_cost': bayes costs for a list of #flies, running first (if
+#                    'auto_fill' is set) the simulation batches missing on
+#                    the control's costs ledger
+#
+# The work is queued onto a single process pool shared by all the clients,
+# and identical requests that are in flight at the same time are coalesced:
+# the simulation is run once and all of the clients that asked for it get
+# the same progress events and result. The missing batches of the bayes cost
+# requests are coalesced the same way, so two analysts sweeping overlapping
+# scenarios never simulate the same batch twice at the same time.
+#
+# Protocol: one json object per line, both ways. A request is
+#     {"id": <any>, "op": "simulate" | "bayes_cost", <parameters>}
+# and the service answers with a stream of events for that id,
+#     {"id": <id>, "event": "accepted" | "coalesced" | "progress" | "result" | "error", ...}
+# where "result" and "error" are always the last ones.
+
+import os
+import json
+import socket
+import asyncio
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from simul.log import SimulationLog
+from simul.parallel import light_control, job_seeds, batch_cost_job, replicate_job
+
+
+#
+# a job being executed by the service. Keeps the list of subscribers (one
+# queue per request attached to it) and broadcasts its events to all of them
+class _Job:
+
+    def __init__(self):
+        self.subscribers = []
+        self.task = None
+        self.error = None
+
+    def broadcast(self, event):
+        for queue in self.subscribers:
+            queue.put_nowait(event)
+
+
+class SimulationService:
+
+    # receives the simulation control to be served, the number of worker
+    # processes (one per cpu if None) and where to listen: a unix socket path
+    # or, if it is None, a localhost tcp port
+    def __init__(self, control, n_workers=None, socket_path='simul_service.sock', host='127.0.0.1', port=8765):
+        self.control = light_control(control)
+        self.n_workers = n_workers or os.cpu_count() or 1
+        self.socket_path = socket_path
+        self.host = host
+        self.port = port
+        self.pool = None
+        self.lookups = None
+        self.server = None
+        self.jobs = {}
+
+    #
+    # starts listening. The returned server must be kept running on the event
+    # loop (see 'serve_forever()')
+    async def start(self):
+        self.pool = ProcessPoolExecutor(max_workers=self.n_workers)
+        self.lookups = ThreadPoolExecutor(max_workers=1)
+        if self.socket_path is not None:
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+            self.server = await asyncio.start_unix_server(self.handle_client, path=self.socket_path)
+        else:
+            self.server = await asyncio.start_server(self.handle_client, host=self.host, port=self.port)
+        return self.server
+
+    async def serve_forever(self):
+        await self.start()
+        try:
+            async with self.server:
+                await self.server.serve_forever()
+        finally:
+            self.close()
+
+    def close(self):
+        if self.server is not None:
+            self.server.close()
+        if self.pool is not None:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+        if self.lookups is not None:
+            # (the ledger's connection of the lookups thread is closed there)
+            if self.control.costs_ledger is not None:
+                self.lookups.submit(self.control.costs_ledger.close)
+            self.lookups.shutdown(wait=False, cancel_futures=True)
+        if (self.socket_path is not None) and os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+    # runs the service until interrupted
+    def run(self):
+        try:
+            asyncio.run(self.serve_forever())
+        except KeyboardInterrupt:
+            pass
+
+    #
+    # reads the requests of a client (one per line) and streams back the
+    # events of each one of them. The requests of a client are served
+    # concurrently, so a client may have several requests in flight.
+    async def handle_client(self, reader, writer):
+        lock = asyncio.Lock()
+        streams = []
+
+        async def send(event):
+            async with lock:
+                writer.write((json.dumps(event) + '\n').encode('utf-8'))
+                await writer.drain()
+
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    request = json.loads(line)
+                except ValueError as e:
+                    await send({'id': None, 'event': 'error', 'error': 'invalid request: {}'.format(e)})
+                    continue
+                streams.append(asyncio.ensure_future(self.stream(request, send)))
+            if streams:
+                await asyncio.gather(*streams)
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    #
+    # attaches a request to its job (a new one, or the identical one already in
+    # flight) and sends the job events to the client until it is done
+    async def stream(self, request, send):
+        request_id = request.pop('id', None)
+        op = request.pop('op', None)
+        handlers = {'simulate': self.simulate, 'bayes_cost': self.bayes_cost}
+        if op not in handlers:
+            await send({'id': request_id, 'event': 'error', 'error': 'unknown operation {!r}'.format(op)})
+            return
+
+        queue = asyncio.Queue()
+        key = (op, json.dumps(request, sort_keys=True))
+        coalesced = key in self.jobs
+        job = self.attach(key, queue, lambda job: handlers[op](job, **request))
+
+        await send({'id': request_id, 'event': 'coalesced' if coalesced else 'accepted'})
+        while True:
+            event = await queue.get()
+            await send(dict(event, id=request_id))
+            if event['event'] in ['result', 'error']:
+                break
+        job.subscribers.remove(queue)
+
+    #
+    # returns the job of the given key, creating (and starting) it if there is
+    # none in flight. 'run' receives the job and returns the coroutine that
+    # executes it and returns its result.
+    def attach(self, key, queue, run):
+        job = self.jobs.get(key)
+        if job is None:
+            job = _Job()
+            self.jobs[key] = job
+            job.task = asyncio.ensure_future(self.execute(key, job, run))
+        if queue is not None:
+            job.subscribers.append(queue)
+        return job
+
+    async def execute(self, key, job, run):
+        try:
+            result = await run(job)
+            job.broadcast({'event': 'result', 'result': result})
+            return result
+        except Exception as e:
+            job.error = '{}: {}'.format(type(e).__name__, e)
+            job.broadcast({'event': 'error', 'error': job.error})
+        finally:
+            del self.jobs[key]
+
+    # submits a function to the process pool
+    def submit(self, fn, *args):
+        return asyncio.get_running_loop().run_in_executor(self.pool, fn, *args)
+
+    #
+    # runs a (blocking) costs ledger lookup off the event loop, on the lookups
+    # thread (a single one, with its own connection to the ledger)
+    def lookup(self, fn, *args, **kwargs):
+        return asyncio.get_running_loop().run_in_executor(self.lookups, lambda: fn(*args, **kwargs))
+
+    #
+    # simulation batch, one pool task per replicate. Returns the cost and the
+    # averaged log (dictionary column: list of values)
+    async def simulate(self, job, n_flies, n_moths, simul_time, n_simuls):
+        columns = self.control.world.universe.df_columns
+        avg_simul_log = SimulationLog.zeros(simul_time + 1, columns)
+        replicates = [self.submit(replicate_job, self.control, n_flies, n_moths, simul_time, seed)
+                      for seed in job_seeds(n_simuls)]
+
+        for i, replicate in enumerate(asyncio.as_completed(replicates)):
+            avg_simul_log = avg_simul_log + SimulationLog(await replicate, columns)
+            job.broadcast({'event': 'progress', 'done': i + 1, 'total': n_simuls})
+
+        avg_simul_log = avg_simul_log / n_simuls
+        self.control.world.n_flies = n_flies
+        return {
+            'cost': float(self.control.cost(avg_simul_log)),
+            'log': {col: avg_simul_log[col].tolist() for col in columns}
+        }
+
+    #
+    # bayes costs of a sample for a list of #flies. 'densities' is the list of
+    # [p, P(p)] pairs (as on the 'Densidades.csv' data file). Needs a control
+    # with a costs ledger, where the missing batches are recorded. Only the
+    # costs of simulations of 'simul_time' steps are used.
+    async def bayes_cost(self, job, densities, sample_n_moths, sample_area, n_flies_list,
+                         auto_fill=False, simul_time=200, n_simuls=50):
+        control = self.control
+        if control.costs_ledger is None:
+            raise ValueError('the bayes cost requests need a control with a costs ledger')
+
+        p_data = pd.DataFrame(data=densities, columns=['p', 'P(p)'])
+        missing = await self.lookup(control.missing_simulations, p_data, n_flies_list, n_steps=simul_time)
+        if len(missing):
+            if not auto_fill:
+                return {'success': False, 'missing': missing.to_dict(orient='list')}
+
+            # each missing batch is a job of its own, so it is coalesced with
+            # the identical batches needed by other requests
+            batches = []
+            for (n_flies, n_moths), seed in zip(missing.values.tolist(), job_seeds(len(missing))):
+                params = {'n_flies': n_flies, 'n_moths': n_moths, 'simul_time': simul_time, 'n_simuls': n_simuls}
+                batches.append(self.attach(('batch_cost', json.dumps(params, sort_keys=True)), None,
+                                           lambda _, params=params, seed=seed: self.submit(
+                                               batch_cost_job, control, params['n_flies'], params['n_moths'],
+                                               params['simul_time'], params['n_simuls'], seed)))
+
+            for i, batch in enumerate(asyncio.as_completed([batch.task for batch in batches])):
+                await batch
+                job.broadcast({'event': 'progress', 'done': i + 1, 'total': len(batches)})
+
+            errors = [batch.error for batch in batches if batch.error is not None]
+            if errors:
+                raise RuntimeError('missing simulation batch failed ({})'.format(errors[0]))
+
+        _, costs = await self.lookup(control.bayes_cost_function, p_data, sample_n_moths, sample_area, n_flies_list,
+                                     n_steps=simul_time)
+        return {'success': True, 'bayes_cost': costs.to_dict(orient='list')}
+
+
+class SimulationClient:
+
+    # connects to a simulation service, on a unix socket or on a tcp port
+    def __init__(self, socket_path='simul_service.sock', host='127.0.0.1', port=8765):
+        if socket_path is not None:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.connect(socket_path)
+        else:
+            self.sock = socket.create_connection((host, port))
+        self.file = self.sock.makefile('rw', encoding='utf-8')
+        self.n_requests = 0
+
+    def close(self):
+        self.file.close()
+        self.sock.close()
+
+    #
+    # sends a request and yields its events (dictionaries) as they arrive,
+    # up to (and including) the final 'result' or 'error' event
+    def events(self, op, **params):
+        self.n_requests += 1
+        request_id = self.n_requests
+        self.file.write(json.dumps(dict(params, id=request_id, op=op), default=_to_json) + '\n')
+        self.file.flush()
+        while True:
+            line = self.file.readline()
+            if not line:
+                raise ConnectionError('the simulation service closed the connection')
+            event = json.loads(line)
+            yield event
+            if event['event'] in ['result', 'error']:
+                return
+
+    #
+    # sends a request and waits for its result. 'progress' is an optional
+    # function called with each one of the progress events
+    def request(self, op, progress=None, **params):
+        for event in self.events(op, **params):
+            if (event['event'] == 'progress') and (progress is not None):
+                progress(event)
+            if event['event'] == 'error':
+                raise RuntimeError(event['error'])
+            if event['event'] == 'result':
+                return event['result']
+
+    def simulate(self, n_flies, n_moths, simul_time, n_simuls, progress=None):
+        return self.request('simulate', progress=progress, n_flies=n_flies, n_moths=n_moths,
+                            simul_time=simul_time, n_simuls=n_simuls)
+
+    def bayes_cost(self, p_data, sample_n_moths, sample_area, n_flies_list, auto_fill=False,
+                   simul_time=200, n_simuls=50, progress=None):
+        return self.request('bayes_cost', progress=progress, densities=p_data[['p', 'P(p)']].values.tolist(),
+                            sample_n_moths=sample_n_moths, sample_area=sample_area,
+                            n_flies_list=list(n_flies_list), auto_fill=auto_fill,
+                            simul_time=simul_time, n_simuls=n_simuls)
+
+
+# json conversion of the numpy scalars that show up on the request parameters
+def _to_json(obj):
+    if isinstance(obj, np.generic):
+        return obj.item()
+    raise TypeError('{!r} is not json serializable'.format(obj))
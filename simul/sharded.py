@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+#
+# Sharded world: a single (very large) simulation of the 'WonderfulWorld',
+# with its creatures split among 'n_shards' worker processes. Each shard is a
+# world of its own, with a part of the initial flies and moths (and their
+# descendants), that ages, kills and breeds its creatures independently. The
+# caterpillars list of the moths is a class attribute, so the shards must be
+# processes (each one with its own list), not threads.
+#
+# The only interaction between the creatures is the predation, which depends
+# on the whole field: a fly that dies of old age (fertile female) preys on a
+# caterpillar with chance
+#    predation_coefficient * #caterpillars / #flies
+# where the counts are the ones of the whole field, and the caterpillar is
+# drawn among all of them. So each day goes through a barrier:
+#    > each shard processes its flies (random and old age deaths) and sends
+#      the number of candidate predators (fertile females that died of old
+#      age), with its numbers of flies and caterpillars at the start of the day
+#    > the parent process rolls the predations of all of the candidates, one
+#      after the other, as on 'WonderfulWorld.single_step()' (each predation
+#      takes a caterpillar out of the next ones' chances), and splits the
+#      successful predators and their victims among the shards, with
+#      multivariate hypergeometric draws (any subset of the candidates, and of
+#      the caterpillars, is equally likely, as on the serial world)
+#    > each shard breeds its predators, kills its victims, processes its moths
+#      and sends the counts of the day, that add up to the log of the field
+# The results have the same distribution as the ones of the 'WonderfulWorld',
+# though not the same random numbers.
+
+import os
+import traceback
+import numpy as np
+import multiprocessing as mp
+
+from simul.creatures import Creature
+from simul.creatures import Moth
+from simul.creatures import Fly
+from simul.log import SimulationLog
+from simul.world import WonderfulWorld, StepRecord
+from simul.stream import StreamingLogWriter, open_streamed_log
+
+
+#
+# number of each color on a draw of 'n' balls, without replacement, from an urn
+# with 'counts' balls of each color (one color at a time, each one a plain
+# hypergeometric draw among the balls left)
+def multivariate_hypergeometric(counts, n):
+    draws = []
+    remaining = int(sum(counts))
+    for count in counts:
+        k = 0
+        if (n > 0) and (count > 0):
+            k = n if count == remaining else int(np.random.hypergeometric(count, remaining - count, n))
+        draws.append(k)
+        n -= k
+        remaining -= count
+    return draws
+
+
+#
+# number of predations of a day: each candidate preys with the ratio-based
+# chance, with the caterpillars left by the previous ones
+def resolve_predations(n_candidates, n_caterpillars, n_flies, coefficient):
+    victims = 0
+    for u in np.random.uniform(size=n_candidates).tolist():
+        if u < coefficient * (n_caterpillars - victims) / n_flies:
+            victims += 1
+    return victims
+
+
+#
+# runs a shard (on its own process): a world with its part of the creatures,
+# stepping through the days with the parent. The messages to the parent are
+# pairs (kind, content): the counts of the day ('row'), the predation figures
+# of the day ('day') or the error, if any
+def shard_process(universe, fil, mil, n_flies, n_moths, end_of_times, uniforms, conn, seed):
+    try:
+        Creature.universe = universe
+        np.random.seed(seed)
+        world = ShardedWorld(universe, fil=fil, mil=mil, n_shards=1)
+        world.initial_age_uniforms = uniforms
+        world.n_flies = n_flies
+        world.n_moths = n_moths
+        world.initialize_world(end_of_times, chunk_size=1, rolling=True)
+        record = StepRecord(world)
+        conn.send(('row', record.values()))
+
+        for _ in range(end_of_times):
+            n_flies, n_caterpillars = len(world.creatures[Fly]), len(Moth.caterpillars)
+            candidates = world.fly_phase()
+            conn.send(('day', (len(candidates), n_caterpillars, n_flies)))
+            n_predators, n_victims = conn.recv()
+            world.predation_phase(candidates, n_predators, n_victims)
+            world.moth_phase()
+            conn.send(('row', record.values()))
+    except Exception:
+        conn.send(('error', traceback.format_exc()))
+    finally:
+        conn.close()
+
+
+def _receive(conn, index):
+    kind, content = conn.recv()
+    if kind == 'error':
+        raise RuntimeError('shard {} failed:\n{}'.format(index, content))
+    return content
+
+
+class ShardedWorld(WonderfulWorld):
+
+    # same as the 'WonderfulWorld', with the number of shards (one per cpu if
+    # None). Only 'run_world()' is sharded: the step iterator and the
+    # snapshots are the ones of the serial world
+    def __init__(self, universe, fil=None, mil=None, n_shards=None):
+        super().__init__(universe, fil=fil, mil=mil)
+        self.n_shards = n_shards if n_shards is not None else (os.cpu_count() or 1)
+
+    #
+    # first part of a day on a shard ('WonderfulWorld.single_step()' up to the
+    # predations): the deaths and aging of the flies. Returns the candidate
+    # predators (fertile females that died of old age)
+    def fly_phase(self):
+        self.instant = self.instant + 1
+        self.advance_log()
+
+        candidates = []
+        for fly in self.creatures[Fly]:
+            if not self.random_death(fly):
+                if self.old_age_death(fly):
+                    if fly.can_procreate():
+                        candidates.append(fly)
+                else:
+                    fly.increment_age()
+            self.log_creature(fly)
+        return candidates
+
+    # predations of the shard: random predators among the candidates, random victims among the caterpillars
+    def predation_phase(self, candidates, n_predators, n_victims):
+        for k in np.random.choice(len(candidates), size=n_predators, replace=False).tolist():
+            self.iteration_data[Fly]['predation'][self.log_idx] += 1
+            self.procreate(candidates[k])
+
+        victims = np.random.choice(len(Moth.caterpillars), size=n_victims, replace=False).tolist()
+        for caterpillar in [Moth.caterpillars[k] for k in victims]:
+            self.kill(caterpillar)
+        self.iteration_data[Moth]['dead'][self.log_idx] += n_victims
+
+    # rest of the day on a shard, as on 'WonderfulWorld.single_step()'
+    def moth_phase(self):
+        self.update_list(Fly)
+        self.update_list(Moth)
+        for moth in self.creatures[Moth]:
+            if not self.random_death(moth):
+                if self.old_age_death(moth):
+                    if moth.can_procreate():
+                        self.procreate(moth)
+                else:
+                    moth.increment_age()
+            self.log_creature(moth)
+        self.update_list(Moth)
+
+    #
+    # runs the world on the shards (see 'WonderfulWorld.run_world()', the log
+    # is the sum of the logs of the shards). The initial creatures are split
+    # as evenly as possible among the shards (and so are the uniform numbers
+    # of their initial ages, on a replicate design)
+    def run_world(self, n_flies, n_moths, end_of_times, lean=False, stream_to=None, chunk_size=4096):
+        self.n_moths = n_moths
+        self.n_flies = n_flies
+        columns = self.universe.df_columns
+
+        n_shards = max([1, min([self.n_shards, max([n_flies, n_moths, 1])])])
+        shard_flies = [len(part) for part in np.array_split(np.arange(n_flies), n_shards)]
+        shard_moths = [len(part) for part in np.array_split(np.arange(n_moths), n_shards)]
+        shard_uniforms = [{Moth: None, Fly: None} for _ in range(n_shards)]
+        for creature_type, counts in [(Moth, shard_moths), (Fly, shard_flies)]:
+            uniforms = self.initial_age_uniforms[creature_type]
+            if uniforms is not None:
+                offsets = np.cumsum([0] + counts)
+                for s in range(n_shards):
+                    shard_uniforms[s][creature_type] = uniforms[offsets[s]:offsets[s + 1]]
+
+        seeds = np.random.randint(low=0, high=2 ** 31 - 1, size=n_shards)
+        conns, processes = [], []
+        for s in range(n_shards):
+            parent_conn, child_conn = mp.Pipe()
+            conns.append(parent_conn)
+            processes.append(mp.Process(target=shard_process,
+                                        args=(self.universe, self.initial_lifespan[Fly], self.initial_lifespan[Moth],
+                                              shard_flies[s], shard_moths[s], end_of_times, shard_uniforms[s],
+                                              child_conn, seeds[s])))
+        for process in processes:
+            process.start()
+
+        values = np.zeros([end_of_times + 1, len(columns)])
+        try:
+            values[0] = np.sum([_receive(conn, s) for s, conn in enumerate(conns)], axis=0)
+            for t in range(1, end_of_times + 1):
+                days = [_receive(conn, s) for s, conn in enumerate(conns)]
+                candidates = [n_candidates for n_candidates, _, _ in days]
+                caterpillars = [n_caterpillars for _, n_caterpillars, _ in days]
+                n_victims = resolve_predations(sum(candidates), sum(caterpillars), sum([f for _, _, f in days]),
+                                               self.universe.predation_coefficient)
+                for conn, n_predators, victims in zip(conns, multivariate_hypergeometric(candidates, n_victims),
+                                                      multivariate_hypergeometric(caterpillars, n_victims)):
+                    conn.send((n_predators, victims))
+                values[t] = np.sum([_receive(conn, s) for s, conn in enumerate(conns)], axis=0)
+            for process in processes:
+                process.join()
+        finally:
+            for process in processes:
+                if process.is_alive():
+                    process.terminate()
+                    process.join()
+        self.instant = end_of_times
+
+        if stream_to is not None:
+            log_writer = StreamingLogWriter(stream_to, columns)
+            for a in range(0, end_of_times + 1, chunk_size):
+                log_writer.append(values[a:a + chunk_size])
+            log_writer.close()
+            return open_streamed_log(stream_to)
+
+        data_log = SimulationLog(values, columns)
+        return data_log if lean else data_log.to_dataframe()
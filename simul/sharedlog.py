@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+#
+# Shared memory transport of replicate logs. When the replicates of a batch
+# run on worker processes, each worker writes its log straight into its slice
+# of a shared memory block, laid out as (replicate, step, column), instead of
+# sending it back pickled. The parent then reduces the block (mean, variance,
+# costs) in place with numpy, without copying the replicates.
+
+import numpy as np
+from multiprocessing import shared_memory
+
+from simul.log import SimulationLog
+from simul.parallel import light_control, prepare_worker, job_seeds, run_jobs
+
+
+class SharedLogBlock:
+
+    #
+    # creates a block for 'n_replicates' logs of 'rows' steps and the given
+    # columns, or attaches to an existing one (given its name)
+    def __init__(self, n_replicates, rows, columns, name=None):
+        self.columns = list(columns)
+        self.shape = (n_replicates, rows, len(self.columns))
+        size = int(np.prod(self.shape)) * np.dtype(float).itemsize
+        if name is None:
+            self.shm = shared_memory.SharedMemory(create=True, size=max([1, size]))
+            self.owner = True
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+            self.owner = False
+        self.array = np.ndarray(self.shape, dtype=float, buffer=self.shm.buf)
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def __len__(self):
+        return self.shape[0]
+
+    # log of a replicate (a view on the block)
+    def replicate(self, i):
+        return SimulationLog(self.array[i], self.columns)
+
+    def mean(self):
+        return SimulationLog(self.array.mean(axis=0), self.columns)
+
+    def var(self, ddof=1):
+        return SimulationLog(self.array.var(axis=0, ddof=ddof), self.columns)
+
+    # cost of each replicate, with the given control
+    def costs(self, control):
+        return np.array([control.cost(self.replicate(i)) for i in range(len(self))])
+
+    #
+    # releases the block. The array views must not be used afterwards; the
+    # block is destroyed when its creator closes it
+    def close(self):
+        self.array = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+#
+# runs a replicate on a worker and writes its log on its slice of the block
+def shared_replicate_job(control, name, shape, i, n_flies, n_moths, simul_time, seed):
+    prepare_worker(control, seed)
+    block = SharedLogBlock(shape[0], shape[1], control.world.universe.df_columns, name=name)
+    try:
+        block.array[i] = control.run_world(n_flies, n_moths, simul_time, lean=True).values
+    finally:
+        block.close()
+
+
+#
+# runs the 'n_simuls' replicates of a batch on 'n_workers' processes, writing
+# their logs on a new shared memory block. Returns the block (to be closed by
+# the caller)
+def run_shared_replicates(control, n_flies, n_moths, simul_time, n_simuls, n_workers=None, telemetry=None):
+    block = SharedLogBlock(n_simuls, simul_time + 1, control.world.universe.df_columns)
+    try:
+        worker_control = light_control(control)
+        run_jobs(shared_replicate_job,
+                 [(worker_control, block.name, block.shape, i, n_flies, n_moths, simul_time, seed)
+                  for i, seed in enumerate(job_seeds(n_simuls))],
+                 n_workers=n_workers, telemetry=telemetry)
+    except Exception:
+        block.close()
+        raise
+    return block
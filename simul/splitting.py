@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+#
+# Multilevel splitting estimator of rare event probabilities: the chance that
+# a count of the log crosses a threshold before the end of the simulation, as
+# the caterpillars going over an outbreak threshold ('up') or the flies dying
+# out ('down', threshold 0).
+#
+# The rare event is reached through a sequence of intermediate levels of the
+# same count, L_1 < L_2 < ... < L_m (the last one is the threshold of the
+# event; decreasing, for 'down'). Fixed effort splitting (Garvels, 2000):
+#    > stage 1: 'n_trials' replicates run from the start, each one until its
+#      count reaches L_1 (a hit, its world is saved, see
+#      'WonderfulWorld.snapshot()') or the simulation ends
+#    > stage k: 'n_trials' replicates start from clones of the worlds saved on
+#      stage k - 1 (the same number of clones of each one, the rest drawn at
+#      random) and run until L_k or the end
+# The world state holds the instant, so the clones only have the time left to
+# get there. With p_k the fraction of hits of the stage k, the probability of
+# the event is estimated by
+#    p = p_1 p_2 ... p_m
+# which is unbiased. The levels should be spaced so each p_k is around 0.1-0.3
+# (see the stages dataframe of 'estimate()'): each stage then costs about as
+# much as a stage of crude Monte Carlo that only needs to see a common event.
+#
+# The whole procedure is repeated 'n_repetitions' times, independently (on
+# the worker processes), and the confidence interval of the probability comes
+# from the spread of the repetitions.
+#
+# The clones only help if their futures are different enough: if the event is
+# mostly decided by the time a level is crossed, the hits of the last stages
+# descend from a couple of worlds of the first one (the 'lineages' of the
+# stages dataframe) and the estimate is hardly better than crude Monte Carlo.
+# In particular, the 'EventWorld' draws the death days of its creatures when
+# they are born, so its clones share them: use the 'WonderfulWorld' (which
+# rolls the random deaths every day) for splitting.
+
+import numpy as np
+import pandas as pd
+import scipy.stats as stats
+
+from simul.world import StepRecord
+from simul.parallel import light_control, prepare_worker, job_seeds, run_jobs
+
+_STAGE_COLUMNS = ['level', 'trials', 'hits', 'p', 'lineages']
+
+
+#
+# runs a repetition of the splitting on a worker. Returns the arrays with the
+# hits of each stage (zero from the first stage without hits on) and with the
+# lineages of the hits (the different worlds of the first stage they are
+# clones of), and the number of steps simulated. With a single level, it is
+# crude Monte Carlo
+def splitting_job(control, column, levels, direction, n_flies, n_moths, simul_time, n_trials, seed):
+    prepare_worker(control, seed)
+    world = control.world
+    record = StepRecord(world, 1.0 / control.area_fraction)
+    sign = 1 if direction == 'up' else -1
+    hits = np.zeros(len(levels), dtype=int)
+    lineages = np.zeros(len(levels), dtype=int)
+    steps = 0
+
+    starts = None
+    for k, level in enumerate(levels):
+        reached = []
+        for i in range(n_trials):
+            if starts is None:
+                next(control.iter_steps(n_flies, n_moths, simul_time))
+                lineage = i
+            else:
+                world.restore(starts[i][0])
+                lineage = starts[i][1]
+            while (sign * record[column] < sign * level) and (world.instant < simul_time):
+                world.single_step()
+                steps += 1
+            if sign * record[column] >= sign * level:
+                reached.append((world.snapshot(), lineage))
+
+        hits[k] = len(reached)
+        lineages[k] = len(set([lineage for _, lineage in reached]))
+        if not reached:
+            break
+        starts = _clones(reached, n_trials)
+    return hits, lineages, steps
+
+
+# starting worlds of the next stage: 'n' clones of the saved worlds, as evenly as possible
+def _clones(reached, n):
+    copies = [n // len(reached)] * len(reached)
+    for i in np.random.choice(len(reached), size=n % len(reached), replace=False):
+        copies[i] += 1
+    return [start for start, c in zip(reached, copies) for _ in range(c)]
+
+
+class RareEventSplitting:
+
+    # control       : simulation control (world, universe and area fraction)
+    # column        : log column of the count ('moth-caterpillars', 'fly-living', ...)
+    # levels        : intermediate levels of the count, the last one is the event
+    # direction     : 'up' (the count gets over the levels) or 'down' (under them)
+    # n_trials      : replicates of each stage
+    # n_repetitions : independent repetitions of the splitting
+    def __init__(self, control, column, levels, direction='up', n_trials=100, n_repetitions=10, n_workers=None):
+        if column not in control.world.universe.df_columns:
+            raise ValueError("unknown log column '{}'".format(column))
+        if direction not in ['up', 'down']:
+            raise ValueError("unknown direction '{}' (expected 'up' or 'down')".format(direction))
+        sign = 1 if direction == 'up' else -1
+        if np.any(np.diff(sign * np.asarray(levels, dtype=float)) <= 0):
+            raise ValueError('the levels must be strictly {}'.format('increasing' if sign > 0 else 'decreasing'))
+
+        self.control = light_control(control)
+        self.column = column
+        self.levels = list(levels)
+        self.direction = direction
+        self.n_trials = n_trials
+        self.n_repetitions = n_repetitions
+        self.n_workers = n_workers
+
+    #
+    # estimates the probability of the event on the scenario. Returns the
+    # probability, its confidence interval (low, high) and the dataframe with
+    # the hits of each stage (all repetitions together). The dataframe's attrs
+    # hold the standard error, the estimate of each repetition, the steps
+    # simulated and the crude Monte Carlo replicates (and steps) it would take
+    # to get the same standard error
+    def estimate(self, n_flies, n_moths, simul_time, confidence=0.95):
+        jobs = [(self.control, self.column, self.levels, self.direction, n_flies, n_moths, simul_time,
+                 self.n_trials, seed) for seed in job_seeds(self.n_repetitions)]
+        results = run_jobs(splitting_job, jobs, n_workers=self.n_workers)
+        hits = np.array([h for h, _, _ in results])
+        lineages = np.array([g for _, g, _ in results])
+        steps = int(sum([s for _, _, s in results]))
+
+        estimates = np.prod(hits / self.n_trials, axis=1)
+        probability = float(np.mean(estimates))
+        if self.n_repetitions > 1:
+            std_error = float(np.std(estimates, ddof=1) / np.sqrt(self.n_repetitions))
+            quantile = stats.t.ppf(0.5 + confidence / 2, self.n_repetitions - 1)
+        else:
+            # asymptotic relative variance of fixed effort splitting, sum (1 - p_k) / (n p_k)
+            p = hits[0] / self.n_trials
+            std_error = (float(probability * np.sqrt(np.sum((1 - p) / (self.n_trials * p))))
+                         if probability > 0 else np.nan)
+            quantile = stats.norm.ppf(0.5 + confidence / 2)
+        interval = (max([0.0, probability - quantile * std_error]), min([1.0, probability + quantile * std_error]))
+
+        # (the stages after the first one without hits don't run)
+        trials = self.n_trials * np.sum(np.hstack([np.ones([len(hits), 1], dtype=int),
+                                                   np.cumprod(hits[:, :-1] > 0, axis=1)]), axis=0)
+        stages = pd.DataFrame(data={'level': self.levels, 'trials': trials, 'hits': hits.sum(axis=0),
+                                    'p': hits.sum(axis=0) / np.maximum(trials, 1),
+                                    'lineages': lineages.mean(axis=0)},
+                              columns=_STAGE_COLUMNS)
+        crude_replicates = probability * (1 - probability) / std_error ** 2 if std_error > 0 else np.nan
+        stages.attrs = {
+            'std_error': std_error,
+            'estimates': estimates.tolist(),
+            'steps': steps,
+            'crude_replicates': crude_replicates,
+            'crude_steps': crude_replicates * simul_time
+        }
+        return probability, interval, stages
+
+    #
+    # crude Monte Carlo estimate of the same probability, from 'n_replicates'
+    # plain replicates (each one stops as soon as it reaches the event). Returns
+    # the probability, its standard error and the number of steps simulated
+    def crude(self, n_flies, n_moths, simul_time, n_replicates):
+        n_jobs = min([n_replicates, max([1, self.n_repetitions])])
+        sizes = [len(rows) for rows in np.array_split(np.arange(n_replicates), n_jobs)]
+        jobs = [(self.control, self.column, self.levels[-1:], self.direction, n_flies, n_moths, simul_time,
+                 size, seed) for size, seed in zip(sizes, job_seeds(n_jobs))]
+        results = run_jobs(splitting_job, jobs, n_workers=self.n_workers)
+        probability = sum([int(h[0]) for h, _, _ in results]) / n_replicates
+        return (probability, np.sqrt(probability * (1 - probability) / n_replicates),
+                int(sum([s for _, _, s in results])))
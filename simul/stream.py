@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+#
+# Streamed simulation logs, for very long horizons. Instead of keeping the
+# whole log in memory, the world keeps only a fixed-size buffer of steps
+# (chunk) and flushes it, whenever it is full, to an appendable binary file.
+#
+# File format:
+#    > <path>      : raw float64 values, one row per step, one column per
+#                    entry of the universe's 'df_columns' (C order)
+#    > <path>.json : header, with the column names, the dtype and the number
+#                    of rows written
+#
+# The logs are read back as memory-mapped 'SimulationLog' objects: the
+# operating system only brings to memory the parts that are actually used.
+
+import os
+import json
+import numpy as np
+
+from simul.log import SimulationLog
+
+_STREAM_DTYPE = '<f8'
+
+
+class StreamingLogWriter:
+
+    # creates (or truncates) the log file at 'path', with the given columns
+    def __init__(self, path, columns):
+        self.path = path
+        self.columns = list(columns)
+        self.rows = 0
+        self.file = open(path, 'wb')
+        self.write_header()
+
+    def write_header(self):
+        with open(self.path + '.json.tmp', 'w') as f:
+            json.dump({'columns': self.columns, 'dtype': _STREAM_DTYPE, 'rows': self.rows}, f)
+        os.replace(self.path + '.json.tmp', self.path + '.json')
+
+    # appends a block of rows (2D array, columns on the writer's order)
+    def append(self, values):
+        np.ascontiguousarray(values, dtype=_STREAM_DTYPE).tofile(self.file)
+        self.rows += len(values)
+
+    def close(self):
+        if not self.file.closed:
+            self.file.close()
+            self.write_header()
+
+
+#
+# opens a streamed log as a memory-mapped 'SimulationLog'. If the header
+# doesn't have the final number of rows (the writer didn't finish), it is
+# taken from the file size. 'mode' is the numpy memmap mode ('r', 'r+', ...)
+def open_streamed_log(path, mode='r'):
+    with open(path + '.json') as f:
+        header = json.load(f)
+    n_cols = len(header['columns'])
+    rows = os.path.getsize(path) // (np.dtype(header['dtype']).itemsize * n_cols)
+    if rows == 0:
+        return SimulationLog(np.zeros([0, n_cols]), header['columns'])
+    values = np.memmap(path, dtype=header['dtype'], mode=mode, shape=(rows, n_cols))
+    return SimulationLog(values, header['columns'])
+
+
+#
+# creates a zeroed streamed log with the given number of rows, opened as a
+# writable memory-mapped 'SimulationLog' (used for the running averages)
+def create_streamed_log(path, rows, columns):
+    with open(path, 'wb') as f:
+        f.truncate(rows * len(columns) * np.dtype(_STREAM_DTYPE).itemsize)
+    writer = StreamingLogWriter.__new__(StreamingLogWriter)
+    writer.path = path
+    writer.columns = list(columns)
+    writer.rows = rows
+    writer.write_header()
+    return open_streamed_log(path, mode='r+')
@@ -0,0 +1,315 @@
+# -*- coding: utf-8 -*-
+#
+# Distributed simulation sweeps over a shared filesystem (NFS, for instance),
+# without any broker. A sweep ('run_some_batches'-like: a list of initial
+# populations, each one simulated 'n_simuls' times) is split into jobs of
+# (#flies, #moths, block of replicates), written as files on a shared
+# directory. Any number of workers, on any number of machines, claim and run
+# them:
+#
+#    shared_dir / jobs   / <job>.json   job description (populations, steps,
+#                                       replicates, universe, area fraction
+#                                       and seed). The name of a job holds all
+#                                       of the sweep's settings (populations,
+#                                       steps, replicates, block size, universe
+#                                       and area fraction), so a sweep
+#                                       submitted again with other settings
+#                                       never reuses the jobs (or shards) of
+#                                       the previous one
+#    shared_dir / leases / <job>.lease  claim of a job by a worker. Created
+#                                       atomically (O_EXCL); the worker keeps
+#                                       touching it (heartbeat) while it runs
+#    shared_dir / shards / <job>.npz    results of a finished job: the sum of
+#                                       its replicate logs and their costs
+#
+# A lease that wasn't touched for more than 'lease_timeout' seconds belongs
+# to a crashed (or disconnected) worker: it is taken over by the first worker
+# that renames it away (renames are atomic, only one of them succeeds) and
+# finds it still expired (its owner may have renewed it after the first look;
+# if so, it is put back), and the job is run again. Each job has its own
+# seed, so a job run twice gives the same shard. The final reduce step merges
+# the shards into the costs (and, optionally, the averaged logs) of each pair
+# of initial populations.
+
+import os
+import json
+import time
+import socket
+import threading
+import multiprocessing
+import numpy as np
+import pandas as pd
+
+from simul.log import SimulationLog
+from simul.parallel import light_control, job_seeds, prepare_worker
+
+_COST_COLUMNS = ['#flies', '#moths', '#steps', '#simuls', 'cost']
+
+
+class SweepQueue:
+
+    # receives the shared directory of the sweep (created if needed), the time
+    # (seconds) after which a lease without heartbeats expires, and the
+    # interval between heartbeats
+    def __init__(self, shared_dir, lease_timeout=120.0, heartbeat=15.0):
+        self.shared_dir = shared_dir
+        self.lease_timeout = lease_timeout
+        self.heartbeat = heartbeat
+        self.jobs_dir = os.path.join(shared_dir, 'jobs')
+        self.leases_dir = os.path.join(shared_dir, 'leases')
+        self.shards_dir = os.path.join(shared_dir, 'shards')
+        for d in [self.jobs_dir, self.leases_dir, self.shards_dir]:
+            os.makedirs(d, exist_ok=True)
+
+    #
+    # adds the jobs of a sweep: 'initial_populations' is a dataframe with the
+    # '#flies' and '#moths' columns (as for 'run_some_batches'), each one is
+    # simulated 'n_simuls' times, split in blocks of 'block_size' replicates.
+    # 'universe' is the fingerprint of the universe of the simulations and
+    # 'area_fraction' their area fraction (see 'SimulationControl.run_world()'):
+    # the workers and the reduce step only take the jobs of their own universe
+    # and area fraction
+    #
+    # Returns the list of job names
+    def submit(self, initial_populations, simul_time, n_simuls, block_size=10, universe=None, area_fraction=1.0):
+        names = []
+        blocks = [(j, min([block_size, n_simuls - j])) for j in range(0, n_simuls, block_size)]
+        populations = initial_populations[['#flies', '#moths']].drop_duplicates().values
+        seeds = job_seeds(len(populations) * len(blocks))
+        for (n_flies, n_moths), (block, n_block), seed in zip([p for p in populations for _ in blocks],
+                                                              blocks * len(populations), seeds):
+            name = '{}-{}-{}-{}-{}-{}-{:g}-{:06d}'.format(int(n_flies), int(n_moths), simul_time, n_simuls,
+                                                          block_size, universe if universe is not None else 'any',
+                                                          area_fraction, block)
+            job = {'#flies': int(n_flies), '#moths': int(n_moths), '#steps': simul_time,
+                   '#simuls': n_block, 'universe': universe, 'area_fraction': float(area_fraction),
+                   'seed': int(seed)}
+            path = os.path.join(self.jobs_dir, name + '.json')
+            if not os.path.exists(path):
+                with open(path + '.tmp', 'w') as f:
+                    json.dump(job, f)
+                os.replace(path + '.tmp', path)
+            names.append(name)
+        return names
+
+    def job_names(self):
+        return sorted(f[:-len('.json')] for f in os.listdir(self.jobs_dir) if f.endswith('.json'))
+
+    def job(self, name):
+        with open(os.path.join(self.jobs_dir, name + '.json')) as f:
+            return json.load(f)
+
+    def lease_path(self, name):
+        return os.path.join(self.leases_dir, name + '.lease')
+
+    # whether a job can be run (and reduced) with the given simulation control:
+    # same universe (fingerprint) and area fraction (the jobs without one are full area)
+    def same_settings(self, job, control):
+        return ((job.get('universe') in [None, control.world.universe.fingerprint()]) and
+                (job.get('area_fraction', 1.0) == control.area_fraction))
+
+    def shard_path(self, name):
+        return os.path.join(self.shards_dir, name + '.npz')
+
+    def is_done(self, name):
+        return os.path.exists(self.shard_path(name))
+
+    # returns the number of pending, leased and done jobs
+    def status(self):
+        names = self.job_names()
+        done = [name for name in names if self.is_done(name)]
+        leased = [name for name in names if (name not in done) and os.path.exists(self.lease_path(name))]
+        return {'pending': len(names) - len(done) - len(leased), 'leased': len(leased), 'done': len(done)}
+
+    #
+    # tries to claim a job. Expired leases are taken over first. Returns True
+    # if the lease was created by this worker
+    def claim(self, name, worker_id):
+        lease = self.lease_path(name)
+        try:
+            if time.time() - os.path.getmtime(lease) > self.lease_timeout:
+                self.take_over(lease, worker_id)
+        except OSError:
+            pass
+
+        try:
+            fd = os.open(lease, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, 'w') as f:
+            f.write(worker_id)
+
+        # the job may have finished between the listing and the claim
+        if self.is_done(name):
+            self.release(name, worker_id)
+            return False
+        return True
+
+    #
+    # removes an expired lease. It is renamed away first (atomically, so only
+    # one worker gets it) and checked again: if it was renewed (or created
+    # again) after the first look, it is put back with a hard link, that never
+    # overwrites a lease created in the meantime
+    def take_over(self, lease, worker_id):
+        stale = '{}.{}.stale'.format(lease, worker_id)
+        os.rename(lease, stale)
+        try:
+            if time.time() - os.path.getmtime(stale) <= self.lease_timeout:
+                try:
+                    os.link(stale, lease)
+                except FileExistsError:
+                    pass
+        finally:
+            os.remove(stale)
+
+    #
+    # removes the lease of a job, if it still belongs to the worker (it may
+    # have been taken over, if the worker stalled for too long). As on
+    # 'take_over()', it is renamed away first and read afterwards: a lease of
+    # another worker is put back, never removed
+    def release(self, name, worker_id):
+        lease = self.lease_path(name)
+        released = '{}.{}.release'.format(lease, worker_id)
+        try:
+            os.rename(lease, released)
+        except OSError:
+            return
+        try:
+            with open(released) as f:
+                if f.read() != worker_id:
+                    try:
+                        os.link(released, lease)
+                    except FileExistsError:
+                        pass
+        finally:
+            os.remove(released)
+
+    # touches the lease every 'heartbeat' seconds, until the event is set (a
+    # missing lease, being checked by another worker, is touched on the next beat)
+    def keep_alive(self, name, stop):
+        while not stop.wait(self.heartbeat):
+            try:
+                os.utime(self.lease_path(name))
+            except OSError:
+                pass
+
+    #
+    # runs a job with the given simulation control and writes its shard
+    # (atomically: written to a temporary file and then renamed)
+    def run_job(self, control, name):
+        job = self.job(name)
+        if not self.same_settings(job, control):
+            raise ValueError("job '{}' belongs to another universe or area fraction ({}, {})"
+                             .format(name, job.get('universe'), job.get('area_fraction', 1.0)))
+        prepare_worker(control, job['seed'])
+        columns = control.world.universe.df_columns
+        sum_log = SimulationLog.zeros(job['#steps'] + 1, columns)
+        costs = np.zeros(job['#simuls'])
+        for i in range(job['#simuls']):
+            curr_log = control.run_world(job['#flies'], job['#moths'], job['#steps'], lean=True)
+            costs[i] = control.cost(curr_log)
+            sum_log = sum_log + curr_log
+
+        tmp = self.shard_path(name) + '.{}.tmp.npz'.format(os.getpid())
+        np.savez(tmp, sum_log=sum_log.values, costs=costs, columns=np.array(columns))
+        os.replace(tmp, self.shard_path(name))
+
+    #
+    # worker loop: claims and runs jobs (of the control's universe and area
+    # fraction) until all of them are done. When all the remaining jobs are
+    # leased by other workers, waits 'poll' seconds and looks again (to take
+    # over the ones whose leases expire).
+    #
+    # Returns the number of jobs run by this worker
+    def work(self, control, worker_id=None, poll=5.0):
+        if worker_id is None:
+            worker_id = '{}-{}'.format(socket.gethostname(), os.getpid())
+
+        n_done = 0
+        while True:
+            remaining = [name for name in self.job_names()
+                         if (not self.is_done(name)) and self.same_settings(self.job(name), control)]
+            if not remaining:
+                return n_done
+
+            claimed = False
+            for name in remaining:
+                if not self.claim(name, worker_id):
+                    continue
+                claimed = True
+                stop = threading.Event()
+                heartbeat = threading.Thread(target=self.keep_alive, args=(name, stop), daemon=True)
+                heartbeat.start()
+                try:
+                    print('{} - running job {}'.format(worker_id, name))
+                    self.run_job(control, name)
+                    n_done += 1
+                finally:
+                    stop.set()
+                    heartbeat.join()
+                    self.release(name, worker_id)
+
+            if not claimed:
+                time.sleep(poll)
+
+    #
+    # merges the shards (of the jobs of the control's universe and area
+    # fraction) into one cost row per pair of initial populations and number
+    # of steps (the cost of the averaged log, as on 'simulation_batch' with
+    # output_costs set to 'mean'). If 'output_dir' is given, the averaged logs are saved there,
+    # as 'output_name{#flies}-{#moths}_mean.csv' (as 'run_some_batches' does).
+    # If the job 'names' are given (the ones returned by 'submit()'), only
+    # those jobs are merged, otherwise all the jobs on the shared directory.
+    #
+    # Returns the costs dataframe
+    def reduce(self, control, output_dir=None, output_name='simul', names=None):
+        merged = {}
+        for name in (self.job_names() if names is None else names):
+            job = self.job(name)
+            if not self.same_settings(job, control):
+                continue
+            if not self.is_done(name):
+                raise RuntimeError("job '{}' is not done yet".format(name))
+            key = (job['#flies'], job['#moths'], job['#steps'])
+            with np.load(self.shard_path(name)) as shard:
+                sum_log, n = merged.get(key, (0, 0))
+                merged[key] = (sum_log + shard['sum_log'], n + job['#simuls'])
+
+        if (output_dir is not None) and not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+
+        rows = []
+        for (n_flies, n_moths, simul_time), (sum_log, n) in sorted(merged.items()):
+            avg_simul_log = SimulationLog(sum_log / n, control.world.universe.df_columns)
+            control.world.n_flies = n_flies
+            control.world.n_moths = n_moths
+            rows.append([n_flies, n_moths, simul_time, n, control.cost(avg_simul_log)])
+            if output_dir is not None:
+                avg_simul_log.to_csv(os.path.join(output_dir,
+                                                  output_name + '{}-{}_mean.csv'.format(n_flies, n_moths)))
+
+        costs = pd.DataFrame(data=rows, index=range(len(rows)), columns=_COST_COLUMNS)
+        if control.costs_ledger is not None:
+            control.costs_ledger.append(costs, universe=control.world.universe.fingerprint(),
+                                        area_fraction=control.area_fraction)
+        return costs
+
+
+def _work(shared_dir, control, worker_id, kwargs):
+    SweepQueue(shared_dir, **kwargs).work(control, worker_id=worker_id)
+
+
+#
+# runs 'n_workers' local worker processes on a sweep and waits for them. Is the
+# single machine version of starting 'SweepQueue(shared_dir).work(control)' on
+# each node (and is also how the sweeps are tested on one machine)
+def run_local_workers(control, shared_dir, n_workers, **kwargs):
+    control = light_control(control)
+    workers = [multiprocessing.Process(target=_work,
+                                       args=(shared_dir, control, '{}-{}'.format(socket.gethostname(), i), kwargs))
+               for i in range(n_workers)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return [worker.exitcode for worker in workers]
@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+#
+# Telemetry of simulation sweeps. The simulation control reports the start and
+# the end of each sweep ('run_some_batches()'), batch ('simulation_batch()') and
+# replicate to a 'Telemetry' object, which:
+#    > writes each one of them as a json event (one per line) on a file, with
+#      its timings, the simulated creatures per second (creature-days: sum of
+#      the living creatures over all the steps, divided by the time) and the
+#      estimated time remaining for the batch and for the sweep
+#    > optionally serves the current state on a local http endpoint:
+#        /metrics : prometheus text format
+#        /status  : json
+#
+# So a long sweep can be followed with 'tail -f' on the events file, or from a
+# browser / monitoring system, and the slow configurations spotted on the
+# batch events.
+
+import json
+import time
+import threading
+import numpy as np
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+class Telemetry:
+
+    # receives the path of the json-lines events file (appended to, if it
+    # exists) and, optionally, the local port of the http endpoint
+    def __init__(self, path=None, port=None, host='127.0.0.1'):
+        self.path = path
+        self.file = open(path, 'a') if path is not None else None
+        self.lock = threading.Lock()
+        self.state = {
+            'sweep_batches': 0, 'sweep_done': 0, 'sweep_start': None,
+            'batch': None, 'batch_replicates': 0, 'batch_done': 0, 'batch_start': None,
+            'replicates_total': 0, 'batches_total': 0, 'creature_days_total': 0.0,
+            'last_replicate_seconds': 0.0, 'creatures_per_second': 0.0, 'cpu_utilization': 0.0,
+            'batch_eta_seconds': 0.0, 'sweep_eta_seconds': 0.0, 'active_workers': 0, 'workers': 0
+        }
+        self.batch_seconds = []
+        self.replicate_seconds = []
+
+        self.server = None
+        if port is not None:
+            self.server = ThreadingHTTPServer((host, port), _handler(self))
+            threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+        if (self.file is not None) and not self.file.closed:
+            self.file.close()
+
+    # writes an event to the events file (and returns it)
+    def emit(self, event, **fields):
+        record = dict({'time': time.time(), 'event': event}, **fields)
+        if self.file is not None:
+            with self.lock:
+                self.file.write(json.dumps(record, default=_to_json) + '\n')
+                self.file.flush()
+        return record
+
+    # updates the state served on the http endpoint
+    def update(self, **fields):
+        with self.lock:
+            self.state.update(fields)
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.state)
+
+    #
+    # sweep of 'n_batches' simulation batches
+    def sweep_started(self, n_batches):
+        self.batch_seconds = []
+        self.update(sweep_batches=n_batches, sweep_done=0, sweep_start=time.time())
+        self.emit('sweep_start', batches=n_batches)
+
+    def sweep_done(self):
+        state = self.snapshot()
+        self.update(sweep_batches=0, sweep_done=0, sweep_start=None, sweep_eta_seconds=0.0)
+        self.emit('sweep_end', batches=state['sweep_done'],
+                  seconds=time.time() - state['sweep_start'] if state['sweep_start'] else None)
+
+    def batch_started(self, n_flies, n_moths, simul_time, n_simuls):
+        self.replicate_seconds = []
+        batch = {'#flies': int(n_flies), '#moths': int(n_moths), '#steps': int(simul_time), '#simuls': int(n_simuls)}
+        self.update(batch=batch, batch_replicates=n_simuls, batch_done=0, batch_start=time.time(),
+                    workers=1, active_workers=1)
+        self.emit('batch_start', **batch)
+
+    #
+    # a replicate of the current batch is done: its wall and cpu times and the
+    # number of creature-days it simulated
+    def replicate_done(self, seconds, cpu_seconds, creature_days):
+        self.replicate_seconds.append(seconds)
+        state = self.snapshot()
+        done = state['batch_done'] + 1
+        batch_eta = np.mean(self.replicate_seconds) * (state['batch_replicates'] - done)
+        fields = {
+            'batch_done': done,
+            'replicates_total': state['replicates_total'] + 1,
+            'creature_days_total': state['creature_days_total'] + creature_days,
+            'last_replicate_seconds': seconds,
+            'creatures_per_second': creature_days / seconds if seconds > 0 else 0.0,
+            'cpu_utilization': cpu_seconds / seconds if seconds > 0 else 0.0,
+            'batch_eta_seconds': batch_eta,
+            'sweep_eta_seconds': self.sweep_eta(batch_eta, state)
+        }
+        self.update(**fields)
+        self.emit('replicate', batch=state['batch'], replicate=done, total=state['batch_replicates'],
+                  seconds=seconds, creature_days=creature_days, creatures_per_second=fields['creatures_per_second'],
+                  cpu_utilization=fields['cpu_utilization'], batch_eta_seconds=batch_eta,
+                  sweep_eta_seconds=fields['sweep_eta_seconds'])
+
+    def batch_done(self, cost=None):
+        state = self.snapshot()
+        seconds = time.time() - state['batch_start']
+        self.batch_seconds.append(seconds)
+        sweep_done = state['sweep_done'] + 1 if state['sweep_batches'] else 0
+        self.update(batch=None, batches_total=state['batches_total'] + 1, sweep_done=sweep_done,
+                    batch_eta_seconds=0.0)
+        self.update(sweep_eta_seconds=self.sweep_eta(0.0, self.snapshot()))
+        self.emit('batch_end', batch=state['batch'], seconds=seconds, replicates=state['batch_done'],
+                  seconds_per_replicate=seconds / max([1, state['batch_done']]), cost=cost,
+                  sweep_done=sweep_done, sweep_eta_seconds=self.snapshot()['sweep_eta_seconds'])
+
+    # estimated time remaining for the sweep: the rest of the current batch plus
+    # the mean batch time for each one of the batches not started yet
+    def sweep_eta(self, batch_eta, state):
+        if not state['sweep_batches']:
+            return 0.0
+        remaining = state['sweep_batches'] - state['sweep_done'] - (state['batch'] is not None)
+        if not self.batch_seconds:
+            per_batch = np.mean(self.replicate_seconds) * state['batch_replicates'] if self.replicate_seconds else 0.0
+        else:
+            per_batch = np.mean(self.batch_seconds)
+        return batch_eta + remaining * per_batch
+
+    #
+    # jobs run on a pool of worker processes ('simul.parallel.run_jobs()'):
+    # 'done' of 'total' jobs are finished after 'seconds', with 'workers' processes
+    def jobs_progress(self, done, total, seconds, workers):
+        active = min([workers, total - done])
+        eta = seconds / done * (total - done) if done else 0.0
+        self.update(workers=workers, active_workers=active, batch_eta_seconds=eta)
+        self.emit('jobs', done=done, total=total, seconds=seconds, eta_seconds=eta,
+                  worker_utilization=active / workers)
+
+    # current state on the prometheus text format
+    def metrics(self):
+        state = self.snapshot()
+        lines = []
+        for name, kind, value in [
+                ('simul_replicates_total', 'counter', state['replicates_total']),
+                ('simul_batches_total', 'counter', state['batches_total']),
+                ('simul_creature_days_total', 'counter', state['creature_days_total']),
+                ('simul_last_replicate_seconds', 'gauge', state['last_replicate_seconds']),
+                ('simul_creatures_per_second', 'gauge', state['creatures_per_second']),
+                ('simul_cpu_utilization', 'gauge', state['cpu_utilization']),
+                ('simul_batch_replicates_done', 'gauge', state['batch_done']),
+                ('simul_batch_replicates', 'gauge', state['batch_replicates']),
+                ('simul_batch_eta_seconds', 'gauge', state['batch_eta_seconds']),
+                ('simul_sweep_batches_done', 'gauge', state['sweep_done']),
+                ('simul_sweep_batches', 'gauge', state['sweep_batches']),
+                ('simul_sweep_eta_seconds', 'gauge', state['sweep_eta_seconds']),
+                ('simul_active_workers', 'gauge', state['active_workers']),
+                ('simul_workers', 'gauge', state['workers'])]:
+            lines += ['# TYPE {} {}'.format(name, kind), '{} {}'.format(name, float(value))]
+        return '\n'.join(lines) + '\n'
+
+
+#
+# request handler class of the http endpoint, bound to a telemetry object
+def _handler(telemetry):
+
+    class TelemetryHandler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            if self.path == '/metrics':
+                body, content_type = telemetry.metrics(), 'text/plain; version=0.0.4'
+            elif self.path == '/status':
+                body, content_type = json.dumps(telemetry.snapshot(), default=_to_json), 'application/json'
+            else:
+                self.send_error(404)
+                return
+            body = body.encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        # no request logging on the terminal
+        def log_message(self, format, *args):
+            pass
+
+    return TelemetryHandler
+
+
+def _to_json(obj):
+    if isinstance(obj, np.generic):
+        return obj.item()
+    raise TypeError('{!r} is not json serializable'.format(obj))
+
+
+#
+# number of creature-days of a simulation log: living creatures summed over
+# all of its steps (a chunk at a time, for the streamed logs)
+def creature_days(data_log, chunk_size=65536):
+    total = 0.0
+    for col in ['moth-living', 'fly-living']:
+        values = np.asarray(data_log[col])
+        for a in range(0, len(values), chunk_size):
+            total += float(np.sum(values[a:a + chunk_size]))
+    return total
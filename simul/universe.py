@@ -11,10 +11,17 @@
 
 from simul.creatures import Moth
 from simul.creatures import Fly
+import hashlib
 from itertools import product
 
 
 class Universe:
+
+    # names of the constructor parameters, in order
+    parameter_names = ['fmfr', 'flm', 'flv', 'famin', 'famax', 'ffr', 'fom', 'fov', 'faa', 'fea', 'frd',
+                       'mmfr', 'mlm', 'mlv', 'mamin', 'mamax', 'mfr', 'mom', 'mov', 'maa', 'mea', 'mrd',
+                       'predation_coefficient']
+
     def __init__(self,
                  fmfr, flm, flv, famin, famax, ffr, fom, fov, faa, fea, frd,  # fly parameters
                  mmfr, mlm, mlv, mamin, mamax, mfr, mom, mov, maa, mea, mrd,  # moth parameters
@@ -38,6 +45,13 @@ class Universe:
 
         self.predation_coefficient = predation_coefficient
 
+        # keeps the constructor parameters, so the universe can be identified
+        # (fingerprint) and rebuilt with some of them changed
+        self.parameters = dict(zip(self.parameter_names,
+                                   [fmfr, flm, flv, famin, famax, ffr, fom, fov, faa, fea, frd,
+                                    mmfr, mlm, mlv, mamin, mamax, mfr, mom, mov, maa, mea, mrd,
+                                    predation_coefficient]))
+
         # defines the set of data that we will want to visualize after the simulation.
         # For each type of creature and each iteration
         self.recordable_data = ['living',
@@ -54,3 +68,10 @@ class Universe:
                                 ]
         self.c_types = ['moth-', 'fly-']
         self.df_columns = [(c + d) for c, d in product(self.c_types, self.recordable_data)]
+
+    # short hash of the universe parameters. Simulation results obtained
+    # with different universes must never be mixed, so this is recorded
+    # next to them (on the costs ledger, for instance)
+    def fingerprint(self):
+        return hashlib.sha1(repr([float(self.parameters[name]) for name in self.parameter_names])
+                            .encode('utf-8')).hexdigest()[:16]
@@ -11,12 +11,15 @@
 #    - simulate the interaction of its creatures for a given number of steps
 #    - be able to perform multiple simulations (not only once)
 
+import pickle
 import numpy as np
 import pandas as pd
 
 from simul.creatures import Creature
 from simul.creatures import Moth
 from simul.creatures import Fly
+from simul.log import SimulationLog
+from simul.stream import StreamingLogWriter, open_streamed_log
 
 
 class WonderfulWorld:
@@ -44,14 +47,40 @@ class WonderfulWorld:
         self.iteration_data = {Moth: [], Fly: []}
         self.initial_lifespan = {Fly: fil, Moth: mil}
 
+        # position of the current instant on the iteration data arrays. They
+        # usually hold the whole simulation (the position is the instant) but,
+        # when the log is streamed to a file, they are a buffer of a few steps
+        # that is flushed every time it gets full (see 'advance_log()'). On the
+        # step iterator ('iter_steps()'), a single step that is reset every day
+        self.log_idx = 0
+        self.log_offset = 0
+        self.log_writer = None
+        self.log_rolling = False
+
+        # uniform numbers of the initial ages of the next run, if they are set
+        # by a replicate design (see 'initial_age()')
+        self.initial_age_uniforms = {Moth: None, Fly: None}
+
+        # initial creatures of the next run, if they are given (arrays with a
+        # row per creature: male, fertile, lifespan, age, see
+        # 'draw_initial_creatures()'), instead of drawn by the world
+        self.initial_creatures = {Moth: None, Fly: None}
+
     #
     # initializes the world with:
     #     - uniform distributions for the initial ages of moths and flies
     #       with limits defined by the universe
     #     - resets the current instant
     #     -
-    def initialize_world(self, n_steps):
+    # If a log writer is given, the iteration data is a buffer of 'chunk_size'
+    # steps, flushed to the writer whenever it gets full ('rolling' is the same,
+    # without the writer: the buffer is just reset)
+    def initialize_world(self, n_steps, log_writer=None, chunk_size=None, rolling=False):
         self.instant = 0
+        self.log_idx = 0
+        self.log_offset = 0
+        self.log_writer = log_writer
+        self.log_rolling = rolling
 
         # reset the list of caterpillars, if it wasn't already empty
         del Moth.caterpillars[:]
@@ -62,14 +91,12 @@ class WonderfulWorld:
         #                    internally, for the flies)
         #    - genders following the universe's male/female ratios
         self.creatures = {
-            Moth: [Moth(0, age=np.random.randint(low=self.universe.initial_age_min[Moth],
-                                                 high=self.universe.initial_age_max[Moth] + 1),
-                        initial_lifespan=self.initial_lifespan[Moth])
-                   for _ in range(self.n_moths)],
-            Fly: [Fly(0, age=np.random.randint(low=self.universe.initial_age_min[Fly],
-                                               high=self.universe.initial_age_max[Fly] + 1),
-                      initial_lifespan=self.initial_lifespan[Fly])
-                  for _ in range(self.n_flies)]
+            Moth: [Moth(0, age=self.initial_age(Moth, i), initial_lifespan=self.initial_lifespan[Moth])
+                   for i in range(self.n_moths)] if self.initial_creatures[Moth] is None else
+                  self.new_creatures(Moth, self.initial_creatures[Moth]),
+            Fly: [Fly(0, age=self.initial_age(Fly, i), initial_lifespan=self.initial_lifespan[Fly])
+                  for i in range(self.n_flies)] if self.initial_creatures[Fly] is None else
+                 self.new_creatures(Fly, self.initial_creatures[Fly])
         }
 
         # resets the newborn creatures arrays
@@ -77,10 +104,67 @@ class WonderfulWorld:
 
         # initializes the output log with the first
         # values for the creatures' features
-        self.reset_iteration_log(n_steps)
+        self.reset_iteration_log(n_steps if (log_writer is None) and not rolling else min([n_steps, chunk_size - 1]))
         self.initialize_log()
         # self.save_iteration_log()
 
+    #
+    # initial age of the i-th creature of a type: uniform on the universe's
+    # limits, drawn here or, on the replicate designs (see 'simul.designs'),
+    # given by the uniform number on 'initial_age_uniforms' (creatures beyond
+    # the given ones are drawn here as well)
+    def initial_age(self, creature_type, i):
+        low = self.universe.initial_age_min[creature_type]
+        high = self.universe.initial_age_max[creature_type] + 1
+        uniforms = self.initial_age_uniforms[creature_type]
+        if (uniforms is None) or (i >= len(uniforms)):
+            return np.random.randint(low=low, high=high)
+        return low + min([int(uniforms[i] * (high - low)), high - low - 1])
+
+    # same as 'initial_age()', for 'n' creatures at once
+    def initial_ages(self, creature_type, n):
+        low = self.universe.initial_age_min[creature_type]
+        high = self.universe.initial_age_max[creature_type] + 1
+        uniforms = self.initial_age_uniforms[creature_type]
+        if uniforms is None:
+            return np.random.randint(low=low, high=high, size=n)
+        given = low + np.minimum((np.asarray(uniforms[0:n]) * (high - low)).astype(int), high - low - 1)
+        return np.concatenate([given, np.random.randint(low=low, high=high, size=n - len(given))])
+
+    #
+    # features of 'n' initial creatures of a type, drawn as the world does on
+    # its initialization: array with a row per creature (male, fertile,
+    # lifespan, age). Given to a world as its 'initial_creatures', the same
+    # creatures can start several runs (or a subset of them, a smaller area)
+    def draw_initial_creatures(self, creature_type, n):
+        male = np.random.uniform(size=n) < self.universe.mf_ratio[creature_type]
+        fertile = np.random.uniform(size=n) < self.universe.fertility_ratio[creature_type]
+        lifespan = np.maximum(1, np.round(np.random.normal(loc=self.universe.lifespan_mean[creature_type],
+                                                           scale=self.universe.lifespan_var[creature_type],
+                                                           size=n)).astype(int))
+        if self.initial_lifespan[creature_type] is not None:
+            ages = lifespan - self.initial_lifespan[creature_type]
+        else:
+            ages = self.initial_ages(creature_type, n)
+        return np.column_stack([male, fertile, lifespan, ages]).astype(int).reshape(-1, 4)
+
+    # creatures of a type with the given features (rows of 'draw_initial_creatures()')
+    def new_creatures(self, creature_type, features):
+        creatures = []
+        for male, fertile, lifespan, age in features.tolist():
+            creature = creature_type.__new__(creature_type)
+            creature.gender = 'm' if male else 'f'
+            creature.fertility = bool(fertile)
+            creature.lifespan = lifespan
+            creature.age = age
+            creature.alive = True
+            creature.generation = self.instant
+            creature.offspring = 0
+            if (creature_type is Moth) and creature.is_caterpillar():
+                Moth.caterpillars.append(creature)
+            creatures.append(creature)
+        return creatures
+
     #
     # kills the current creature. Previously, it automatically removed the
     # killed creature from the creatures list. But, that messed up the creature
@@ -101,8 +185,8 @@ class WonderfulWorld:
 
         # we update our iteration data (that we want to visualise when the simulation
         # ends) with these new numbers
-        self.iteration_data[type(creature)]['parents'][self.instant] += 1
-        self.iteration_data[type(creature)]['newborn'][self.instant] += len(children)
+        self.iteration_data[type(creature)]['parents'][self.log_idx] += 1
+        self.iteration_data[type(creature)]['newborn'][self.log_idx] += len(children)
 
     #
     # Checks if a creature should randomly die. If yes, kills it and
@@ -110,7 +194,7 @@ class WonderfulWorld:
     # whether the creature actually died or not
     def random_death(self, creature):
         if creature.random_death():
-            self.iteration_data[type(creature)]['randomly_killed'][self.instant] += 1
+            self.iteration_data[type(creature)]['randomly_killed'][self.log_idx] += 1
             self.kill(creature)
             return True
         else:
@@ -122,7 +206,7 @@ class WonderfulWorld:
     # whether the creature actually died or not
     def old_age_death(self, creature):
         if creature.old_age_death():
-            self.iteration_data[type(creature)]['old_age_killed'][self.instant] += 1
+            self.iteration_data[type(creature)]['old_age_killed'][self.log_idx] += 1
             self.kill(creature)
             return True
         else:
@@ -148,8 +232,8 @@ class WonderfulWorld:
     #
     # Afterwards, we procreate the fly that just performed the predation.
     def predation(self, fly):
-        self.iteration_data[Fly]['predation'][self.instant] += 1
-        self.iteration_data[Moth]['dead'][self.instant] += 1
+        self.iteration_data[Fly]['predation'][self.log_idx] += 1
+        self.iteration_data[Moth]['dead'][self.log_idx] += 1
 
         # get the lucky bastard (caterpillars) by its horns
         lucky_caterpillar = Moth.caterpillars[np.random.randint(low=0,
@@ -168,6 +252,7 @@ class WonderfulWorld:
         # we reset the iteration log and update the current instant
         # self.reset_iteration_log()
         self.instant = self.instant + 1
+        self.advance_log()
 
         # fly stuff:
         #    > random death
@@ -216,13 +301,13 @@ class WonderfulWorld:
 
     # save the useful data on a dataframe for each generation
     def log_creature(self, creature):
-        self.iteration_data[type(creature)]['living'][self.instant] += creature.is_alive()
-        self.iteration_data[type(creature)]['dead'][self.instant] += creature.is_dead()
-        self.iteration_data[type(creature)]['male'][self.instant] += creature.gender == 'm'
-        self.iteration_data[type(creature)]['female'][self.instant] += creature.gender == 'f'
-        self.iteration_data[type(creature)]['caterpillars'][self.instant] += (creature.is_caterpillar() and
+        self.iteration_data[type(creature)]['living'][self.log_idx] += creature.is_alive()
+        self.iteration_data[type(creature)]['dead'][self.log_idx] += creature.is_dead()
+        self.iteration_data[type(creature)]['male'][self.log_idx] += creature.gender == 'm'
+        self.iteration_data[type(creature)]['female'][self.log_idx] += creature.gender == 'f'
+        self.iteration_data[type(creature)]['caterpillars'][self.log_idx] += (creature.is_caterpillar() and
                                                                               creature.is_alive())
-        self.iteration_data[type(creature)]['adults'][self.instant] += creature.is_adult()
+        self.iteration_data[type(creature)]['adults'][self.log_idx] += creature.is_adult()
 
     # resets the iteration log
     def reset_iteration_log(self, n_steps):
@@ -240,6 +325,26 @@ class WonderfulWorld:
             Moth: {col: np.zeros(n_steps + 1) for col in self.universe.recordable_data}
         }
 
+    #
+    # moves the iteration data position to the current instant. If the buffer
+    # is full, it is flushed to the log writer (if any) and reset
+    def advance_log(self):
+        self.log_idx = self.instant - self.log_offset
+        buffer_size = len(self.iteration_data[Fly]['living'])
+        if ((self.log_writer is not None) or self.log_rolling) and (self.log_idx == buffer_size):
+            if self.log_writer is not None:
+                self.flush_log(buffer_size)
+            for creature_type in [Fly, Moth]:
+                for col in self.universe.recordable_data:
+                    self.iteration_data[creature_type][col][:] = 0
+            self.log_offset = self.instant
+            self.log_idx = 0
+
+    # writes the first 'rows' of the iteration data buffer to the log writer
+    def flush_log(self, rows):
+        buffer = SimulationLog.from_iteration_data(self.iteration_data, self.universe, [Fly, Moth])
+        self.log_writer.append(buffer.values[0:rows])
+
     #
     # initializes the dataframe by creating it empty, logging in all the creatures
     # and saving on it as its first element
@@ -256,17 +361,114 @@ class WonderfulWorld:
     # by repeatedly executing the 'single_step()' method.
     #
     # Returns the dataframe with the outputs generated from the
-    # simulation.
-    def run_world(self, n_flies, n_moths, end_of_times):
+    # simulation. If 'lean' is set, returns a numpy-backed 'SimulationLog'
+    # instead, that only builds the dataframe when it is asked to.
+    #
+    # If 'stream_to' (a file path) is given, the log is streamed to that file
+    # in chunks of 'chunk_size' steps (only one chunk is kept in memory) and a
+    # memory-mapped 'SimulationLog' of the file is returned
+    def run_world(self, n_flies, n_moths, end_of_times, lean=False, stream_to=None, chunk_size=4096):
         self.n_moths = n_moths
         self.n_flies = n_flies
 
-        self.initialize_world(end_of_times)
+        log_writer = None
+        if stream_to is not None:
+            log_writer = StreamingLogWriter(stream_to, self.universe.df_columns)
+
+        self.initialize_world(end_of_times, log_writer=log_writer, chunk_size=chunk_size)
         for _ in range(end_of_times):
             self.single_step()
 
+        if log_writer is not None:
+            self.flush_log(self.log_idx + 1)
+            log_writer.close()
+            self.log_writer = None
+            return open_streamed_log(stream_to)
+
+        if lean:
+            return SimulationLog.from_iteration_data(self.iteration_data, self.universe, [Fly, Moth])
+
         return pd.DataFrame(data={(creature_type.name() + col): self.iteration_data[creature_type][col]
                                   for creature_type in [Fly, Moth]
                                   for col in self.universe.recordable_data},
                             index=range(end_of_times + 1),
                             columns=self.universe.df_columns)
+
+    #
+    # migration between worlds (see 'simul.metapop'): each adult creature of a
+    # type leaves the world with chance 'rate'. Returns the array with a row per
+    # emigrant (male, fertile, lifespan, age), to be sent to other worlds
+    def emigrate(self, creature_type, rate):
+        creatures = self.creatures[creature_type]
+        leaving = (np.random.uniform(size=len(creatures)) < rate) & np.array([creature.is_adult()
+                                                                              for creature in creatures], dtype=bool)
+        emigrants = [creature for creature, leaves in zip(creatures, leaving) if leaves]
+        creatures[:] = [creature for creature, leaves in zip(creatures, leaving) if not leaves]
+        return np.array([[creature.gender == 'm', creature.fertility, creature.lifespan, creature.age]
+                         for creature in emigrants], dtype=int).reshape(-1, 4)
+
+    # receives the emigrants of other worlds (rows of 'emigrate()'), keeping
+    # their features
+    def immigrate(self, creature_type, migrants):
+        self.creatures[creature_type] += self.new_creatures(creature_type, migrants)
+
+    #
+    # state of the world on the current instant (creatures, calendar, counts of
+    # the current step, ...), as a pickled copy that can be restored any number
+    # of times (see 'simul.splitting'). The caterpillars list of the moths is a
+    # class attribute, so it goes along with the world's own state (pickled
+    # together, its references stay the same creatures of the world)
+    def snapshot(self):
+        state = {key: value for key, value in self.__dict__.items() if key not in ['universe', 'log_writer']}
+        return pickle.dumps((state, Moth.caterpillars), protocol=pickle.HIGHEST_PROTOCOL)
+
+    # brings the world back to a snapshot (on the same universe, without a log writer)
+    def restore(self, snapshot):
+        state, caterpillars = pickle.loads(snapshot)
+        self.__dict__.update(state)
+        self.log_writer = None
+        Creature.universe = self.universe
+        Moth.caterpillars[:] = caterpillars
+
+    #
+    # runs the world one step at a time, as a generator: yields a 'StepRecord'
+    # with the counts of the initial instant and then of each step, up to
+    # 'end_of_times' steps (forever if None). The consumer may stop at any
+    # time (and resume later, the generator keeps the world's state).
+    #
+    # Only the current step is kept (no log is built): the record reads its
+    # counts straight from the world, so it is the same object on every step
+    # and its values are only valid until the next one
+    def iter_steps(self, n_flies, n_moths, end_of_times=None):
+        self.n_moths = n_moths
+        self.n_flies = n_flies
+
+        self.initialize_world(np.inf if end_of_times is None else end_of_times, chunk_size=1, rolling=True)
+        record = StepRecord(self)
+        yield record
+        while (end_of_times is None) or (self.instant < end_of_times):
+            self.single_step()
+            yield record
+
+
+class StepRecord:
+
+    # counts of the current step of a world, read from its iteration data
+    # (times 'scale', the inverse of the area fraction on downscaled runs)
+    def __init__(self, world, scale=1.0):
+        self.world = world
+        self.scale = scale
+        types = {creature_type.name(): creature_type for creature_type in [Fly, Moth]}
+        self.index = {(c + d): (types[c], d) for c in world.universe.c_types for d in world.universe.recordable_data}
+
+    @property
+    def instant(self):
+        return self.world.instant
+
+    def __getitem__(self, column):
+        creature_type, data = self.index[column]
+        return self.world.iteration_data[creature_type][data][self.world.log_idx] * self.scale
+
+    # copy of the counts, on the universe's 'df_columns' order
+    def values(self):
+        return np.array([self[column] for column in self.world.universe.df_columns])
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+#
+# Background output writer. Formatting a simulation log as csv (and writing
+# it to disk) takes a while and, done right after each replicate, it leaves
+# the simulation loop waiting. The 'BackgroundWriter' takes the logs to be
+# saved and writes them on a worker thread (or process), while the next
+# replicate runs.
+#
+# The pending writes are kept on a bounded queue: when it is full, the
+# simulation waits for the writer (so memory doesn't pile up if the disk is
+# slower than the simulations). 'flush()' is the barrier that waits for all
+# of the pending writes (and raises their errors, if any): after it, all the
+# files are complete.
+
+import threading
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+# file name suffixes of the pandas compression methods
+_SUFFIXES = {'gzip': '.gz', 'bz2': '.bz2', 'xz': '.xz', 'zip': '.zip', 'zstd': '.zst'}
+
+
+class BackgroundWriter:
+
+    # max_pending : size of the queue of pending writes
+    # compression : pandas compression method of the csv files ('gzip', 'bz2',
+    #               ...), added as a suffix to their names, or None
+    # processes   : if set, the files are written by a worker process instead of
+    #               a thread (the formatting doesn't compete with the simulation
+    #               for the interpreter, at the price of sending it the logs)
+    def __init__(self, max_pending=4, compression=None, processes=False):
+        self.compression = compression
+        self.pool = ProcessPoolExecutor(max_workers=1) if processes else ThreadPoolExecutor(max_workers=1)
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.pending = []
+
+    # name of the file actually written for a given path
+    def file_name(self, path):
+        return path + _SUFFIXES.get(self.compression, '')
+
+    #
+    # queues a simulation log (dataframe or 'SimulationLog') to be saved as csv
+    # on the given path (plus the compression suffix). Returns the file name
+    def to_csv(self, data_log, path, compress=True):
+        compression = self.compression if compress else None
+        if isinstance(data_log, pd.DataFrame):
+            job = (_write_dataframe, data_log, path, compression)
+        else:
+            job = (_write_values, data_log.values.copy(), list(data_log.columns), path, compression)
+        self.submit(*job)
+        return path + _SUFFIXES.get(compression, '')
+
+    # queues a function call, waiting for a free slot if the queue is full
+    def submit(self, fn, *args):
+        self.slots.acquire()
+        try:
+            future = self.pool.submit(fn, *args)
+        except Exception:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda _: self.slots.release())
+        self.pending.append(future)
+
+    # waits for all of the pending writes. Raises the first error, if any
+    def flush(self):
+        pending, self.pending = self.pending, []
+        errors = [future.exception() for future in pending]
+        errors = [error for error in errors if error is not None]
+        if errors:
+            raise errors[0]
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self.pool.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def _write_dataframe(df, path, compression):
+    df.to_csv(path + _SUFFIXES.get(compression, ''), compression=compression)
+
+
+def _write_values(values, columns, path, compression):
+    pd.DataFrame(data=values, index=range(len(values)), columns=columns).to_csv(
+        path + _SUFFIXES.get(compression, ''), compression=compression)
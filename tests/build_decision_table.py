@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+#
+# Builds the decision table (best number of flies for each sample of n moths
+# on an area A) from the simple costs of the simulations and the moth density
+# distribution, and saves it to be used on the field (see 'funcs.decision').
+# The grid covers the counts and areas of the 'AmostragemBrocas.csv' samples.
+
+import numpy as np
+import pandas as pd
+import os
+from funcs.decision import build_decision_table, load_decision_table
+
+# input files
+densities_file = os.path.join('..', 'data', 'Densidades.csv')
+samples_file = os.path.join('..', 'data', 'AmostragemBrocas.csv')
+costs_file = os.path.join('outputs', 'simul_results_cost.csv')
+
+# output directory of the table
+decision_table_dir = os.path.join('outputs', 'decision_table')
+
+# definition of the list with initial number of flies (same as the simulations)
+fly_step = 1500
+fly_max = 40000
+n_flies_list = list(range(0, fly_max, fly_step))
+
+samples = pd.read_csv(samples_file)
+n_values = np.arange(0, 2 * samples['n'].max() + 1)
+area_values = np.linspace(samples['A'].min() / 2, samples['A'].max() * 2, 50)
+
+table = build_decision_table(pd.read_csv(densities_file), pd.read_csv(costs_file, index_col=[0]),
+                             n_flies_list, n_values, area_values)
+table.save(decision_table_dir)
+
+# on the field: load (memory-mapped) and look up
+table = load_decision_table(decision_table_dir)
+for _, sample in samples.drop_duplicates(['n', 'A']).iterrows():
+    print('n={}, A={}: release {} flies'.format(sample['n'], sample['A'], table.flies(sample['n'], sample['A'])))
@@ -15,6 +15,8 @@ output_dir = 'simple_costs'
 output_file = 'cost_dir{}-{}_steps.csv'.format(exec_dir, cost_steps)
 
 u, w, sc, my_plotter = init_default()
-costs_df = sc.simple_cost(simul_results_dir, simul_files, cost_steps=cost_steps)
+# the results directory is indexed once (catalog); later runs with a different
+# number of steps only read the cached columns
+costs_df = sc.simple_cost(simul_results_dir, simul_files, cost_steps=cost_steps, use_catalog=True)
 
 costs_df.to_csv(os.path.join(output_dir, output_file))
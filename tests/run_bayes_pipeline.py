@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+#
+# Same as the 'test_forall_n_A' script, but without the manual round trips:
+# the simulations missing for the bayes costs of all values of 'n' and 'A'
+# (read from the 'AmostragemBrocas.csv' file) are planned, run in parallel
+# and recorded on a costs ledger, and then the bayes costs are computed
+
+import pandas as pd
+import os
+from funcs.init_default import init_default
+from simul.ledger import CostsLedger
+
+# simulation batch parameters
+steps = 200
+n_simuls = 50
+n_workers = None    # one process per cpu
+
+# output files
+output_csv_dir = 'outputs'
+output_csv_name = 'simul_results'
+costs_ledger_file = os.path.join(output_csv_dir, output_csv_name + '_cost.sqlite')
+
+# data files
+densities_file = os.path.join('..', 'data', 'Densidades.csv')
+samples_file = os.path.join('..', 'data', 'AmostragemBrocas.csv')
+
+u, w, sc, my_plotter = init_default()
+
+# definition of the list with initial number of flies
+fly_step = 1500
+fly_max = 40000
+n_flies_list = list(range(0, fly_max, fly_step))
+
+success, bayes_costs = sc.bayes_cost_query(pd.read_csv(densities_file), pd.read_csv(samples_file),
+                                           n_flies_list, CostsLedger(costs_ledger_file),
+                                           auto_fill=True, simul_time=steps, n_simuls=n_simuls,
+                                           n_workers=n_workers)
+
+# save results on external file
+bayes_cost_file = os.path.join(output_csv_dir, output_csv_name + '_bayes_cost.csv')
+bayes_costs.to_csv(bayes_cost_file)
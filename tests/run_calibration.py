@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+#
+# Calibration (ABC-SMC) of some of the universe parameters against the field
+# data without flies. Uses the event-driven world and a downscaled area, so
+# each candidate parameter set costs a fraction of a full simulation batch.
+
+import os
+from funcs.init_default import init_default
+from simul.events import EventWorld
+from simul.creatures import Moth, Fly
+from simul.calibration import AbcSmc, load_field_data
+
+# data files
+samples_file = os.path.join('..', 'data', 'BrocasP-No-Area.txt')
+densities_file = os.path.join('..', 'data', 'Densidade_sem_cotesia-bin_02.txt')
+
+# output file
+output_dir = 'outputs'
+posterior_file = os.path.join(output_dir, 'calibration_posterior.csv')
+
+# calibrated parameters and their (uniform) priors. The field data has no
+# flies, so only the moth parameters can be calibrated with it
+priors = {
+    'mom': (10.0, 100.0),   # moth offspring mean
+    'mrd': (0.0, 0.1),      # moth random death chance
+}
+
+u, w, sc, my_plotter = init_default()
+sc.world = EventWorld(u, fil=w.initial_lifespan[Fly], mil=w.initial_lifespan[Moth])
+sc.area_fraction = 0.1
+
+samples, densities = load_field_data(samples_file, densities_file)
+abc = AbcSmc(sc, samples, densities, priors, simul_time=60, n_replicates=20, n_particles=200)
+posterior = abc.run(n_generations=6)
+
+if not os.path.exists(output_dir):
+    os.mkdir(output_dir)
+posterior.to_csv(posterior_file)
+print(posterior.describe())
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+#
+# Distributed version of the 'run_simulations' sweep. The jobs are written to
+# a shared directory (an NFS mount, for instance) and run by any number of
+# workers: start this script once on each machine (the first one to run it
+# also submits the jobs; submitting again is harmless). Here, 'n_local_workers'
+# worker processes are started on this machine. When all the jobs are done,
+# the shards are reduced into the costs file and the averaged logs.
+
+import os
+import pandas as pd
+from funcs.init_default import init_default
+from simul.sweep import SweepQueue, run_local_workers
+
+# simulation batch parameters
+steps = 200
+n_simuls = 50
+block_size = 10
+n_local_workers = os.cpu_count() or 1
+
+# data files
+initial_pops_file = os.path.join('..', 'data', 'initial_pops_1.csv')
+
+# shared directory and output files
+shared_dir = os.path.join('outputs', 'sweep')
+output_csv_dir = 'outputs'
+output_csv_name = 'simul_results'
+
+u, w, sc, my_plotter = init_default()
+
+queue = SweepQueue(shared_dir, lease_timeout=120.0, heartbeat=15.0)
+names = queue.submit(pd.read_csv(initial_pops_file), steps, n_simuls, block_size=block_size, universe=u.fingerprint(),
+                     area_fraction=sc.area_fraction)
+run_local_workers(sc, shared_dir, n_local_workers)
+
+if queue.status()['pending'] + queue.status()['leased'] == 0:
+    costs = queue.reduce(sc, output_dir=output_csv_dir, output_name=output_csv_name, names=names)
+    costs.to_csv(os.path.join(output_csv_dir, output_csv_name + '_cost.csv'))
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+#
+# Early stopping with the step iterator ('SimulationControl.iter_steps()'):
+# searches the number of flies with the lowest cost for a given number of
+# moths, following the running cost of each replicate day by day.
+#
+# The cost integrates the caterpillars with the Simpson rule (see
+# 'SimulationControl.cost()'), which is a weighted sum of the daily counts
+# with positive weights, known in advance for the number of steps. So the
+# running cost (flies cost plus the weighted counts so far) only grows, and
+# ends on the same cost as 'cost()'. While a candidate runs, its mean cost is
+# at least the sum of the costs of its finished replicates, the running cost
+# of the current one and the flies cost of the ones left, over the number of
+# replicates; once that lower bound is above the best mean cost found so far,
+# the candidate is dropped without running the rest of its steps (and
+# replicates). A single unlucky replicate doesn't drop a candidate by itself.
+
+import numpy as np
+import scipy.integrate as integrate
+from funcs.init_default import init_default
+
+steps = 200
+n_simuls = 10
+n_moths = 2000
+n_flies_list = list(range(0, 40000, 1500))
+
+u, w, sc, my_plotter = init_default()
+
+# weights of the daily caterpillars on the cost's integral
+weights = sc.cost_moth * integrate.simps(np.eye(steps + 1), axis=0)
+
+best_flies, best_cost = None, np.inf
+for n_flies in n_flies_list:
+    flies_cost = n_flies * sc.cost_fly
+    costs = []
+    for i in range(n_simuls):
+        # bound on the running cost of this replicate, from the bound on the mean
+        bound = n_simuls * best_cost - sum(costs) - (n_simuls - i - 1) * flies_cost
+        running_cost = flies_cost
+        for record in sc.iter_steps(n_flies, n_moths, steps):
+            running_cost += weights[record.instant] * int(record['moth-caterpillars'])
+            if running_cost > bound:
+                break
+        else:
+            costs.append(running_cost)
+            continue
+        print('#flies={}: dropped on day {} of replicate {}'.format(n_flies, record.instant, i + 1))
+        break
+    else:
+        print('#flies={}: mean cost {:.2f}'.format(n_flies, np.mean(costs)))
+        if np.mean(costs) < best_cost:
+            best_flies, best_cost = n_flies, np.mean(costs)
+
+print('best: {} flies, cost {:.2f}'.format(best_flies, best_cost))
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+#
+# Rare event probabilities with multilevel splitting (see 'simul.splitting'):
+# the chance of a caterpillar outbreak (the caterpillars going over a
+# threshold) and of the flies dying out, before the end of the simulation.
+# The hits of each stage are printed; levels with a conditional probability
+# much below 0.1 should be split in more levels.
+
+from funcs.init_default import init_default
+from simul.splitting import RareEventSplitting
+
+# scenario
+n_flies = 6000
+n_moths = 2000
+steps = 200
+
+n_trials = 200
+n_repetitions = 10
+n_workers = None    # one process per cpu
+
+u, w, sc, my_plotter = init_default()
+
+events = [
+    ('caterpillar outbreak', 'moth-caterpillars', [4000, 6000, 8000, 10000, 12000], 'up'),
+    ('flies extinction', 'fly-living', [2000, 1000, 500, 100, 0], 'down')
+]
+for name, column, levels, direction in events:
+    splitting = RareEventSplitting(sc, column, levels, direction=direction, n_trials=n_trials,
+                                   n_repetitions=n_repetitions, n_workers=n_workers)
+    probability, (low, high), stages = splitting.estimate(n_flies, n_moths, steps)
+    print('{}: p = {:.3e} (95% ci {:.3e} - {:.3e})'.format(name, probability, low, high))
+    print(stages)
+    print('    {} steps simulated, crude monte carlo would take {:.0f} replicates ({:.0f} steps)'
+          .format(stages.attrs['steps'], stages.attrs['crude_replicates'], stages.attrs['crude_steps']))
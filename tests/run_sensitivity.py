@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+#
+# Global sensitivity analysis of the cost and of the final populations to
+# some of the universe parameters (see 'simul.sensitivity'), around the
+# default universe. The outputs of the design points are cached, so the
+# script can be stopped and run again (or with a larger design) without
+# running the same points twice.
+
+import os
+import numpy as np
+from funcs.init_default import init_default
+from simul.sensitivity import SensitivityAnalysis
+
+# scenario
+n_flies = 6000
+n_moths = 2000
+steps = 200
+n_replicates = 10
+
+# design rows (rounded up to a power of 2 on the Sobol design)
+n_rows = 64
+n_workers = None    # one process per cpu
+
+# parameters ranges (integer bounds: integer parameters)
+ranges = {
+    'frd': (0.03, 0.07),
+    'mrd': (0.02, 0.04),
+    'fom': (20, 36),
+    'mom': (50, 70),
+    'flm': (20, 28),
+    'predation_coefficient': (5.0, 15.0)
+}
+
+output_csv_dir = 'outputs'
+cache_file = os.path.join(output_csv_dir, 'sensitivity_cache.jsonl')
+indices_file = os.path.join(output_csv_dir, 'sensitivity_indices.csv')
+
+u, w, sc, my_plotter = init_default()
+if not os.path.exists(output_csv_dir):
+    os.mkdir(output_csv_dir)
+
+analysis = SensitivityAnalysis(sc, ranges, n_flies, n_moths, simul_time=steps, n_replicates=n_replicates,
+                               cache_file=cache_file, n_workers=n_workers)
+indices = analysis.run(n=n_rows, method='sobol', seed=np.random.randint(2 ** 31 - 1))
+indices.to_csv(indices_file)
+print(indices)
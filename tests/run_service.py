@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+#
+# Starts the local simulation job service with the default initialisation
+# function. Clients (scripts, notebooks) connect to it with
+#
+#     from simul.service import SimulationClient
+#     client = SimulationClient(socket_path)
+#     result = client.simulate(n_flies, n_moths, steps, n_simuls, progress=print)
+#
+# and share its process pool; identical requests in flight are run only once
+
+import os
+from funcs.init_default import init_default
+from simul.ledger import CostsLedger
+from simul.service import SimulationService
+
+# service parameters
+n_workers = None    # one process per cpu
+socket_path = 'simul_service.sock'
+
+# costs ledger, where the batches run for the bayes cost requests are recorded
+output_csv_dir = 'outputs'
+costs_ledger_file = os.path.join(output_csv_dir, 'simul_results_cost.sqlite')
+
+u, w, sc, my_plotter = init_default()
+sc.costs_ledger = CostsLedger(costs_ledger_file)
+
+print("serving on '{}'".format(socket_path))
+SimulationService(sc, n_workers=n_workers, socket_path=socket_path).run()
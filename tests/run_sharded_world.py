@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+#
+# Single simulation of a very large field on a sharded world (see
+# 'simul.sharded'): the creatures are split among worker processes, which
+# meet once a day to settle the predations. Runs the same scenario on the
+# serial world first (if 'compare' is set), for the running times.
+
+import time
+from funcs.init_default import init_default
+from simul.creatures import Moth
+from simul.creatures import Fly
+from simul.sharded import ShardedWorld
+
+# scenario
+steps = 100
+nf = 50000
+nm = 200000
+
+n_shards = None     # one process per cpu
+compare = False
+
+u, w, sc, my_plotter = init_default()
+
+if compare:
+    start = time.time()
+    serial_log = sc.run_world(nf, nm, steps, lean=True)
+    print('serial world: {:.1f}s, cost {:.2f}'.format(time.time() - start, sc.cost(serial_log)))
+
+sc.world = ShardedWorld(u, fil=w.initial_lifespan[Fly], mil=w.initial_lifespan[Moth], n_shards=n_shards)
+start = time.time()
+sharded_log = sc.run_world(nf, nm, steps, lean=True)
+print('sharded world ({} shards): {:.1f}s, cost {:.2f}'.format(sc.world.n_shards, time.time() - start,
+                                                                sc.cost(sharded_log)))